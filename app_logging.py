@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from sqlalchemy import event
+from opentelemetry import trace
+from models import engine
+
+# دالة db_services أبطأ من هذا تسجل سطراً "slow_call" (مع سياقها: المستخدم، الصفقة...)
+SLOW_CALL_MS = float(os.getenv("SLOW_CALL_MS", "500"))
+# استعلام SQL واحد أبطأ من هذا يسجل بنصه في "slow_query"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+MAX_STATEMENT_CHARS = 2000
+
+# سياق العملية الحالية (operation, user_id, deal_id...): يضاف لكل سطر يكتب أثناءها
+_context = ContextVar("log_context", default={})
+
+# الحقول التي يضيفها LogRecord نفسه (كل ما عداها جاء من extra=)
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """سطر JSON واحد لكل سجل: يقرأه أي جامع سجلات بدون تحليل نصوص"""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(current_context())
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS})
+
+        # ربط السجل بالـ trace الحالي (نفس المعرف في نظام التتبع)
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            entry["trace_id"] = format(span_context.trace_id, "032x")
+            entry["span_id"] = format(span_context.span_id, "016x")
+
+        if record.exc_info:
+            entry["error"] = repr(record.exc_info[1])
+            entry["traceback"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(service):
+    """يستدعى مرة واحدة عند تشغيل العملية (بدل logging.basicConfig)"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter(service))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # كل طلب HTTP من مكتبة تليجرام يسجل سطراً على INFO: ضجيج لا نحتاجه
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    install_slow_query_log(engine)
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    يضيف حقولاً لكل سطر يكتب داخل الكتلة (وما تستدعيه من دوال).
+    تعيد قاموس حالة العملية: mark_call_failed تكتب فيه.
+    """
+    state = {"failed": False}
+    merged = {**_context.get(), **{k: v for k, v in fields.items() if v is not None}}
+    merged["_state"] = state
+    token = _context.set(merged)
+    try:
+        yield state
+    finally:
+        _context.reset(token)
+
+
+def current_context():
+    return {k: v for k, v in _context.get().items() if not k.startswith("_")}
+
+
+def mark_call_failed():
+    """العملية الحالية فشلت حتى لو أعادت قيمة عادية (None / False / [])"""
+    state = _context.get().get("_state")
+    if state is not None:
+        state["failed"] = True
+
+
+def install_slow_query_log(engine):
+    """تسجيل كل استعلام SQL أبطأ من SLOW_QUERY_MS (بنصه، بدون قيم المعاملات)"""
+    log = logging.getLogger("sql.slow")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _log_slow(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - context._query_start) * 1000
+        if elapsed_ms >= SLOW_QUERY_MS:
+            log.warning(
+                "slow_query",
+                extra={
+                    "duration_ms": round(elapsed_ms, 1),
+                    "statement": statement[:MAX_STATEMENT_CHARS],
+                    "rowcount": cursor.rowcount,
+                },
+            )
@@ -0,0 +1,54 @@
+from decimal import Decimal, ROUND_HALF_UP, ROUND_CEILING
+
+# العملة الأساسية: رصيد users.balance_cents والعمولات والتقارير بها (الدولار = USDT)
+BASE_ASSET = "USDT"
+
+# العملات المدعومة ودقة تخزين كل منها (عدد الخانات بعد الفاصلة).
+# المبالغ تخزن كأعداد صحيحة بأصغر وحدة: USDT بالسنت كما كان دائماً، BTC بالساتوشي...
+ASSET_DECIMALS = {
+    "USDT": 2,
+    "USDC": 2,
+    "TON": 9,
+    "BTC": 8,
+    "ETH": 9,
+    "LTC": 8,
+    "BNB": 8,
+    "TRX": 6,
+}
+
+
+def normalize_asset(asset):
+    """اسم العملة بأحرف كبيرة، أو None إذا لم تكن مدعومة"""
+    asset = (asset or BASE_ASSET).strip().upper()
+    return asset if asset in ASSET_DECIMALS else None
+
+
+def to_units(amount, asset, rounding=ROUND_HALF_UP):
+    """مبلغ عشري (مثلاً 0.5 TON) إلى أصغر وحدة (500000000)"""
+    scale = Decimal(10) ** ASSET_DECIMALS[asset]
+    return int((Decimal(str(amount)) * scale).to_integral_value(rounding=rounding))
+
+
+def from_units(units, asset):
+    """أصغر وحدة إلى مبلغ عشري"""
+    return Decimal(units or 0).scaleb(-ASSET_DECIMALS[asset]).normalize()
+
+
+def format_amount(units, asset):
+    """للعرض: '10.5$' للعملة الأساسية و '0.25 TON' لغيرها"""
+    amount = from_units(units, asset)
+    text = f"{amount:f}"
+    return f"{text}$" if asset == BASE_ASSET else f"{text} {asset}"
+
+
+def convert_units(units, from_asset, to_asset, rates):
+    """
+    تحويل بين عملتين عبر سعر كل منهما بالدولار (rates: {العملة: سعر الوحدة الكاملة بالدولار}).
+    نقرب للأعلى: من يدفع لا يدفع أقل من القيمة.
+    تعيد (المبلغ بأصغر وحدة للعملة الهدف، السعر المستخدم: كم وحدة هدف لكل وحدة مصدر).
+    """
+    if from_asset == to_asset:
+        return units, Decimal(1)
+    rate = Decimal(rates[from_asset]) / Decimal(rates[to_asset])
+    amount = from_units(units, from_asset) * rate
+    return to_units(amount, to_asset, rounding=ROUND_CEILING), rate
@@ -0,0 +1,72 @@
+import time
+import asyncio
+import logging
+import redis.asyncio as aioredis
+from models import Session, User
+
+log = logging.getLogger(__name__)
+
+# قناة Redis لأحداث الحظر: "ban:123" أو "unban:123"
+BANS_CHANNEL = "bans"
+# إعادة تحميل احتياطية: Pub/Sub لا يحفظ الرسائل، وما ضاع منها (انقطاع قصير لم نلاحظه)
+# يبقى خطأ في هذه النسخة حتى التحميل التالي (مثل PERMISSIONS_REFRESH_SECONDS)
+BANS_REFRESH_SECONDS = 300
+
+# المحظورون حالياً: فحص كل تحديث يكون بحثاً في مجموعة بالذاكرة، بدون قاعدة البيانات
+_banned = set()
+
+
+def load_bans():
+    """إعادة بناء المجموعة من القاعدة (عند التشغيل وبعد كل انقطاع عن Redis)"""
+    global _banned
+    session = Session()
+    try:
+        rows = session.query(User.id).filter(User.is_banned.is_(True)).all()
+        _banned = {r.id for r in rows}
+        return len(_banned)
+    finally:
+        session.close()
+
+
+def is_banned(user_id):
+    return user_id in _banned
+
+
+def apply_ban_event(event):
+    action, _, user_id = (event or "").partition(":")
+    if not user_id.isdigit():
+        return
+    if action == "ban":
+        _banned.add(int(user_id))
+    elif action == "unban":
+        _banned.discard(int(user_id))
+
+
+async def ban_sync_listener():
+    """حلقة خلفية: كل نسخة من البوت تطبق الحظر فور صدوره من أي نسخة أخرى"""
+    while True:
+        client = aioredis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(BANS_CHANNEL)
+            # ما صدر أثناء الانقطاع لم يصلنا: نقرأ الحالة كاملة من القاعدة بعد الاشتراك
+            await asyncio.to_thread(load_bans)
+            reloaded = time.monotonic()
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=BANS_REFRESH_SECONDS
+                )
+                if message and message.get("type") == "message":
+                    apply_ban_event(message["data"])
+                if time.monotonic() - reloaded >= BANS_REFRESH_SECONDS:
+                    await asyncio.to_thread(load_bans)
+                    reloaded = time.monotonic()
+        except Exception:
+            log.exception("Ban sync error")
+            await asyncio.sleep(5)
+        finally:
+            try:
+                await pubsub.aclose()
+                await client.aclose()
+            except Exception:
+                pass
@@ -1,13 +1,28 @@
+import asyncio
+import csv
+import io
 import html
 import time
 import os
 import logging
 from dotenv import load_dotenv
-from db_services import check_spam_protection, verify_admin_action
+from db_services import check_spam_protection, verify_admin_action_async
+from db_services import get_admin_session, end_admin_session, ADMIN_SESSION_TTL_SECONDS
+from db_services import request_withdrawal, get_pending_withdrawals, approve_withdrawals
+from db_services import resolve_reviewed_withdrawal
+from db_services import get_revenue_report, get_user_balances
+from db_services import MAX_BULK_DEALS, create_deals_bulk, save_deal_template, get_deal_templates
+from db_services import create_deals_from_template
+from db_services import get_dispute_queue, claim_dispute_case
+from assets import BASE_ASSET, ASSET_DECIMALS, normalize_asset, format_amount
+from models import AdminRole, WithdrawalStatus
+from results import Result
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 from decimal import Decimal, InvalidOperation
-from db_services import get_or_create_user, get_user_rating
+from db_services import get_or_create_user, get_user_rating, get_user_with_deal
+from deal_links import PAY_PREFIX, deal_pay_link, normalize_public_id
 from utils import get_text
 from telegram.ext import (
     ApplicationBuilder,
@@ -17,6 +32,11 @@ from telegram.ext import (
     filters,
     ConversationHandler,
     CallbackQueryHandler,
+    CallbackContext,
+    ExtBot,
+    InlineQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
 
 # استيراد الخدمات (تأكد أن db_services يحتوي على الدوال الجديدة)
@@ -27,17 +47,37 @@ from db_services import (
     add_balance_to_user,
     create_new_deal,
     get_deal_details,
+    resolve_deal_ref,
     process_deal_payment,
     get_user_active_deals,
+    set_deal_milestones,
+    get_deal_milestones,
     mark_deal_delivered,
     release_deal_funds,
 )
-from payment_services import create_deposit_invoice, check_invoice_status
-
-# إعداد السجلات (Logs)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+from payment_services import create_deposit_invoice, check_invoice_status, IS_TESTNET
+from message_buffer import message_log_buffer
+from evidence_archiver import EvidenceArchiver
+from leaderboard import get_top_sellers, get_seller_rank, search_top_sellers, leaderboard_refresher
+from withdrawal_worker import withdrawal_worker
+from exchange_rates import rates_refresher
+from revenue_aggregator import revenue_aggregator
+from milestone_sweeper import milestone_sweeper
+from permissions import permissions_listener, has_role, admins_with_role
+from bans import is_banned, load_bans, ban_sync_listener
+from metrics import start_bot_metrics_server, instrument_handlers
+from tracing import init_tracing, trace_handlers, TracedRequest
+from app_logging import configure_logging
+from outbox import notify, notify_many, send_now, send_with_outcome, outbox_worker
+from db_services import set_user_ban
+from db_services import create_broadcast, cancel_broadcast, get_broadcast
+from broadcaster import broadcast_worker, broadcast_report
+import profiling
+from migrations import check_schema
+
+# إعداد السجلات (Logs): سطر JSON لكل سجل مع سياق المعالج والمستخدم
+configure_logging("escrow-bot")
+log = logging.getLogger(__name__)
 load_dotenv()
 
 # تعريف حالات المحادثة (0, 1, 2 للبائع) و (3, 4 للمشتري)
@@ -45,6 +85,39 @@ ASK_PRICE, ASK_DESCRIPTION, CONFIRM_DEAL, PAY_ASK_ID, PAY_CONFIRM = range(5)
 
 USER_COOLDOWNS = {}
 
+
+class EscrowContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """
+    سياق مخصص: تطبيق تليجرام ينشئ نسخة جديدة منه لكل تحديث (Update)،
+    لذلك deal_cache هنا كاش يعيش طوال معالجة طلب واحد فقط ثم يختفي.
+    """
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application=application, chat_id=chat_id, user_id=user_id)
+        self.deal_cache = {}
+
+
+def remember_deal(context, deal):
+    """نحفظ صورة الصفقة التي أعادتها دوال القاعدة لنعيد استخدامها في نفس الطلب"""
+    if deal and isinstance(context, EscrowContext):
+        context.deal_cache[deal["id"]] = deal
+    return deal
+
+
+def get_deal_cached(context, deal_id):
+    """رحلة واحدة فقط لقاعدة البيانات لكل صفقة داخل نفس التحديث"""
+    if isinstance(context, EscrowContext) and deal_id in context.deal_cache:
+        return context.deal_cache[deal_id]
+    return remember_deal(context, get_deal_details(deal_id))
+
+
+def deal_milestones(deal):
+    """المراحل من صورة الصفقة إن حُملت معها، وإلا (صورة من دالة تعديل) من قاعدة البيانات"""
+    if "milestones" in deal:
+        return deal["milestones"]
+    return get_deal_milestones(deal["id"])
+
+
 def is_spamming(user_id):
     return check_spam_protection(user_id, limit=3, window_seconds=2)
     
@@ -54,6 +127,57 @@ def is_spamming(user_id):
     USER_COOLDOWNS[user_id] = now
     return False
 
+def pop_pin(user_id, args, position):
+    """
+    مع جلسة أدمن فعالة لا يُكتب الـ PIN في الأمر.
+    تعيد (المعاملات بدون الـ PIN، الـ PIN أو None).
+    position: موضع الـ PIN في صيغة الأمر عند عدم وجود جلسة.
+    """
+    args = list(args or [])
+    if position < 0 or len(args) <= position or get_admin_session(user_id) is not None:
+        return args, None
+    return args[:position] + args[position + 1:], args[position]
+
+
+ADMIN_AUTH_ERRORS = {
+    Result.NO_PERMISSION: "⛔ غير مصرح.",
+    Result.WRONG_PIN: "❌ **رمز الأمان (PIN) غير صحيح!**\nتم تسجيل محاولة دخول فاشلة.",
+    Result.LOCKED: "🔒 **محاولات خاطئة كثيرة.**\nتم إيقاف الدخول مؤقتاً، حاول لاحقاً.",
+    Result.PIN_REQUIRED: "🔑 أضف الـ PIN للأمر، أو افتح جلسة: `/login [PIN]`",
+}
+
+
+async def authorize_admin(update, pin_input, required_role=None):
+    """
+    التحقق من الأدمن بدون إيقاف البوت (bcrypt في مجمع خيوط) مع الرد الموحد عند الرفض.
+    رسالة فيها PIN تحذف من المحادثة.
+    """
+    auth_status = await verify_admin_action_async(update.effective_user.id, pin_input, required_role)
+    if pin_input:
+        try:
+            await update.message.delete()
+        except Exception:
+            pass  # الحذف تحسين أمني فقط
+    if auth_status == Result.AUTHORIZED:
+        return True
+    if auth_status != Result.NOT_ADMIN:  # غير الأدمن نتجاهله بصمت
+        await update.effective_chat.send_message(ADMIN_AUTH_ERRORS[auth_status], parse_mode="Markdown")
+    return False
+
+
+async def ban_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    يعمل قبل كل المعالجات (group -1): المحظور يتوقف هنا.
+    الفحص بحث في مجموعة بالذاكرة (bans.py) بدون أي استعلام.
+    """
+    user = update.effective_user
+    if user is None or not is_banned(user.id):
+        return
+    if update.callback_query:
+        await update.callback_query.answer("⛔ حسابك محظور.", show_alert=True)
+    raise ApplicationHandlerStop
+
+
 # --- 1. القائمة الرئيسية ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -107,26 +231,41 @@ async def start_new_deal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
 
     target = query.message if query else update.message
-    await target.reply_text("1️⃣ حسناً، أرسل سعر السلعة أو الخدمة بالدولار (مثلاً: 50):")
+    await target.reply_text(
+        "1️⃣ حسناً، أرسل سعر السلعة أو الخدمة بالدولار (مثلاً: 50)\n"
+        "أو بعملة أخرى بعد الرقم (مثلاً: 2.5 TON):"
+    )
     return ASK_PRICE
 
 
 async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        raw_price = Decimal(update.message.text)
+        parts = update.message.text.split()
+        if not 1 <= len(parts) <= 2:
+            raise ValueError("صيغة غير صحيحة")
+        raw_price = Decimal(parts[0])
+        asset = normalize_asset(parts[1] if len(parts) == 2 else BASE_ASSET)
+        if asset is None:
+            await update.message.reply_text(
+                "⚠️ عملة غير مدعومة. المتاح: " + "، ".join(ASSET_DECIMALS)
+            )
+            return ASK_PRICE
         
         # 1. الحماية من الأرقام السالبة أو الصفر
         if raw_price <= 0:
              raise ValueError("السعر يجب أن يكون أكبر من صفر")
 
         # 2. الفلترة الصارمة للكسور (Rounding Strategy)
-        # هذا السطر يحول أي رقم مثل 10.559 إلى 10.56 ويقطع أي كسور زائدة بدقة
-        price = raw_price.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        # هذا السطر يحول أي رقم مثل 10.559 إلى 10.56 (أو دقة العملة) ويقطع أي كسور زائدة بدقة
+        price = raw_price.quantize(Decimal(1).scaleb(-ASSET_DECIMALS[asset]), rounding=ROUND_HALF_UP)
+        if price <= 0:
+             raise ValueError("السعر يجب أن يكون أكبر من صفر")
         
         # (اختياري) إذا كنت تريد رفض الكسور الزائدة بدلاً من تقريبها، احتفظ بالتحقق القديم.
         # لكن التقريب هنا أكثر سلاسة للمستخدم:
         
         context.user_data["temp_price"] = price
+        context.user_data["temp_asset"] = asset
         await update.message.reply_text("2️⃣ عظيم! الآن أرسل وصفاً مختصراً للصفقة:")
         return ASK_DESCRIPTION
     except (ValueError, InvalidOperation):  # InvalidOperation هي خطأ Decimal
@@ -142,11 +281,13 @@ async def handle_description(update: Update, context: ContextTypes.DEFAULT_TYPE)
     clean_desc = html.escape(raw_text)
     context.user_data['temp_desc'] = clean_desc
     price = context.user_data['temp_price']
+    asset = context.user_data.get("temp_asset", BASE_ASSET)
     desc = context.user_data["temp_desc"]
+    price_text = f"{price}$" if asset == BASE_ASSET else f"{price.normalize():f} {asset}"
 
     msg = (
         f"⚠️ **مراجعة الصفقة قبل النشر:**\n\n"
-        f"💰 السعر: {price}$\n"
+        f"💰 السعر: {price_text}\n"
         f"📝 الوصف: {desc}\n\n"
         "هل تريد تأكيد إنشاء الصفقة؟"
     )
@@ -168,15 +309,18 @@ async def finalize_deal(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     seller_id = query.from_user.id
     price = context.user_data["temp_price"]
+    asset = context.user_data.get("temp_asset", BASE_ASSET)
     desc = context.user_data["temp_desc"]
 
-    deal_id = create_new_deal(seller_id, price, desc)
+    public_id = create_new_deal(seller_id, price, desc, asset)
 
-    if deal_id:
+    if public_id:
         await query.edit_message_text(
             f"✅ **تم إنشاء الصفقة بنجاح!**\n\n"
-            f"رقم الصفقة: `{deal_id}`\n\n"
-            f"الخطوة التالية: أرسل هذا الرقم للمشتري ليقوم بالدفع."
+            f"رمز الصفقة: `{public_id}`\n\n"
+            f"الخطوة التالية: أرسل هذا الرابط للمشتري ليدفع بضغطة واحدة:\n"
+            f"{deal_pay_link(context.bot.username, public_id)}",
+            disable_web_page_preview=True,
         )
     else:
         await query.edit_message_text("❌ فشل إنشاء الصفقة في قاعدة البيانات.")
@@ -191,29 +335,55 @@ async def start_pay_deal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     await query.message.reply_text(
         "💸 **دفع قيمة صفقة**\n\n"
-        "أرسل لي **رقم الصفقة** التي تريد دفع قيمتها (مثلاً: 105):",
+        "أرسل لي **رمز الصفقة** الذي أعطاك إياه البائع (مثلاً: 7KQ2M9XD4RTA):",
         parse_mode="Markdown",
     )
     return PAY_ASK_ID
 
 
 async def preview_deal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        deal_id = int(update.message.text)
-    except ValueError:
-        await update.message.reply_text("⚠️ يرجى إرسال أرقام فقط.")
-        return PAY_ASK_ID
+    deal_id = resolve_deal_ref(update.message.text)
 
     # جلب التفاصيل
-    deal = get_deal_details(deal_id)
+    deal = get_deal_cached(context, deal_id) if deal_id else None
 
-    # فحوصات الأمان
     if not deal:
         await update.message.reply_text(
-            "❌ لم يتم العثور على صفقة بهذا الرقم. حاول مرة أخرى:"
+            "❌ لم يتم العثور على صفقة بهذا الرمز. حاول مرة أخرى:"
         )
         return PAY_ASK_ID
 
+    return await show_deal_preview(update, context, deal)
+
+
+async def pay_link_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /start pay_<رمز الصفقة>: رابط الدفع المباشر يفتح شاشة الدفع فوراً بدون سؤال رقم الصفقة.
+    الرمز العام لا يمكن تخمينه، والمستخدم والصفقة يجلبان معاً بجلسة واحدة (بحث بالفهرس).
+    """
+    user = update.effective_user
+    public_id = normalize_public_id(context.args[0][len(PAY_PREFIX):])
+    if public_id is None:
+        await update.message.reply_text("❌ رابط الدفع غير صالح. اطلب من البائع رابطاً جديداً.")
+        return ConversationHandler.END
+
+    db_user, deal = get_user_with_deal(user.id, user.full_name, user.username, public_id)
+    if not db_user:
+        await update.message.reply_text("❌ خطأ فني في قاعدة البيانات.")
+        return ConversationHandler.END
+    if not deal:
+        await update.message.reply_text("❌ لم يتم العثور على الصفقة.")
+        return ConversationHandler.END
+
+    remember_deal(context, deal)
+    return await show_deal_preview(update, context, deal)
+
+
+async def show_deal_preview(update, context, deal):
+    """شاشة الفاتورة مع زر الدفع (من إدخال الرقم أو من رابط الدفع)"""
+    deal_id = deal["id"]
+
+    # فحوصات الأمان
     if deal["seller_id"] == update.effective_user.id:
         await update.message.reply_text("⛔ لا يمكنك شراء صفقتك الخاصة!")
         return ConversationHandler.END
@@ -227,16 +397,27 @@ async def preview_deal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # عرض الفاتورة
     context.user_data["paying_deal_id"] = deal_id
     msg = (
-        f"🧾 **تفاصيل الصفقة #{deal['id']}**\n\n"
+        f"🧾 **تفاصيل الصفقة #{deal['public_id']}**\n\n"
         f"👤 البائع: **{deal['seller_name']}**\n"
-        f"💰 المبلغ المطلوب: **{deal['amount']}$**\n"
+        f"💰 المبلغ المطلوب: **{deal['amount_text']}**\n"
         f"📝 الوصف: {deal['description']}\n\n"
-        "هل تريد دفع المبلغ وحجز الصفقة الآن؟"
     )
+    milestones = deal_milestones(deal)
+    if milestones:
+        msg += "🧩 **المراحل** (كل مرحلة تُسلم وتُحرر وحدها):\n" + "\n".join(
+            f"{m['no']}. {m['title']}: {m['amount_text']}" for m in milestones
+        ) + "\n\n"
+    msg += "هل تريد دفع المبلغ وحجز الصفقة الآن؟"
     keyboard = [
-        [InlineKeyboardButton("✅ موافق ودفع الآن", callback_data="confirm_pay")],
-        [InlineKeyboardButton("❌ إلغاء", callback_data="cancel_conv")],
+        [InlineKeyboardButton("✅ موافق ودفع الآن", callback_data=f"confirm_pay:{deal['asset']}")],
     ]
+    if deal["asset"] != BASE_ASSET:
+        # الدفع من رصيد الدولار مع التحويل بسعر لحظة الدفع
+        keyboard.append(
+            [InlineKeyboardButton(f"💱 ادفع من رصيد {BASE_ASSET} (تحويل بسعر اللحظة)",
+                                  callback_data=f"confirm_pay:{BASE_ASSET}")]
+        )
+    keyboard.append([InlineKeyboardButton("❌ إلغاء", callback_data="cancel_conv")])
     await update.message.reply_text(
         msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown"
     )
@@ -249,32 +430,34 @@ async def execute_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     deal_id = context.user_data["paying_deal_id"]
     buyer_id = query.from_user.id
+    # العملة التي اختار الدفع بها (confirm_pay:TON)
+    pay_asset = normalize_asset(query.data.partition(":")[2] or None)
 
     # تنفيذ عملية الدفع الذرية
-    result = process_deal_payment(deal_id, buyer_id)
+    result = process_deal_payment(deal_id, buyer_id, pay_asset)
+
+    if isinstance(result, dict) and result["status"] == Result.SUCCESS:
+        # الدالة تعيد صورة الصفقة كاملة، فلا حاجة لجلبها مرة أخرى
+        deal_info = remember_deal(context, result["deal"])
 
-    if result == "SUCCESS":
         # إشعار المشتري
         await query.edit_message_text(
             f"✅ **تم الدفع وحجز الأموال!**\n\n"
-            f"الصفقة #{deal_id} أصبحت نشطة الآن.\n"
+            f"الصفقة #{deal_info['public_id']} أصبحت نشطة الآن.\n"
             f"لقد قمنا بإبلاغ البائع ليبدأ التنفيذ."
         )
 
-        # محاولة إشعار البائع
-        deal_info = get_deal_details(deal_id)
+        # إشعار البائع (عبر صندوق الصادر: يعاد عند 429، والنتيجة تسجل)
         if deal_info:
-            try:
-                await context.bot.send_message(
-                    chat_id=deal_info["seller_id"],
-                    text=f"🔔 **تنبيه جديد!**\n\n"
-                    f"قام المشتري بدفع قيمة الصفقة #{deal_id}.\n"
-                    f"المال محجوز لدينا (Escrow). يمكنك تسليم السلعة/الخدمة الآن بأمان.",
-                )
-            except Exception:
-                pass  # قد يكون البائع حظر البوت
+            await notify(
+                deal_info["seller_id"],
+                f"🔔 **تنبيه جديد!**\n\n"
+                f"قام المشتري بدفع قيمة الصفقة #{deal_info['public_id']}.\n"
+                f"المال محجوز لدينا (Escrow). يمكنك تسليم السلعة/الخدمة الآن بأمان.",
+                kind="deal_paid",
+            )
 
-    elif result == "INSUFFICIENT_FUNDS":
+    elif result == Result.INSUFFICIENT_FUNDS:
         await query.edit_message_text(
             "⛔ **رصيدك غير كافٍ!**\n\n" "يرجى شحن رصيدك أولاً.",
             reply_markup=InlineKeyboardMarkup(
@@ -282,9 +465,12 @@ async def execute_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ),
         )
 
-    elif result == "DEAL_NOT_PENDING":
+    elif result == Result.DEAL_NOT_PENDING:
         await query.edit_message_text("❌ عذراً، يبدو أن هذه الصفقة تم دفعها بالفعل.")
 
+    elif result == Result.RATES_UNAVAILABLE:
+        await query.edit_message_text("⏳ أسعار الصرف غير متاحة حالياً، حاول بعد دقيقة.")
+
     else:
         await query.edit_message_text("❌ حدث خطأ غير متوقع.")
 
@@ -305,32 +491,38 @@ async def cancel_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def deposit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        # استخراج المبلغ: /deposit 10
+        # استخراج المبلغ والعملة (اختيارية): /deposit 10 أو /deposit 2 TON
         amount = Decimal(context.args[0])
         if amount <= 0:
             raise ValueError
+        asset = normalize_asset(context.args[1] if len(context.args) > 1 else BASE_ASSET)
+        if asset is None:
+            raise ValueError
     except (IndexError, ValueError, InvalidOperation):
         await update.message.reply_text(
-            "❌ خطأ!\nاكتب الأمر ثم المبلغ.\nمثال: `/deposit 10`"
+            "❌ خطأ!\nاكتب الأمر ثم المبلغ (والعملة اختيارياً).\nمثال: `/deposit 10` أو `/deposit 2 TON`\n"
+            "العملات: " + "، ".join(ASSET_DECIMALS)
         )
         return
 
     msg = await update.message.reply_text("⏳ جاري إنشاء رابط الدفع...")
 
     # استدعاء خدمة الدفع
-    invoice_data = await create_deposit_invoice(user_id, amount)
+    invoice_data = await create_deposit_invoice(user_id, amount, asset)
 
     if invoice_data:
         # حفظ رقم الفاتورة للتحقق
         context.user_data["invoice_id"] = invoice_data["invoice_id"]
         context.user_data["deposit_amount"] = amount
+        context.user_data["deposit_asset"] = asset
+        amount_text = f"{amount}$" if asset == BASE_ASSET else f"{amount} {asset}"
 
         keyboard = [
             [InlineKeyboardButton("🔗 اضغط للدفع", url=invoice_data["pay_url"])],
             [InlineKeyboardButton("✅ لقد دفعت", callback_data="check_deposit")],
         ]
         await msg.edit_text(
-            f"💳 **شحن رصيد: {amount}$**\nصلاحية الرابط 15 دقيقة.",
+            f"💳 **شحن رصيد: {amount_text}**\nصلاحية الرابط 15 دقيقة.",
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
     else:
@@ -344,6 +536,7 @@ async def check_deposit_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     invoice_id = context.user_data.get("invoice_id")
     amount = context.user_data.get("deposit_amount")
+    asset = context.user_data.get("deposit_asset", BASE_ASSET)
 
     if not invoice_id:
         await query.edit_message_text("❌ لا توجد عملية معلقة.")
@@ -352,8 +545,15 @@ async def check_deposit_handler(update: Update, context: ContextTypes.DEFAULT_TY
     status = await check_invoice_status(invoice_id)
 
     if status == "paid":
-        add_balance_to_user(query.from_user.id, amount)
-        await query.edit_message_text(f"✅ **تم الشحن بنجاح!**\nأضيف {amount}$ لرصيدك.")
+        result = add_balance_to_user(query.from_user.id, amount, asset, invoice_id=invoice_id)
+        if not result:
+            await query.edit_message_text(
+                "❌ تعذر الشحن مؤقتاً، اضغط الزر مرة أخرى بعد قليل.",
+                reply_markup=query.message.reply_markup,
+            )
+            return
+        amount_text = f"{amount}$" if asset == BASE_ASSET else f"{amount} {asset}"
+        await query.edit_message_text(f"✅ **تم الشحن بنجاح!**\nأضيف {amount_text} لرصيدك.")
     elif status == "active":
         await query.edit_message_text(
             "⏳ الفاتورة لم تدفع بعد. حاول مجدداً بعد الدفع.",
@@ -385,10 +585,10 @@ async def list_deals_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     keyboard = []
     for deal in deals:
         # شكل الزر: "صفقة #10 - بائع - 50$"
-        btn_text = f"#{deal['id']} | {deal['role']} | {deal['amount']}$"
-        # عند الضغط، نرسل أمر: manage_deal_10
+        btn_text = f"#{deal['public_id']} | {deal['role']} | {deal['amount_text']}"
+        # عند الضغط، نرسل أمر: manage_deal_<الرمز العام> (الرقم الداخلي لا يخرج للمستخدم)
         keyboard.append(
-            [InlineKeyboardButton(btn_text, callback_data=f"manage_deal_{deal['id']}")]
+            [InlineKeyboardButton(btn_text, callback_data=f"manage_deal_{deal['public_id']}")]
         )
 
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="back_home")])
@@ -404,11 +604,12 @@ async def manage_deal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
 
-    # استخراج رقم الصفقة من الزر (manage_deal_105)
-    deal_id = int(query.data.split("_")[2])
+    # استخراج رمز الصفقة من الزر (manage_deal_7KQ2M9XD4RTA)
+    public_id = query.data.split("_")[2]
+    deal_id = resolve_deal_ref(public_id)
 
     # جلب التفاصيل
-    deal = get_deal_details(deal_id)  # موجودة سابقاً
+    deal = get_deal_cached(context, deal_id) if deal_id else None
     user_id = query.from_user.id
 
     if not deal:
@@ -419,21 +620,41 @@ async def manage_deal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     is_seller = user_id == deal["seller_id"]
 
     msg = (
-        f"⚙️ **إدارة الصفقة #{deal_id}**\n"
+        f"⚙️ **إدارة الصفقة #{public_id}**\n"
         f"الحالة: `{deal['status']}`\n"
-        f"المبلغ: {deal['amount']}$\n"
+        f"المبلغ: {deal['amount_text']}\n"
         f"الوصف: {deal['description']}\n"
     )
 
     keyboard = []
+    milestones = deal_milestones(deal) if deal["status"] == "active" else []
+
+    if milestones:
+        # صفقة بمراحل: الأزرار لكل مرحلة على حدة
+        msg += "\n🧩 **المراحل:**\n"
+        for m in milestones:
+            msg += f"{m['no']}. {m['title']}: {m['amount_text']} (`{m['status']}`)\n"
+            if is_seller and m["status"] == "active":
+                keyboard.append([InlineKeyboardButton(
+                    f"🚚 تم تسليم المرحلة {m['no']}", callback_data=f"seller_done_{public_id}_{m['no']}"
+                )])
+            elif not is_seller and m["status"] in ("active", "delivered"):
+                keyboard.append([
+                    InlineKeyboardButton(
+                        f"💰 حرر المرحلة {m['no']}", callback_data=f"buyer_confirm_{public_id}_{m['no']}"
+                    ),
+                    InlineKeyboardButton(
+                        f"🚨 نزاع {m['no']}", callback_data=f"dispute_{public_id}_{m['no']}"
+                    ),
+                ])
 
-    if is_seller:
+    elif is_seller:
         if deal["status"] == "active":
             msg += "\n💡 **المطلوب:** قم بتنفيذ الخدمة/تسليم السلعة للمشتري (خارج البوت أو في الشات)، ثم اضغط الزر أدناه."
             keyboard.append(
                 [
                     InlineKeyboardButton(
-                        "🚚 تم التسليم", callback_data=f"seller_done_{deal_id}"
+                        "🚚 تم التسليم", callback_data=f"seller_done_{public_id}"
                     )
                 ]
             )
@@ -449,18 +670,26 @@ async def manage_deal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
                 [
                     InlineKeyboardButton(
                         "💰 استلمت - حرر المال",
-                        callback_data=f"buyer_confirm_{deal_id}",
+                        callback_data=f"buyer_confirm_{public_id}",
                     )
                 ]
             )
             keyboard.append(
                 [
                     InlineKeyboardButton(
-                        "🚨 مشكلة / نزاع", callback_data=f"dispute_{deal_id}"
+                        "🚨 مشكلة / نزاع", callback_data=f"dispute_{public_id}"
                     )
                 ]
             )
 
+    if deal.get("buyer_id"):
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    "💬 غرفة المحادثة", callback_data=f"chat_enter_{public_id}"
+                )
+            ]
+        )
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="my_active_deals")])
 
     await query.edit_message_text(
@@ -470,24 +699,27 @@ async def manage_deal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def seller_delivered_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    deal_id = int(query.data.split("_")[2])
+    # seller_done_<رمز الصفقة> أو seller_done_<رمز الصفقة>_2 (المرحلة 2)
+    parts = query.data.split("_")
+    public_id = parts[2]
+    deal_id = resolve_deal_ref(public_id)
+    milestone_no = int(parts[3]) if len(parts) > 3 else None
     seller_id = query.from_user.id
 
-    result = mark_deal_delivered(deal_id, seller_id)  # دالة القاعدة
+    result = mark_deal_delivered(deal_id, seller_id, milestone_no)  # دالة القاعدة
 
-    if result == "SUCCESS" or isinstance(result, dict):  # لأننا أعدنا قاموساً
+    if result == Result.SUCCESS or isinstance(result, dict):  # لأننا أعدنا قاموساً
         await query.answer("✅ تم تحديث الحالة!")
         # إشعار المشتري
         buyer_id = result["buyer_id"]
-        try:
-            await context.bot.send_message(
-                buyer_id,
-                f"📢 **تحديث بخصوص الصفقة #{deal_id}**\n"
-                f"يخبرنا البائع أنه أتم التسليم.\n"
-                f"يرجى التحقق ثم تأكيد الاستلام من قائمة 'صفقاتي النشطة'.",
-            )
-        except:
-            pass
+        what = f"المرحلة {milestone_no} من الصفقة #{public_id}" if milestone_no else f"الصفقة #{public_id}"
+        await notify(
+            buyer_id,
+            f"📢 **تحديث بخصوص {what}**\n"
+            f"يخبرنا البائع أنه أتم التسليم.\n"
+            f"يرجى التحقق ثم تأكيد الاستلام من قائمة 'صفقاتي النشطة'.",
+            kind="deal_delivered",
+        )
 
         # تحديث رسالة البائع
         await query.edit_message_text(
@@ -500,16 +732,34 @@ async def seller_delivered_action(update: Update, context: ContextTypes.DEFAULT_
 # 2. المشتري يضغط "تأكيد الاستلام" (تحرير المال)
 async def buyer_confirm_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    deal_id = int(query.data.split("_")[2])
+    # buyer_confirm_<رمز الصفقة> أو buyer_confirm_<رمز الصفقة>_2 (المرحلة 2)
+    parts = query.data.split("_")
+    public_id = parts[2]
+    deal_id = resolve_deal_ref(public_id)
+    milestone_no = int(parts[3]) if len(parts) > 3 else None
     buyer_id = query.from_user.id
 
     # تحرير الأموال
-    res = release_deal_funds(deal_id, buyer_id)  # دالة القاعدة
+    res = release_deal_funds(deal_id, buyer_id, milestone_no)  # دالة القاعدة
+
+    if isinstance(res, dict) and res["status"] == Result.SUCCESS and milestone_no and res["deal_status"] != "completed":
+        # مرحلة واحدة تحررت والصفقة مستمرة: التقييم عند انتهاء كل المراحل
+        await query.edit_message_text(
+            f"✅ **تم تحرير المرحلة {milestone_no}.**\n"
+            f"💸 تم تحويل {res['net_amount']} للبائع."
+        )
+        await notify(
+            res["seller_id"],
+            f"💵 **تم تحرير المرحلة {milestone_no} من الصفقة #{public_id}.**\n"
+            f"المبلغ الصافي: {res['net_amount']}\n"
+            f"عمولة المنصة: {res['fee']}",
+            kind="milestone_released",
+        )
 
-    if isinstance(res, dict) and res["status"] == "SUCCESS":
+    elif isinstance(res, dict) and res["status"] == Result.SUCCESS:
         await query.edit_message_text(
             f"🎉 **ألف مبروك! تمت العملية بنجاح.**\n\n"
-            f"💸 تم تحويل {res['net_amount']}$ للبائع.\n"
+            f"💸 تم تحويل {res['net_amount']} للبائع.\n"
             f"🤝 شكراً لثقتكم بنا.\n\n"
             f"👇 **كيف كان أداء البائع؟** يرجى التقييم:"
         )
@@ -517,27 +767,27 @@ async def buyer_confirm_action(update: Update, context: ContextTypes.DEFAULT_TYP
         seller_id = res['seller_id']
         keyboard = [
             [
-                InlineKeyboardButton("⭐ 1", callback_data=f"rate_{deal_id}_1_{seller_id}"),
-                InlineKeyboardButton("⭐ 2", callback_data=f"rate_{deal_id}_2_{seller_id}"),
-                InlineKeyboardButton("⭐ 3", callback_data=f"rate_{deal_id}_3_{seller_id}"),
-                InlineKeyboardButton("⭐ 4", callback_data=f"rate_{deal_id}_4_{seller_id}"),
-                InlineKeyboardButton("⭐ 5", callback_data=f"rate_{deal_id}_5_{seller_id}"),
+                InlineKeyboardButton("⭐ 1", callback_data=f"rate_{public_id}_1_{seller_id}"),
+                InlineKeyboardButton("⭐ 2", callback_data=f"rate_{public_id}_2_{seller_id}"),
+                InlineKeyboardButton("⭐ 3", callback_data=f"rate_{public_id}_3_{seller_id}"),
+                InlineKeyboardButton("⭐ 4", callback_data=f"rate_{public_id}_4_{seller_id}"),
+                InlineKeyboardButton("⭐ 5", callback_data=f"rate_{public_id}_5_{seller_id}"),
             ]
         ]
         await query.message.reply_text("مقياس الجودة:", reply_markup=InlineKeyboardMarkup(keyboard))
 
         # إشعار البائع بالمال
-        try:
-            await context.bot.send_message(
-                res["seller_id"],
-                f"💵 **مبروك! وصلتك أرباح جديدة.**\n\n"
-                f"تم إكمال الصفقة #{deal_id}.\n"
-                f"المبلغ الصافي: {res['net_amount']}$\n"
-                f"عمولة المنصة: {res['fee']}$\n\n"
-                f"رصيدك الحالي قد تم تحديثه.",
-            )
-        except:
-            pass
+        await notify(
+            res["seller_id"],
+            f"💵 **مبروك! وصلتك أرباح جديدة.**\n\n"
+            f"تم إكمال الصفقة #{public_id}.\n"
+            f"المبلغ الصافي: {res['net_amount']}\n"
+            f"عمولة المنصة: {res['fee']}\n\n"
+            f"رصيدك الحالي قد تم تحديثه.",
+            kind="deal_completed",
+        )
+    elif res == Result.RATES_UNAVAILABLE:
+        await query.answer("⏳ أسعار الصرف غير متاحة حالياً، حاول بعد دقيقة.", show_alert=True)
     else:
         await query.answer("❌ خطأ! لا يمكن إتمام العملية.", show_alert=True)
 
@@ -545,9 +795,9 @@ async def rate_seller_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    # تفكيك البيانات: rate_105_5_99999
+    # تفكيك البيانات: rate_<رمز الصفقة>_5_99999
     data = query.data.split("_")
-    deal_id = int(data[1])
+    deal_id = resolve_deal_ref(data[1])
     stars = int(data[2])
     seller_id = int(data[3])
     buyer_id = query.from_user.id
@@ -555,7 +805,7 @@ async def rate_seller_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     from db_services import add_review
     new_avg = add_review(deal_id, buyer_id, seller_id, stars)
     
-    if new_avg == "ALREADY_REVIEWED":
+    if new_avg == Result.ALREADY_REVIEWED:
         await query.edit_message_text("⚠️ لقد قمت بتقييم هذه الصفقة مسبقاً.")
     elif new_avg:
         await query.edit_message_text(f"✅ **شكراً لك!**\nأصبح تقييم البائع الآن: ⭐ {new_avg:.1f}")
@@ -564,94 +814,344 @@ async def rate_seller_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def dispute_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    # الزر يأتي بصيغة: dispute_105
-    deal_id = int(query.data.split("_")[1])
+    # الزر يأتي بصيغة: dispute_<رمز الصفقة> أو dispute_<رمز الصفقة>_2 (المرحلة 2)
+    parts = query.data.split("_")
+    public_id = parts[1]
+    deal_id = resolve_deal_ref(public_id)
+    milestone_no = int(parts[2]) if len(parts) > 2 else None
     user_id = query.from_user.id
 
-    # محاولة فتح النزاع في القاعدة
-    if open_dispute(deal_id, user_id):
+    # محاولة فتح النزاع في القاعدة (تعيد صورة الصفقة بعد التجميد)
+    deal_details = remember_deal(context, open_dispute(deal_id, user_id, milestone_no))
+    if deal_details:
+        what = f"المرحلة {milestone_no} من الصفقة" if milestone_no else "الصفقة"
+        resolve_ref = f"{public_id} seller [PIN] {milestone_no}" if milestone_no else f"{public_id} seller"
+        amount_text = deal_details["milestone"]["amount_text"] if milestone_no else deal_details["amount_text"]
         await query.edit_message_text(
-            f"⚠️ **تم رفع حالة نزاع للصفقة #{deal_id}**\n\n"
+            f"⚠️ **تم رفع حالة نزاع على {what} #{public_id}**\n\n"
             f"🔒 تم تجميد الأموال.\n"
             f"👮‍♂️ تم استدعاء المشرفين لمراجعة المحادثة.\n\n"
             f"يرجى الانتظار، سيتواصل معك الدعم قريباً."
         )
 
-        # --- إشعار الأدمن (أنت) ---
-        admin_id = os.getenv("ADMIN_ID")
-        if admin_id:
-            try:
-                # نرسل لك رابط حساباتهم لتتكلم معهم
-                deal_details = get_deal_details(deal_id)  # دالة قديمة نستفيد منها
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"🚨 **إنذار: نزاع جديد!**\n\n"
-                    f"رقم الصفقة: `{deal_id}`\n"
-                    f"المبلغ: {deal_details['amount']}$\n"
-                    f"الأطراف: البائع `{deal_details['seller_id']}` ضد المشتري `{user_id}`\n\n"
-                    f"للحل استخدم الأمر:\n"
-                    f"`/resolve {deal_id} seller` (للبائع)\n"
-                    f"`/resolve {deal_id} buyer` (للمشتري)",
-                    parse_mode="Markdown",
-                )
-            except Exception as e:
-                print(f"Failed to notify admin: {e}")
+        # --- إشعار فريق النزاعات (كل من يملك صلاحية DISPUTE_AGENT) ---
+        alert = (
+            f"🚨 **إنذار: نزاع جديد!**\n\n"
+            f"رمز الصفقة: `{public_id}`" + (f" (المرحلة {milestone_no})" if milestone_no else "") + "\n"
+            f"المبلغ: {amount_text}\n"
+            f"الأطراف: البائع `{deal_details['seller_id']}` ضد المشتري `{user_id}`\n\n"
+            f"القضية في طابور النزاعات: `/queue [PIN]` ثم `/claim {public_id} [PIN]`\n"
+            f"للحل استخدم الأمر:\n"
+            f"`/resolve {resolve_ref}` (للبائع)\n"
+            f"`/resolve {resolve_ref.replace('seller', 'buyer')}` (للمشتري)"
+        )
+        await notify_many([
+            {"chat_id": admin_id, "kind": "dispute_alert", "text": alert, "parse_mode": "Markdown"}
+            for admin_id in admins_with_role(AdminRole.DISPUTE_AGENT)
+        ])
 
     else:
         await query.answer("❌ لا يمكن فتح نزاع لهذه الصفقة حالياً.", show_alert=True)
 
 async def admin_resolve_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    # ملاحظة: admin_id لم نعد نحتاجه بشدة هنا لأننا نعتمد على الجدول وقاعدة البيانات
-    # لكن لا بأس بتركه كطبقة أمان إضافية لو أحببت
 
     try:
-        # 1. تحليل المدخلات: نتوقع ID ثم الفائز ثم الرمز السري
-        deal_id = int(context.args[0])
-        winner = context.args[1].lower()
-        pin_input = context.args[2] # الرمز السري
+        # 1. تحليل المدخلات: نتوقع رمز الصفقة ثم الفائز ثم الرمز السري (إلا مع جلسة فعالة)
+        args, pin_input = pop_pin(user_id, context.args, 2)
+        public_id = args[0]
+        winner = args[1].lower()
+        # رقم المرحلة (اختياري) لصفقات المراحل
+        milestone_no = int(args[2]) if len(args) > 2 else None
     except (IndexError, ValueError):
         # هذا الـ except يغطي أي نقص في البيانات أو خطأ في الصيغة
         await update.message.reply_text(
-            "⚠️ **أمان عالي:**\nاستخدم الأمر مع رمز PIN الخاص بك:\n`/resolve [ID] [winner] [PIN]`",
+            "⚠️ **أمان عالي:**\nاستخدم الأمر مع رمز PIN الخاص بك:\n`/resolve [رمز الصفقة] [winner] [PIN] [مرحلة اختياري]`\n"
+            "(بعد `/login [PIN]` لا حاجة للـ PIN)",
             parse_mode="Markdown"
         )
         return
 
     # 2. التحقق الأمني الكامل (صلاحية + 2FA)
-    # نستدعي دالة التحقق التي أنشأناها في db_services
-    auth_status = verify_admin_action(user_id, pin_input, required_role="dispute_agent")
-    
-    if auth_status == "NOT_ADMIN":
-        return # تجاهل بصمت (ليس أدمن أصلاً)
-    elif auth_status == "NO_PERMISSION":
-        await update.message.reply_text("⛔ ليس لديك صلاحية حل النزاعات.")
-        return
-    elif auth_status == "WRONG_PIN":
-        await update.message.reply_text("❌ **رمز الأمان (PIN) غير صحيح!**\nتم تسجيل محاولة دخول فاشلة.")
+    if not await authorize_admin(update, pin_input, AdminRole.DISPUTE_AGENT):
         return
 
     # 3. إذا وصلنا هنا، فالأدمن موثوق ومعه الرمز الصحيح
     if winner not in ["seller", "buyer"]:
-        await update.message.reply_text("❌ الفائز يجب أن يكون 'seller' أو 'buyer'.")
+        await update.effective_chat.send_message("❌ الفائز يجب أن يكون 'seller' أو 'buyer'.")
         return
 
     # 4. تنفيذ الحكم
-    result = solve_dispute_by_admin(deal_id, winner)
+    deal_id = resolve_deal_ref(public_id)
+    if deal_id is None:
+        await update.effective_chat.send_message("❌ صفقة غير موجودة.")
+        return
+    result = solve_dispute_by_admin(deal_id, winner, milestone_no, admin_id=user_id)
 
-    if isinstance(result, dict) and result["status"] == "SUCCESS":
-        await update.message.reply_text(f"✅ {result['msg']}")
+    if isinstance(result, dict) and result["status"] == Result.SUCCESS:
+        await update.effective_chat.send_message(f"✅ {result['msg']}")
 
         # إبلاغ الطرفين بالحكم النهائي
-        notification = f"⚖️ **حكم المحكمة الرقمية**\n\nبخصوص الصفقة #{deal_id}:\n{result['msg']}"
-        try:
-            await context.bot.send_message(result["buyer_id"], notification)
-            await context.bot.send_message(result["seller_id"], notification)
-        except:
-            pass
+        notification = f"⚖️ **حكم المحكمة الرقمية**\n\nبخصوص الصفقة #{result['deal']['public_id']}:\n{result['msg']}"
+        await notify_many([
+            {"chat_id": result["buyer_id"], "kind": "dispute_resolved", "text": notification},
+            {"chat_id": result["seller_id"], "kind": "dispute_resolved", "text": notification},
+        ])
+
+    elif result == Result.CLAIMED_BY_OTHER:
+        await update.effective_chat.send_message("⛔ هذه القضية استلمها وكيل آخر.")
+    elif result == Result.RATES_UNAVAILABLE:
+        await update.effective_chat.send_message("⏳ أسعار الصرف غير متاحة حالياً، أعد الحكم بعد دقيقة.")
+    else:
+        await update.effective_chat.send_message(f"❌ خطأ: {result}")
+
+
+# ==========================================
+#  جلسة الأدمن
+# ==========================================
+async def admin_login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/login [PIN]: جلسة قصيرة، أوامر الأدمن خلالها بدون PIN"""
+    pin_input = context.args[0] if context.args else None
+    if not await authorize_admin(update, pin_input):
+        return
+    await update.effective_chat.send_message(
+        f"🔓 تم فتح جلسة الأدمن لمدة {ADMIN_SESSION_TTL_SECONDS // 60} دقيقة.\n"
+        "أوامر الأدمن الآن بدون PIN. للإغلاق: /logout"
+    )
+
+
+async def admin_logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    end_admin_session(update.effective_user.id)
+    await update.message.reply_text("🔒 تم إغلاق جلسة الأدمن.")
+
+
+async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ban [user_id] [PIN] [السبب] و /unban [user_id] [PIN]"""
+    banned = update.message.text.lstrip("/").lower().startswith("ban")
+    args, pin_input = pop_pin(update.effective_user.id, context.args, 1)
+    try:
+        target_id = int(args[0])
+    except (IndexError, ValueError):
+        command = "/ban [user_id] [PIN] [السبب]" if banned else "/unban [user_id] [PIN]"
+        await update.message.reply_text(f"استخدم: `{command}`", parse_mode="Markdown")
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.DISPUTE_AGENT):
+        return
+
+    result = set_user_ban(update.effective_user.id, target_id, banned, " ".join(args[1:]))
+    if result == Result.SUCCESS:
+        text = f"🚫 تم حظر `{target_id}`." if banned else f"✅ تم فك حظر `{target_id}`."
+    elif result == Result.UNCHANGED:
+        text = "ℹ️ المستخدم محظور مسبقاً." if banned else "ℹ️ المستخدم غير محظور."
+    elif result == Result.IS_ADMIN:
+        text = "⛔ لا يمكن حظر أدمن."
+    elif result == Result.NOT_FOUND:
+        text = "❌ مستخدم غير موجود."
+    else:
+        text = "❌ حدث خطأ غير متوقع."
+    await update.effective_chat.send_message(text, parse_mode="Markdown")
+
 
+# ==========================================
+#  الإعلانات لكل المستخدمين (المدير العام)
+# ==========================================
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """رداً على الرسالة المراد إعلانها: /broadcast [PIN]"""
+    _, pin_input = pop_pin(update.effective_user.id, context.args, 0)
+    source = update.message.reply_to_message
+    if not source or not source.text:
+        await update.message.reply_text(
+            "📣 اكتب نص الإعلان في رسالة، ثم رد عليها بالأمر: `/broadcast [PIN]`",
+            parse_mode="Markdown",
+        )
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.SUPER_ADMIN):
+        return
+
+    # text_html يحفظ التنسيق كما كتبه الأدمن (عريض، روابط...)
+    broadcast = create_broadcast(update.effective_user.id, source.text_html, "HTML")
+    if not isinstance(broadcast, dict):
+        await update.effective_chat.send_message("❌ حدث خطأ غير متوقع.")
+        return
+    await update.effective_chat.send_message(
+        f"📣 تم تسجيل الإعلان #{broadcast['id']} لحوالي {broadcast['total_recipients']} مستخدم.\n"
+        f"يبدأ الإرسال خلال لحظات. المتابعة: /broadcast_status\n"
+        f"الإيقاف: `/broadcast_cancel {broadcast['id']}`",
+        parse_mode="Markdown",
+    )
+
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast_status [رقم الإعلان]: آخر إعلان إن لم يحدد"""
+    if not has_role(update.effective_user.id, AdminRole.SUPER_ADMIN):
+        return
+    try:
+        broadcast_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("استخدم: `/broadcast_status [رقم الإعلان]`", parse_mode="Markdown")
+        return
+    broadcast = get_broadcast(broadcast_id)
+    if not broadcast:
+        await update.message.reply_text("📭 لا يوجد إعلان.")
+        return
+    await update.message.reply_text(broadcast_report(broadcast))
+
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast_cancel [رقم الإعلان] [PIN]"""
+    args, pin_input = pop_pin(update.effective_user.id, context.args, 1)
+    try:
+        broadcast_id = int(args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("استخدم: `/broadcast_cancel [رقم الإعلان] [PIN]`", parse_mode="Markdown")
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.SUPER_ADMIN):
+        return
+
+    result = cancel_broadcast(broadcast_id)
+    if result == Result.SUCCESS:
+        text = f"⏹ تم إيقاف الإعلان #{broadcast_id} (الدفعة الجارية تكتمل أولاً)."
+    elif result == Result.WRONG_STATUS:
+        text = "ℹ️ الإعلان غير موجود أو انتهى مسبقاً."
     else:
-        await update.message.reply_text(f"❌ خطأ: {result}")
+        text = "❌ حدث خطأ غير متوقع."
+    await update.effective_chat.send_message(text)
+
+
+# ==========================================
+#  تحليل الأداء عند الطلب (المدير العام)
+# ==========================================
+def _profile_summary(path, top):
+    lines = [f"📁 {path}", "أكثر الدوال ظهوراً (نسبة العينات):"]
+    lines += [f"{percent}% {frame}" for frame, percent in top]
+    return "\n".join(lines)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [ثواني] [PIN]: عينات من حلقة الأحداث إلى ملف Flame Graph"""
+    args, pin_input = pop_pin(update.effective_user.id, context.args, 1)
+    try:
+        seconds = int(args[0]) if args else 30
+    except ValueError:
+        await update.message.reply_text("استخدم: `/profile [ثواني] [PIN]`", parse_mode="Markdown")
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.SUPER_ADMIN):
+        return
+
+    seconds = max(1, min(seconds, profiling.MAX_SAMPLE_SECONDS))
+    await update.effective_chat.send_message(f"🔬 بدأ التحليل لمدة {seconds} ثانية...")
+    # في الخلفية: البوت يعالج التحديثات بالتتابع، والانتظار هنا يوقف ما نريد قياسه
+    context.application.create_task(_report_sample(context.bot, update.effective_chat.id, seconds))
+
+
+async def _report_sample(bot, chat_id, seconds):
+    path, top = await profiling.sample_event_loop(seconds, name="bot")
+    if path is None:
+        text = "⏳ يوجد تحليل آخر جارٍ، حاول لاحقاً."
+    else:
+        text = _profile_summary(path, top)
+    await send_now(bot, chat_id, kind="admin", text=text)
+
+
+async def profile_handler_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile_handler [المعالج] [عدد الاستدعاءات] [PIN]: cProfile لاستدعاءات قادمة فقط"""
+    args, pin_input = pop_pin(update.effective_user.id, context.args, 2)
+    try:
+        label = args[0]
+        calls = int(args[1]) if len(args) > 1 else 1
+    except (IndexError, ValueError):
+        armed = ", ".join(f"{k} ({v})" for k, v in profiling.armed().items()) or "لا شيء"
+        await update.message.reply_text(
+            "استخدم: `/profile_handler [المعالج] [عدد الاستدعاءات] [PIN]`\n"
+            "مثال: `/profile_handler /start 5`\n"
+            f"المفعل حالياً: {armed}",
+            parse_mode="Markdown",
+        )
+        return
+    if label not in profiling.known_labels:
+        await update.message.reply_text("❌ معالج غير معروف (نفس الاسم في مقاييس handler).")
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.SUPER_ADMIN):
+        return
+
+    profiling.arm(label, calls)
+    await update.effective_chat.send_message(
+        f"🔬 سيتم تسجيل أول {profiling.armed().get(label, calls)} استدعاءات لـ {label}\n"
+        f"الملفات (.prof) في `{profiling.PROFILE_DIR}`",
+        parse_mode="Markdown",
+    )
+
+
+# ==========================================
+#  طابور النزاعات (فريق DISPUTE_AGENT)
+# ==========================================
+async def dispute_queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/queue [PIN]: القضايا المفتوحة بالأولوية وعبء كل وكيل"""
+    _, pin_input = pop_pin(update.effective_user.id, context.args, 0)
+    if not await authorize_admin(update, pin_input, AdminRole.DISPUTE_AGENT):
+        return
+
+    queue = get_dispute_queue()
+    if queue["cases"]:
+        lines = [
+            ("🔥 " if c["overdue"] else "• ")
+            + f"`{c['public_id']}`" + (f" م{c['milestone']}" if c["milestone"] else "")
+            + f" | {c['amount_text']} | منذ {c['age_hours']} ساعة"
+            for c in queue["cases"]
+        ]
+        text = (
+            f"⚖️ **طابور النزاعات** ({queue['total']} مفتوحة):\n\n" + "\n".join(lines)
+            + "\n\nاستلم الأعلى أولوية: `/claim [PIN]` أو قضية معينة: `/claim [رمز الصفقة] [PIN]`"
+        )
+    else:
+        text = "✅ لا توجد نزاعات مفتوحة."
+
+    if queue["agents"]:
+        text += "\n\n👮 **عبء الوكلاء** (مفتوحة / محلولة):\n" + "\n".join(
+            f"• {html.escape(a['name'])}: {a['open_cases']} / {a['resolved_cases']}"
+            for a in queue["agents"]
+        )
+    await update.effective_chat.send_message(text, parse_mode="Markdown")
+
+
+async def claim_dispute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/claim [رمز الصفقة اختياري] [PIN]"""
+    user_id = update.effective_user.id
+    # الـ PIN آخر كلمة في الأمر (إلا مع جلسة فعالة)
+    args, pin_input = pop_pin(user_id, context.args, len(context.args or []) - 1)
+    if len(args) > 1:
+        await update.message.reply_text(
+            "استخدم: `/claim [PIN]` أو `/claim [رمز الصفقة] [PIN]`", parse_mode="Markdown"
+        )
+        return
+    public_id = args[0] if args else None
+
+    if not await authorize_admin(update, pin_input, AdminRole.DISPUTE_AGENT):
+        return
+
+    result = claim_dispute_case(user_id, public_id)
+    if isinstance(result, dict):
+        ref = result["public_id"] + (f" seller [PIN] {result['milestone']}" if result["milestone"] else " seller")
+        await update.effective_chat.send_message(
+            f"📌 **استلمت قضية الصفقة `{result['public_id']}`**"
+            + (f" (المرحلة {result['milestone']})" if result["milestone"] else "") + "\n"
+            f"المبلغ: {result['amount_text']} | منذ {result['age_hours']} ساعة\n"
+            f"البائع `{result['seller_id']}` ضد المشتري `{result['buyer_id']}`\n\n"
+            f"الحكم: `/resolve {ref}` أو `/resolve {ref.replace('seller', 'buyer')}`",
+            parse_mode="Markdown",
+        )
+    elif result == Result.EMPTY:
+        await update.effective_chat.send_message("✅ لا توجد قضايا متاحة للاستلام.")
+    elif result == Result.NOT_FOUND:
+        await update.effective_chat.send_message("❌ صفقة غير موجودة.")
+    else:
+        await update.effective_chat.send_message("❌ حدث خطأ غير متوقع.")
+
 
 async def send_deal_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -664,31 +1164,31 @@ async def send_deal_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = update.message.photo[-1].file_id  # نأخذ أعلى دقة
 
         # استخراج رقم الصفقة من الكابشن (صعب قليلاً للمستخدم)
-        # لذلك سنبسط الأمر: المستخدم يكتب /msg 105 في الكابشن
+        # لذلك سنبسط الأمر: المستخدم يكتب /msg <رمز الصفقة> في الكابشن
         try:
             # نحاول استخراج الرقم من أول كلمة في الكابشن
             deal_id_str = msg_text.split()[1]  # لأن [0] هي /msg
-            deal_id = int(deal_id_str)
+            deal_id = resolve_deal_ref(deal_id_str)
             # نحذف الأمر والرقم من النص لنرسل الباقي
             clean_text = " ".join(msg_text.split()[2:])
         except:
             await update.message.reply_text(
-                "⚠️ لإرسال صورة: ارفق الصورة واكتب في الوصف: \n`/msg [رقم الصفقة] [تعليقك]`"
+                "⚠️ لإرسال صورة: ارفق الصورة واكتب في الوصف: \n`/msg [رمز الصفقة] [تعليقك]`"
             )
             return
     else:
         # رسالة نصية عادية
         try:
-            deal_id = int(context.args[0])
+            deal_id = resolve_deal_ref(context.args[0])
             msg_text = " ".join(context.args[1:])
             clean_text = msg_text
             file_id = None
         except (IndexError, ValueError):
-            await update.message.reply_text("⚠️ خطأ! مثال: `/msg 105 مرحباً`")
+            await update.message.reply_text("⚠️ خطأ! مثال: `/msg 7KQ2M9XD4RTA مرحباً`")
             return
 
     # التحقق من الصفقة
-    deal = get_deal_details(deal_id)
+    deal = get_deal_cached(context, deal_id) if deal_id else None
     if not deal:
         await update.message.reply_text("❌ صفقة غير موجودة.")
         return
@@ -697,76 +1197,590 @@ async def send_deal_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ لست طرفاً في هذه الصفقة.")
         return
 
-    # 1. الحفظ في قاعدة البيانات (الأدلة)
-    from db_services import save_message_to_log
-
-    save_message_to_log(deal_id, user_id, text=clean_text, file_id=file_id)
-
-    # 2. الإرسال للطرف الآخر
     receiver_id = (
         deal["buyer_id"] if user_id == deal["seller_id"] else deal["seller_id"]
     )
+    if await relay_deal_message(context, deal, user_id, receiver_id, clean_text, file_id):
+        await update.message.reply_text("✅ تم الإرسال.")
+    else:
+        await update.message.reply_text(
+            f"❌ لم يتمكن الطرف الآخر من استلام الرسالة (ربما حظر البوت)."
+        )
+
+
+async def relay_deal_message(context, deal, sender_id, receiver_id, text, file_id=None):
+    """
+    1. حفظ الرسالة كدليل (في الـ WAL والذاكرة، وتصل القاعدة لاحقاً دفعة واحدة)
+    2. الإرسال للطرف الآخر
+    deal: قاموس فيه id (للقاعدة) و public_id (للعرض)
+    """
+    message_log_buffer.add(deal["id"], sender_id, text=text, file_id=file_id)
+
+    if not receiver_id:
+        return False  # لا يوجد مشترٍ بعد
 
+    header = f"📩 **رسالة من الطرف الآخر (صفقة #{deal['public_id']}):**\n\n"
+    if file_id:
+        sent = await send_now(
+            context.bot, receiver_id, "send_photo", kind="deal_chat",
+            photo=file_id, caption=header + text, parse_mode="Markdown",
+        )
+    else:
+        sent = await send_now(
+            context.bot, receiver_id, kind="deal_chat", text=header + text, parse_mode="Markdown"
+        )
+    return sent is not None
+
+
+# ==========================================
+#  غرفة المحادثة (Chat Mode)
+# ==========================================
+async def enter_chat_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الدخول لغرفة صفقة: /chat <رمز الصفقة> أو زر 'غرفة المحادثة'"""
+    query = update.callback_query
+    user_id = update.effective_user.id
     try:
-        header = f"📩 **رسالة من الطرف الآخر (صفقة #{deal_id}):**\n\n"
-        if file_id:
-            await context.bot.send_photo(
-                chat_id=receiver_id,
-                photo=file_id,
-                caption=header + clean_text,
-                parse_mode="Markdown",
-            )
+        if query:
+            await query.answer()
+            deal_id = resolve_deal_ref(query.data.split("_")[2])  # chat_enter_<رمز الصفقة>
         else:
-            await context.bot.send_message(
-                chat_id=receiver_id, text=header + clean_text, parse_mode="Markdown"
-            )
+            deal_id = resolve_deal_ref(context.args[0])
+    except IndexError:
+        await update.message.reply_text("⚠️ خطأ! مثال: `/chat 7KQ2M9XD4RTA`", parse_mode="Markdown")
+        return
 
-        await update.message.reply_text("✅ تم الإرسال.")
-    except Exception as e:
-        await update.message.reply_text(
-            f"❌ لم يتمكن الطرف الآخر من استلام الرسالة (ربما حظر البوت)."
+    target = query.message if query else update.message
+
+    # رحلة واحدة للقاعدة عند الدخول فقط، بعدها كل الرسائل تمر بدون استعلامات
+    deal = get_deal_cached(context, deal_id) if deal_id else None
+    if not deal:
+        await target.reply_text("❌ صفقة غير موجودة.")
+        return
+    if user_id not in [deal["seller_id"], deal.get("buyer_id")]:
+        await target.reply_text("⛔ لست طرفاً في هذه الصفقة.")
+        return
+    if not deal.get("buyer_id"):
+        await target.reply_text("⏳ لا يوجد مشترٍ لهذه الصفقة بعد.")
+        return
+
+    peer_id = deal["buyer_id"] if user_id == deal["seller_id"] else deal["seller_id"]
+    context.user_data["chat_room"] = {
+        "deal": {"id": deal["id"], "public_id": deal["public_id"]},
+        "peer_id": peer_id,
+    }
+
+    await target.reply_text(
+        f"💬 **دخلت غرفة الصفقة #{deal['public_id']}**\n\n"
+        f"كل رسالة أو صورة ترسلها الآن تصل للطرف الآخر مباشرة وتحفظ كدليل.\n"
+        f"للخروج أرسل /leave",
+        parse_mode="Markdown",
+    )
+
+
+async def leave_chat_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    room = context.user_data.pop("chat_room", None)
+    if room:
+        await update.message.reply_text(f"🚪 خرجت من غرفة الصفقة #{room['deal']['public_id']}.")
+    else:
+        await update.message.reply_text("لست في أي غرفة محادثة.")
+
+
+async def chat_room_relay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أي رسالة عادية من مستخدم داخل غرفة تُمرر تلقائياً للطرف الآخر"""
+    room = context.user_data.get("chat_room")
+    if not room:
+        return  # ليس في غرفة: نتجاهل الرسالة
+
+    message = update.effective_message
+    if message.photo:
+        text = message.caption or ""
+        file_id = message.photo[-1].file_id  # نأخذ أعلى دقة
+    else:
+        text = message.text
+        file_id = None
+
+    ok = await relay_deal_message(
+        context, room["deal"], update.effective_user.id, room["peer_id"], text, file_id
+    )
+    if not ok:
+        await message.reply_text(
+            "❌ لم يتمكن الطرف الآخر من استلام الرسالة (ربما حظر البوت)."
         )
 
 
 async def admin_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    admin_id = os.getenv("ADMIN_ID")
-
-    if user_id != admin_id:
-        return  # حماية
+    # حماية: فريق النزاعات فقط (بحث في كاش الصلاحيات، بدون قاعدة البيانات)
+    if not has_role(update.effective_user.id, AdminRole.DISPUTE_AGENT):
+        return
 
     try:
-        deal_id = int(context.args[0])
+        public_id = context.args[0]
+        deal_id = resolve_deal_ref(public_id)
         from db_services import get_deal_logs
 
-        logs = get_deal_logs(deal_id)
+        logs = get_deal_logs(deal_id) if deal_id else None
 
         if not logs:
             await update.message.reply_text("📭 السجل فارغ لهذه الصفقة.")
             return
 
-        await update.message.reply_text(f"⚖️ **سجل المحكمة للصفقة #{deal_id}:**")
+        await update.message.reply_text(f"⚖️ **سجل المحكمة للصفقة #{public_id}:**")
 
+        # سجل طويل = عشرات الرسائل لنفس المحادثة: كلها تمر بحدود المعدل (رسالة/ثانية للمحادثة)
+        chat_id = update.effective_chat.id
         for log in logs:
             sender = "البائع"  # يمكنك تحسينها لجلب الاسم
             time_str = log.created_at.strftime("%Y-%m-%d %H:%M")
 
             if log.is_image:
-                await update.message.reply_photo(
-                    photo=log.file_id,
-                    caption=f"👤 {sender} [{time_str}]\n📎 {log.message_text or 'بدون تعليق'}",
+                # file_id أولاً: تليجرام لا يعيد رفع الصورة. النسخة المحلية المؤرشفة
+                # فقط إن رفض file_id (انتهت صلاحيته أو حذف الملف من تليجرام)
+                evidence = log.evidence
+                caption = f"👤 {sender} [{time_str}]\n📎 {log.message_text or 'بدون تعليق'}"
+                outcome, sent = await send_with_outcome(
+                    context.bot, chat_id, "send_photo", kind="deal_logs", photo=log.file_id, caption=caption
                 )
+                if outcome == "failed" and evidence and evidence.path and os.path.exists(evidence.path):
+                    # bytes لا ملف مفتوح: تصح إعادة الإرسال بعد RetryAfter
+                    with open(evidence.path, "rb") as f:
+                        photo = f.read()
+                    sent = await send_now(
+                        context.bot, chat_id, "send_photo", kind="deal_logs", photo=photo, caption=caption
+                    )
             else:
-                await update.message.reply_text(
-                    f"👤 {sender} [{time_str}]:\n💬 {log.message_text}"
+                sent = await send_now(
+                    context.bot, chat_id, kind="deal_logs",
+                    text=f"👤 {sender} [{time_str}]:\n💬 {log.message_text}",
                 )
+            if sent is None:
+                await update.message.reply_text("⚠️ توقف عرض السجل (حد الإرسال)، أعد المحاولة بعد قليل.")
+                return
 
     except (IndexError, ValueError):
-        await update.message.reply_text("استخدم: `/logs [رقم الصفقة]`")
+        await update.message.reply_text("استخدم: `/logs [رمز الصفقة]`")
+
+
+async def milestones_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تقسيم صفقة قبل الدفع إلى مراحل: /milestones 7KQ2M9XD4RTA 100 150 250"""
+    user_id = update.effective_user.id
+    try:
+        public_id = context.args[0]
+        amounts = [Decimal(a) for a in context.args[1:]]
+        if len(amounts) < 2:
+            raise ValueError
+    except (IndexError, ValueError, InvalidOperation):
+        await update.message.reply_text(
+            "🧩 تقسيم الصفقة إلى مراحل (قبل الدفع):\n"
+            "`/milestones [رمز الصفقة] [مبلغ 1] [مبلغ 2] ...`\n"
+            "مثال: `/milestones 7KQ2M9XD4RTA 100 150 250` (المجموع = مبلغ الصفقة)",
+            parse_mode="Markdown",
+        )
+        return
+
+    deal_id = resolve_deal_ref(public_id)
+    result = set_deal_milestones(deal_id, user_id, amounts) if deal_id else Result.NOT_FOUND
+    if isinstance(result, list):
+        lines = [f"{n}. {amount}" for n, amount in enumerate(result, start=1)]
+        await update.message.reply_text(
+            f"✅ **تم تقسيم الصفقة #{public_id} إلى {len(result)} مراحل:**\n" + "\n".join(lines),
+            parse_mode="Markdown",
+        )
+    elif result == Result.SUM_MISMATCH:
+        await update.message.reply_text("⚠️ مجموع المراحل يجب أن يساوي مبلغ الصفقة بالضبط.")
+    elif result == Result.WRONG_STATUS:
+        await update.message.reply_text("⛔ لا يمكن تعديل المراحل بعد دفع الصفقة.")
+    elif result == Result.NOT_FOUND:
+        await update.message.reply_text("❌ الصفقة غير موجودة أو لست البائع.")
+    else:
+        await update.message.reply_text("⚠️ مبالغ غير صحيحة.")
+
+
+async def wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/wallet: الرصيد بكل العملات"""
+    balances = get_user_balances(update.effective_user.id)
+    lines = [f"• {format_amount(units, asset)}" for asset, units in balances.items()]
+    await update.message.reply_text(
+        "👛 **محفظتك:**\n\n" + "\n".join(lines)
+        + "\n\nللشحن بعملة أخرى: `/deposit 2 TON`",
+        parse_mode="Markdown",
+    )
+
+
+# ==========================================
+#  الإنشاء الجماعي والقوالب (للبائعين بكثرة)
+# ==========================================
+def parse_deal_row(price_text, description, asset_text=None):
+    """
+    نفس قواعد handle_price / handle_description لصف واحد.
+    تعيد {"amount", "description", "asset"} أو None إذا كان الصف غير صالح.
+    """
+    asset = normalize_asset(asset_text)
+    description = (description or "").strip()
+    if asset is None or not description or len(description) > 500:
+        return None
+    try:
+        price = Decimal(price_text).quantize(
+            Decimal(1).scaleb(-ASSET_DECIMALS[asset]), rounding=ROUND_HALF_UP
+        )
+    except (InvalidOperation, TypeError):
+        return None
+    # NaN يمر من quantize ويرفع InvalidOperation عند المقارنة
+    if not price.is_finite() or price <= 0:
+        return None
+    return {"amount": price, "description": html.escape(description), "asset": asset}
+
+
+async def reply_created_deals(message, context, public_ids):
+    """رد واحد بكل الصفقات المنشأة مع رابط الدفع المباشر لكل منها"""
+    username = context.bot.username
+    lines = [f"#{public_id} — {deal_pay_link(username, public_id)}" for public_id in public_ids]
+    await message.reply_text(
+        f"✅ تم إنشاء {len(public_ids)} صفقة:\n\n" + "\n".join(lines),
+        disable_web_page_preview=True,
+    )
+
+
+async def reply_bulk_error(message, result):
+    if result == Result.TOO_MANY:
+        await message.reply_text(f"⚠️ الحد الأقصى {MAX_BULK_DEALS} صفقة في المرة الواحدة.")
+    elif result == Result.NOT_FOUND:
+        await message.reply_text("❌ لا يوجد قالب بهذا الاسم. اعرض قوالبك بـ /templates")
+    else:
+        await message.reply_text("❌ فشل إنشاء الصفقات في قاعدة البيانات.")
+
+
+async def template_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حفظ قالب: /template اسم السعر [العملة] الوصف"""
+    args = context.args or []
+    row = None
+    if len(args) >= 3:
+        name, price_text, rest = args[0][:64], args[1], args[2:]
+        asset_text = BASE_ASSET
+        # العملة اختيارية: الكلمة الثالثة تعتبر عملة فقط إذا طابقت عملة مدعومة حرفياً
+        if rest[0] in ASSET_DECIMALS and len(rest) > 1:
+            asset_text, rest = rest[0], rest[1:]
+        row = parse_deal_row(price_text, " ".join(rest), asset_text)
+    if row is None:
+        await update.message.reply_text(
+            "🧾 حفظ قالب صفقة:\n"
+            "`/template [الاسم] [السعر] [العملة اختياري] [الوصف]`\n"
+            "مثال: `/template netflix 12 اشتراك نتفليكس شهر`\n"
+            "ثم: `/bulk netflix 10` لإنشاء 10 صفقات منه",
+            parse_mode="Markdown",
+        )
+        return
+
+    if save_deal_template(update.effective_user.id, name, row["amount"], row["description"], row["asset"]):
+        await update.message.reply_text(f"✅ تم حفظ القالب «{html.escape(name)}».")
+    else:
+        await update.message.reply_text("❌ حدث خطأ غير متوقع.")
+
+
+async def templates_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    templates = get_deal_templates(update.effective_user.id)
+    if not templates:
+        await update.message.reply_text("📭 ليس لديك قوالب. أنشئ واحداً بـ /template")
+        return
+    lines = [f"• {t['name']}: {t['amount_text']} — {t['description']}" for t in templates]
+    await update.message.reply_text("🧾 قوالبك:\n\n" + "\n".join(lines))
+
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/bulk اسم_القالب العدد"""
+    user_id = update.effective_user.id
+    if is_spamming(user_id):
+        await update.message.reply_text("⏳ مهلاً! أنت تضغط بسرعة كبيرة. انتظر قليلاً.")
+        return
+    try:
+        name = context.args[0]
+        count = int(context.args[1])
+        if count <= 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "📦 إنشاء عدة صفقات من قالب:\n`/bulk [اسم القالب] [العدد]`\n"
+            "أو أرسل ملف CSV بأعمدة: السعر، الوصف، العملة (اختياري)",
+            parse_mode="Markdown",
+        )
+        return
+    if count > MAX_BULK_DEALS:
+        await reply_bulk_error(update.message, Result.TOO_MANY)
+        return
+
+    result = create_deals_from_template(user_id, name, count)
+    if isinstance(result, list):
+        await reply_created_deals(update.message, context, result)
+    else:
+        await reply_bulk_error(update.message, result)
+
+
+async def bulk_csv_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ملف CSV: كل سطر صفقة (السعر، الوصف، العملة اختياري)"""
+    user_id = update.effective_user.id
+    if is_spamming(user_id):
+        await update.message.reply_text("⏳ مهلاً! أنت تضغط بسرعة كبيرة. انتظر قليلاً.")
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > 64 * 1024:
+        await update.message.reply_text("⚠️ الملف كبير جداً.")
+        return
+
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        text = bytes(data).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text("⚠️ الملف يجب أن يكون بترميز UTF-8.")
+        return
+
+    rows, bad_lines = [], []
+    for line_no, cells in enumerate(csv.reader(io.StringIO(text)), start=1):
+        cells = [c.strip() for c in cells]
+        if not any(cells):
+            continue
+        row = None
+        if len(cells) >= 2:
+            row = parse_deal_row(cells[0], cells[1], cells[2] if len(cells) > 2 and cells[2] else None)
+        if row is None:
+            if line_no == 1 and not rows:
+                continue  # سطر العناوين
+            bad_lines.append(str(line_no))
+        else:
+            rows.append(row)
+
+    if bad_lines:
+        await update.message.reply_text(
+            "⚠️ أسطر غير صالحة: " + "، ".join(bad_lines[:20]) + "\nلم يتم إنشاء أي صفقة."
+        )
+        return
+    if not rows:
+        await update.message.reply_text("📭 الملف لا يحتوي صفقات.")
+        return
+
+    result = create_deals_bulk(user_id, rows)
+    if isinstance(result, list):
+        await reply_created_deals(update.message, context, result)
+    else:
+        await reply_bulk_error(update.message, result)
+
+
+# ==========================================
+#  السحب (Withdrawals)
+# ==========================================
+async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if is_spamming(user_id):
+        await update.message.reply_text("⏳ مهلاً! أنت تضغط بسرعة كبيرة. انتظر قليلاً.")
+        return
+    try:
+        # استخراج المبلغ: /withdraw 10
+        amount = Decimal(context.args[0])
+        if amount <= 0:
+            raise ValueError
+    except (IndexError, ValueError, InvalidOperation):
+        await update.message.reply_text(
+            "❌ خطأ!\nاكتب الأمر ثم المبلغ.\nمثال: `/withdraw 10`", parse_mode="Markdown"
+        )
+        return
+
+    result = request_withdrawal(user_id, amount)
+
+    if isinstance(result, dict) and result["status"] == Result.SUCCESS:
+        if result["needs_approval"]:
+            note = "⏳ المبلغ كبير، سيراجعه فريق المالية قبل التحويل."
+        else:
+            note = "⏳ سيصلك إلى محفظتك في @CryptoBot خلال دقائق."
+        await update.message.reply_text(
+            f"✅ **تم تسجيل طلب السحب #{result['withdrawal_id']}**\n"
+            f"💰 المبلغ: {result['amount']}$ (تم حجزه من رصيدك)\n{note}",
+            parse_mode="Markdown",
+        )
+    elif result == Result.INSUFFICIENT_FUNDS:
+        await update.message.reply_text("⛔ رصيدك غير كافٍ لهذا المبلغ.")
+    elif result == Result.AMOUNT_TOO_SMALL:
+        await update.message.reply_text("⚠️ أقل مبلغ للسحب هو 1$.")
+    else:
+        await update.message.reply_text("❌ حدث خطأ غير متوقع.")
+
+
+async def pending_withdrawals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """فريق المالية: /withdrawals [PIN]"""
+    _, pin_input = pop_pin(update.effective_user.id, context.args, 0)
+    if not await authorize_admin(update, pin_input, AdminRole.FINANCE_AGENT):
+        return
+
+    pending = get_pending_withdrawals()
+    review = get_pending_withdrawals(status=WithdrawalStatus.NEEDS_REVIEW)
+    if not pending and not review:
+        await update.effective_chat.send_message("📭 لا توجد طلبات سحب بانتظار الموافقة.")
+        return
+
+    if pending:
+        lines = [
+            f"#{w['id']} | المستخدم `{w['user_id']}` | {w['amount_cents'] / 100.0}$"
+            for w in pending
+        ]
+        await update.effective_chat.send_message(
+            "💸 **طلبات سحب بانتظار الموافقة:**\n\n" + "\n".join(lines)
+            + "\n\nللموافقة: `/approve_withdrawals all [PIN]` أو `/approve_withdrawals 12,15 [PIN]`",
+            parse_mode="Markdown",
+        )
+    if review:
+        # بدون Markdown: last_error نص من CryptoBot قد يكسر التنسيق
+        lines = [
+            f"#{w['id']} | المستخدم {w['user_id']} | {w['amount_cents'] / 100.0}$ | "
+            f"{w['attempts']} محاولات | {w['last_error'] or '-'}"
+            for w in review
+        ]
+        await update.effective_chat.send_message(
+            "🔎 طلبات نتيجتها مجهولة (تحقق من CryptoBot بالـ spend_id أولاً):\n\n" + "\n".join(lines)
+            + "\n\nالقرار: /review_withdrawal [رقم] paid|refund|retry [PIN]"
+        )
+
+
+async def approve_withdrawals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """موافقة جماعية: /approve_withdrawals all|12,15 [PIN]"""
+    user_id = update.effective_user.id
+    try:
+        args, pin_input = pop_pin(user_id, context.args, 1)
+        target = args[0].lower()
+        ids = None if target == "all" else [int(x) for x in target.split(",") if x]
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "استخدم: `/approve_withdrawals all [PIN]` أو `/approve_withdrawals 12,15 [PIN]`",
+            parse_mode="Markdown",
+        )
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.FINANCE_AGENT):
+        return
+
+    approved = approve_withdrawals(user_id, ids)
+    await update.effective_chat.send_message(f"✅ تمت الموافقة على {approved} طلب سحب.")
+
+
+async def review_withdrawal_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    طلب NEEDS_REVIEW بعد التحقق من CryptoBot: /review_withdrawal 12 paid|refund|retry [PIN]
+    paid = وصل فعلاً، refund = لم يصل (يعود المبلغ للمستخدم)، retry = إعادة المحاولة بنفس spend_id.
+    """
+    user_id = update.effective_user.id
+    try:
+        args, pin_input = pop_pin(user_id, context.args, 2)
+        withdrawal_id, decision = int(args[0]), args[1].lower()
+        if decision not in ("paid", "refund", "retry"):
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "استخدم: `/review_withdrawal [رقم] paid|refund|retry [PIN]`", parse_mode="Markdown"
+        )
+        return
+
+    if not await authorize_admin(update, pin_input, AdminRole.FINANCE_AGENT):
+        return
+
+    result = resolve_reviewed_withdrawal(user_id, withdrawal_id, decision)
+    if not isinstance(result, dict):
+        errors = {
+            Result.NOT_FOUND: "❌ طلب غير موجود.",
+            Result.WRONG_STATUS: "⚠️ الطلب ليس بانتظار التحقق.",
+        }
+        await update.effective_chat.send_message(errors.get(result, "❌ حدث خطأ غير متوقع."))
+        return
+
+    await update.effective_chat.send_message(f"✅ تم تسجيل القرار ({decision}) للطلب #{withdrawal_id}.")
+    if decision == "paid":
+        text = f"✅ **تم تحويل {result['amount']}$** إلى محفظتك في CryptoBot (طلب #{withdrawal_id})."
+    elif decision == "refund":
+        text = f"↩️ **تعذر تنفيذ السحب #{withdrawal_id}**\nأعدنا {result['amount']}$ إلى رصيدك."
+    else:
+        return
+    await notify(result["user_id"], text, kind="withdrawal", parse_mode="Markdown")
+
+
+async def revenue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تقرير الإيرادات: /revenue [day|week|month] [PIN]"""
+    # الـ PIN آخر كلمة في الأمر (إلا مع جلسة فعالة)
+    args, pin_input = pop_pin(update.effective_user.id, context.args, len(context.args or []) - 1)
+    period = args[0].lower() if args else "day"
+
+    if not await authorize_admin(update, pin_input, AdminRole.FINANCE_AGENT):
+        return
+
+    report = get_revenue_report(period)
+    if report is None:
+        await update.effective_chat.send_message("⚠️ الفترة يجب أن تكون day أو week أو month.")
+        return
+    if not report:
+        await update.effective_chat.send_message("📭 لا توجد إيرادات في هذه الفترة.")
+        return
+
+    lines = [
+        f"`{r['period_start']}` | {r['deals']} صفقة | حجم {r['gross']}$ | عمولة {r['fee']}$"
+        for r in report
+    ]
+    total_fee = sum(r["fee"] for r in report)
+    await update.effective_chat.send_message(
+        f"📈 **الإيرادات ({period}):**\n\n" + "\n".join(lines)
+        + f"\n\n💰 الإجمالي: {round(total_fee, 2)}$",
+        parse_mode="Markdown",
+    )
+
+
+# ==========================================
+#  لوحة أفضل البائعين (Leaderboard)
+# ==========================================
+def format_seller_line(seller):
+    return (
+        f"{seller['rank']}. {html.escape(seller['name'])} — "
+        f"⭐ {seller['avg']:.1f} ({seller['reviews']}) | ✅ {seller['completed']} صفقة"
+    )
+
+
+async def top_sellers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # القراءة من Redis فقط (الترتيب محسوب مسبقاً في الخلفية)
+    sellers = get_top_sellers(10)
+    if not sellers:
+        await update.message.reply_text("📭 لا يوجد ترتيب للبائعين بعد.")
+        return
+
+    lines = [format_seller_line(s) for s in sellers]
+    my_rank = get_seller_rank(update.effective_user.id)
+    if my_rank:
+        lines.append(f"\n📍 ترتيبك: #{my_rank}")
+
+    await update.message.reply_text(
+        "🏆 <b>أفضل البائعين الموثوقين</b>\n\n" + "\n".join(lines),
+        parse_mode="HTML",
+    )
+
+
+async def inline_sellers_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """البحث المضمن: @bot اسم_البائع"""
+    inline_query = update.inline_query
+    sellers = search_top_sellers(inline_query.query, limit=10)
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(s["seller_id"]),
+            title=f"#{s['rank']} {s['name']}",
+            description=f"⭐ {s['avg']:.1f} ({s['reviews']} تقييم) | {s['completed']} صفقة مكتملة",
+            input_message_content=InputTextMessageContent(
+                f"🏆 {format_seller_line(s)}", parse_mode="HTML"
+            ),
+        )
+        for s in sellers
+    ]
+    await inline_query.answer(results, cache_time=60, is_personal=False)
 
 
 # أمر سري لك فقط لشحن رصيدك وتجربة البوت
 async def dev_faucet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    رصيد تجريبي: يسجل فقط على testnet وللمدير العام فقط.
+    الرصيد يدخل الدفتر كإيداع حقيقي، والسحب يحوله لـ CryptoBot (بدون مراجعة تحت حد الموافقة).
+    """
+    if not IS_TESTNET or not has_role(update.effective_user.id, AdminRole.SUPER_ADMIN):
+        return
     user_id = update.effective_user.id
     # سنضيف 100 دولار وهمية لرصيدك في القاعدة
     from db_services import add_balance_to_user
@@ -777,13 +1791,61 @@ async def dev_faucet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def post_init(application):
+    """المهام الخلفية التي تعيش بعمر البوت"""
+    # مقاييس Prometheus على منفذ جانبي (BOT_METRICS_PORT)
+    start_bot_metrics_server()
+    # قائمة المحظورين قبل أول تحديث، ثم تبقى متزامنة عبر Redis pub/sub
+    await asyncio.to_thread(load_bans)
+    application.create_task(ban_sync_listener())
+    message_log_buffer.recover()
+    application.create_task(message_log_buffer.run())
+    # نسخ صور الأدلة من تليجرام للتخزين المحلي
+    application.create_task(EvidenceArchiver(application.bot).run())
+    # إعادة حساب ترتيب البائعين تدريجياً
+    application.create_task(leaderboard_refresher())
+    # تنفيذ طلبات السحب عبر CryptoBot
+    application.create_task(withdrawal_worker())
+    # لقطة أسعار الصرف في Redis (لا نستدعي API الأسعار مع كل طلب)
+    application.create_task(rates_refresher())
+    # مجاميع الإيرادات اليومية (خارج معاملة التحرير)
+    application.create_task(revenue_aggregator())
+    # صفقات المراحل التي بقيت ACTIVE بعد إغلاق كل مراحلها
+    application.create_task(milestone_sweeper())
+    # كاش صلاحيات الأدمن يتحدث فور تغيير جدول admins (LISTEN/NOTIFY)
+    application.create_task(permissions_listener())
+    # إرسال الإشعارات المسجلة في outbound_messages بحدود معدل تليجرام
+    application.create_task(outbox_worker(application.bot))
+    # الإعلانات: يستأنف من آخر نقطة حفظ بعد أي توقف
+    application.create_task(broadcast_worker(application.bot))
+
+
+async def post_shutdown(application):
+    # كتابة آخر الأدلة المتبقية في الذاكرة قبل الإغلاق
+    await message_log_buffer.close()
+
+
 if __name__ == "__main__":
     TOKEN = os.getenv("BOT_TOKEN")
     if not TOKEN:
         print("Error: BOT_TOKEN missing")
         exit()
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    # يرفض التشغيل على قاعدة لم تطبق عليها migrations هذا الإصدار (python migrations.py)
+    check_schema()
+    init_tracing("escrow-bot")
+
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        # طلبات Telegram API (ما عدا getUpdates) تظهر spans تحت المعالج الذي أرسلها
+        # (نفس حجم الـ pool الافتراضي في ApplicationBuilder)
+        .request(TracedRequest(connection_pool_size=256))
+        .context_types(ContextTypes(context=EscrowContext))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # معالج البائع
     seller_handler = ConversationHandler(
@@ -808,11 +1870,14 @@ if __name__ == "__main__":
 
     # معالج المشتري (الجديد)
     buyer_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(start_pay_deal, pattern="new_pay_btn")],
+        entry_points=[
+            CallbackQueryHandler(start_pay_deal, pattern="new_pay_btn"),
+            CommandHandler("start", pay_link_entry, filters=filters.Regex(f"^/start {PAY_PREFIX}")),
+        ],
         states={
             PAY_ASK_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, preview_deal)],
             PAY_CONFIRM: [
-                CallbackQueryHandler(execute_payment, pattern="confirm_pay"),
+                CallbackQueryHandler(execute_payment, pattern="^confirm_pay"),
                 CallbackQueryHandler(cancel_process, pattern="cancel_conv"),
             ],
         },
@@ -822,9 +1887,13 @@ if __name__ == "__main__":
         ],
     )
 
-    app.add_handler(CommandHandler("start", start_command))
+    # بوابة الحظر قبل كل المعالجات
+    app.add_handler(TypeHandler(Update, ban_gate), group=-1)
+
+    # المشتري قبل /start العام: روابط الدفع (/start pay_...) يلتقطها buyer_handler أولاً
     app.add_handler(seller_handler)
     app.add_handler(buyer_handler)
+    app.add_handler(CommandHandler("start", start_command))
 
     # معالج زر الشحن (مؤقت)
     app.add_handler(CallbackQueryHandler(simple_deposit, pattern="deposit_btn"))
@@ -842,10 +1911,47 @@ if __name__ == "__main__":
     )
     app.add_handler(CallbackQueryHandler(dispute_action_handler, pattern="^dispute_"))
     app.add_handler(CommandHandler("resolve", admin_resolve_command))
+    app.add_handler(CommandHandler("login", admin_login_command))
+    app.add_handler(CommandHandler(["ban", "unban"], ban_command))
+    app.add_handler(CommandHandler("logout", admin_logout_command))
+    app.add_handler(CommandHandler("queue", dispute_queue_command))
+    app.add_handler(CommandHandler("claim", claim_dispute_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("profile_handler", profile_handler_command))
     app.add_handler(CommandHandler("msg", send_deal_message))
     app.add_handler(CommandHandler("logs", admin_logs_command))
     app.add_handler(CallbackQueryHandler(rate_seller_handler, pattern="^rate_"))
-    app.add_handler(CommandHandler("faucet", dev_faucet))
+    if IS_TESTNET:
+        app.add_handler(CommandHandler("faucet", dev_faucet))
+    app.add_handler(CommandHandler("milestones", milestones_command))
+    app.add_handler(CommandHandler("wallet", wallet_command))
+    app.add_handler(CommandHandler("template", template_command))
+    app.add_handler(CommandHandler("templates", templates_command))
+    app.add_handler(CommandHandler("bulk", bulk_command))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), bulk_csv_handler))
+    app.add_handler(CommandHandler("withdraw", withdraw_command))
+    app.add_handler(CommandHandler("withdrawals", pending_withdrawals_command))
+    app.add_handler(CommandHandler("approve_withdrawals", approve_withdrawals_command))
+    app.add_handler(CommandHandler("review_withdrawal", review_withdrawal_command))
+    app.add_handler(CommandHandler("revenue", revenue_command))
+    app.add_handler(CommandHandler("top", top_sellers_command))
+    app.add_handler(InlineQueryHandler(inline_sellers_query))
+    app.add_handler(CommandHandler("chat", enter_chat_room))
+    app.add_handler(CallbackQueryHandler(enter_chat_room, pattern="^chat_enter_"))
+    app.add_handler(CommandHandler("leave", leave_chat_room))
+    # يجب أن يبقى آخر معالج: يلتقط الرسائل العادية فقط إذا لم تكن ضمن محادثة أخرى
+    app.add_handler(
+        MessageHandler((filters.TEXT | filters.PHOTO) & ~filters.COMMAND, chat_room_relay)
+    )
+
+    # زمن كل معالج وتتبعه (بعد تسجيلها كلها)
+    instrument_handlers(app)
+    trace_handlers(app)
+    # الأخير: يغلف كل ما سبق، فملف التحليل يشمل كلفة المقاييس والتتبع أيضاً
+    profiling.profile_handlers(app)
 
     print("🚀 البوت يعمل الآن بنظام البائع والمشتري الكامل...")
     app.run_polling()
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from db_services import claim_broadcast, get_broadcast_recipients, checkpoint_broadcast, finish_broadcast
+from models import BroadcastStatus
+from outbox import TokenBucket, limiter, send_with_outcome, notify
+
+log = logging.getLogger(__name__)
+
+# أقل من الحد العام (30/ث) عمداً: يبقى هامش لإشعارات الصفقات أثناء الإعلان
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# عدد المرسلين المتزامنين (كلهم يمرون بنفس حدود المعدل، فالعدد يغطي زمن الطلب فقط)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))
+# مستلمون لكل دفعة = المسافة بين نقطتي حفظ (التوقف المفاجئ يعيد دفعة واحدة على الأكثر)
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "1000"))
+BROADCAST_POLL_SECONDS = int(os.getenv("BROADCAST_POLL_SECONDS", "30"))
+# مستلم أصابه RetryAfter يعود للطابور حتى هذا العدد، ثم يحسب فاشلاً
+BROADCAST_RATE_LIMIT_RETRIES = 3
+
+_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+
+
+def broadcast_report(b):
+    """نص التقدم/النتيجة: المعالجون، السرعة، والوقت المتبقي التقديري (b: صورة الإعلان)"""
+    processed = b["sent_count"] + b["blocked_count"] + b["failed_count"]
+    lines = [
+        f"📣 **إعلان #{b['id']}** ({b['status']})",
+        f"✅ وصل: {b['sent_count']}  🚫 حظروا البوت: {b['blocked_count']}  ❌ فشل: {b['failed_count']}",
+        f"📊 {processed} من ~{b['total_recipients']}",
+    ]
+    if b["started_at"]:
+        end = b["finished_at"] or datetime.utcnow()
+        elapsed = max((end - b["started_at"]).total_seconds(), 1)
+        rate = processed / elapsed
+        lines.append(f"⚡ {rate:.1f} رسالة/ثانية خلال {int(elapsed)} ثانية")
+        remaining = b["total_recipients"] - processed
+        if b["status"] == BroadcastStatus.RUNNING and rate > 0 and remaining > 0:
+            lines.append(f"⏳ المتبقي تقريباً: {int(remaining / rate / 60) + 1} دقيقة")
+    return "\n".join(lines)
+
+
+async def _send_batch(bot, broadcast, user_ids):
+    """دفعة واحدة عبر مجموعة مرسلين: تعيد (عدد الواصل، من حظر البوت، عدد الفاشل)"""
+    queue = asyncio.Queue()
+    for user_id in user_ids:
+        queue.put_nowait(user_id)
+    counts = {"sent": 0, "failed": 0}
+    blocked = []
+    rate_limited = {}
+
+    async def sender():
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            wait = _bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            outcome, _ = await send_with_outcome(
+                bot, user_id, kind="broadcast",
+                text=broadcast["text"], parse_mode=broadcast["parse_mode"],
+            )
+            if outcome == "rate_limited" and rate_limited.get(user_id, 0) < BROADCAST_RATE_LIMIT_RETRIES:
+                # البوت كله موقوف: الإعلان يتوقف معه (لا يستهلك توكنات على رسائل ستفشل)
+                # والمستلم يعاد في آخر الدفعة بدل أن يحسب فاشلاً
+                rate_limited[user_id] = rate_limited.get(user_id, 0) + 1
+                _bucket.pause(limiter.global_bucket.paused_for())
+                queue.put_nowait(user_id)
+            elif outcome == "blocked":
+                blocked.append(user_id)
+            else:
+                counts["sent" if outcome == "sent" else "failed"] += 1
+
+    await asyncio.gather(*(sender() for _ in range(min(BROADCAST_WORKERS, len(user_ids)))))
+    return counts["sent"], blocked, counts["failed"]
+
+
+async def run_broadcast(bot, broadcast):
+    """
+    يرسل من نقطة الحفظ (last_user_id) حتى آخر مستخدم.
+    نقطة حفظ بعد كل دفعة، والإلغاء يظهر عندها.
+    """
+    broadcast_id = broadcast["id"]
+    last_user_id = broadcast["last_user_id"]
+    started = time.monotonic()
+    processed = 0
+    if last_user_id:
+        log.info("Broadcast resumed", extra={"broadcast_id": broadcast_id, "after_user_id": last_user_id})
+
+    while True:
+        user_ids = await asyncio.to_thread(get_broadcast_recipients, last_user_id, BROADCAST_BATCH)
+        if not user_ids:
+            break
+        sent, blocked, failed = await _send_batch(bot, broadcast, user_ids)
+        last_user_id = user_ids[-1]
+        status = await asyncio.to_thread(
+            checkpoint_broadcast, broadcast_id, last_user_id, sent, blocked, failed
+        )
+        processed += len(user_ids)
+        log.info(
+            "Broadcast checkpoint",
+            extra={
+                "broadcast_id": broadcast_id,
+                "last_user_id": last_user_id,
+                "processed": processed,
+                "rate_per_s": round(processed / max(time.monotonic() - started, 0.001), 1),
+            },
+        )
+        if status != BroadcastStatus.RUNNING:
+            # ألغي، أو تعذر الحفظ: الإعلان يبقى RUNNING ويستأنف من آخر نقطة بعد مهلة التوقف
+            log.warning("Broadcast stopped", extra={"broadcast_id": broadcast_id, "status": str(status)})
+            return None
+
+    final = await asyncio.to_thread(finish_broadcast, broadcast_id)
+    if final:
+        await notify(final["created_by"], broadcast_report(final), kind="broadcast_report")
+    return final
+
+
+async def broadcast_worker(bot):
+    """حلقة خلفية تعمل بعمر البوت: إعلان واحد في كل مرة"""
+    while True:
+        try:
+            broadcast = await asyncio.to_thread(claim_broadcast)
+            if broadcast:
+                await run_broadcast(bot, broadcast)
+                continue
+        except Exception:
+            log.exception("Broadcast worker error")
+        await asyncio.sleep(BROADCAST_POLL_SECONDS)
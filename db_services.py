@@ -1,3 +1,11 @@
+import sys
+import json
+import uuid
+import time
+import random
+import functools
+import logging
+import asyncio
 import hashlib
 import redis
 import bcrypt
@@ -8,9 +16,121 @@ from models import MessageLog
 from models import AuditLog
 from models import Review
 from models import Session, User, Deal, DealStatus, MessageLog, AuditLog, Review, Admin, AdminRole
+from models import EvidenceFile, SellerStats, SellerStatsDaily, Withdrawal, WithdrawalStatus
+from models import RevenueEntry, RevenueDaily, UserBalance, ExchangeConversion, DealMilestone
+from models import DealTemplate, DisputeCase, DisputeCaseStatus, OutboundMessage, OutboundStatus
+from models import Broadcast, BroadcastStatus
+from datetime import datetime, timedelta
+from sqlalchemy import insert, func, select, update, exists, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ledger import post_transaction, user_account, escrow_account, fee_account, external_account
+from ledger import withdrawal_account, exchange_account, transaction_exists
+from assets import BASE_ASSET, to_units, from_units, format_amount, convert_units
+from fees import calculate_fee, fee_tier_for
+from sqlalchemy.orm import joinedload
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from deal_links import new_public_id, normalize_public_id
+import permissions
+from bans import BANS_CHANNEL, apply_ban_event
+from metrics import RATE_LIMIT_DECISIONS, AUDIT_LOCK_WAIT_SECONDS, instrument_db_module
+from tracing import trace_db_module
+from app_logging import mark_call_failed
+from contextvars import ContextVar
+from results import Result
 
 redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
 
+log = logging.getLogger(__name__)
+
+SELLER_STATS_CACHE_TTL = 300 # ثواني
+RECENT_WINDOW_DAYS = 30
+
+# أقصى عدد صفقات في إنشاء جماعي واحد (الرد برسالة واحدة يجب أن يبقى تحت حد تليجرام)
+MAX_BULK_DEALS = 50
+
+# جلسة الأدمن بعد PIN صحيح: الأوامر التالية خلالها لا تحتاج PIN ولا bcrypt
+ADMIN_SESSION_TTL_SECONDS = 15 * 60
+# الحماية من التخمين: بعد هذا العدد من الأخطاء يقفل الدخول لمدة القفل
+PIN_MAX_FAILURES = 5
+PIN_LOCKOUT_SECONDS = 15 * 60
+# bcrypt بطيء عمداً (100-300ms من المعالج): يعمل في مجمع خيوط محدود بعيداً عن حلقة البوت
+PIN_CHECK_WORKERS = 2
+_pin_check_pool = ThreadPoolExecutor(max_workers=PIN_CHECK_WORKERS, thread_name_prefix="pin-check")
+
+# مهلة الرد على النزاع: القضايا الأقدم منها تتقدم الطابور مهما كان مبلغها
+DISPUTE_SLA = timedelta(hours=24)
+
+# لقطة أسعار الصرف (يحدثها exchange_rates.rates_refresher في الخلفية)
+RATES_KEY = "rates:snapshot"
+# بعد هذه المدة بدون تحديث نعتبر الأسعار قديمة ونرفض التحويل بدل استخدامها
+RATES_TTL_SECONDS = 300
+
+# فترات تقرير الإيرادات وعدد الفترات الافتراضي لكل منها
+REVENUE_PERIODS = {"day": 30, "week": 12, "month": 12}
+# عمولة سجلت قبل منتصف الليل بقليل قد تظهر (commit) بعده: نعيد حساب أمس خلال هذا الهامش
+REVENUE_IN_FLIGHT_MARGIN = timedelta(minutes=5)
+
+# السحب: أقل مبلغ، والمبلغ الذي يحتاج موافقة فريق المالية
+MIN_WITHDRAWAL_CENTS = 100
+WITHDRAWAL_APPROVAL_THRESHOLD_CENTS = 50000  # 500$
+# طلب علق في PROCESSING (توقف العامل فجأة) نعيد محاولته بعد هذه المدة بنفس spend_id
+WITHDRAWAL_STUCK_AFTER = timedelta(minutes=10)
+# إشعار علق في SENDING (توقف البوت أثناء الإرسال) يعود للطابور بعد هذه المدة
+OUTBOUND_STUCK_AFTER = timedelta(minutes=5)
+# إعلان RUNNING بدون نقطة حفظ منذ هذه المدة: عامله توقف، فتستأنفه نسخة أخرى
+BROADCAST_STALE_AFTER = timedelta(minutes=5)
+
+# تعارض SERIALIZABLE (40001) أو deadlock (40P01): المعاملة كلها تعاد من أولها
+CONFLICT_SQLSTATES = {"40001", "40P01"}
+CONFLICT_RETRIES = 4
+CONFLICT_BACKOFF_SECONDS = 0.02
+# True داخل دالة عليها retry_on_conflict ولم تستنفد محاولاتها
+_conflict_retry = ContextVar("conflict_retry", default=False)
+
+
+class _SerializationConflict(Exception):
+    pass
+
+
+class _RatesUnavailable(Exception):
+    """صفقة قديمة بعملة غير الأساسية بدون قيمة بالدولار، ولا لقطة أسعار صالحة لتقديرها"""
+
+
+def retry_on_conflict(func):
+    """
+    للدوال المالية (معاملة واحدة تنتهي بـ commit): عند التعارض تعاد الدالة كاملة
+    بجلسة جديدة بدل أن تعيد ERROR. المحاولة الأخيرة تفشل كالمعتاد (ERROR في السجل).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, CONFLICT_RETRIES + 1):
+            token = _conflict_retry.set(attempt < CONFLICT_RETRIES)
+            try:
+                return func(*args, **kwargs)
+            except _SerializationConflict:
+                log.info("Serialization conflict, retrying", extra={"attempt": attempt})
+                time.sleep(random.uniform(0, CONFLICT_BACKOFF_SECONDS * 2 ** attempt))
+            finally:
+                _conflict_retry.reset(token)
+    return wrapper
+
+
+def _retry_if_conflict():
+    """أول سطر في except دالة عليها retry_on_conflict (قبل أي commit آخر)"""
+    error = sys.exc_info()[1]
+    if _conflict_retry.get() and getattr(getattr(error, "orig", None), "pgcode", None) in CONFLICT_SQLSTATES:
+        raise _SerializationConflict() from error
+
+
+def _log_failure(message):
+    """
+    خطأ عندنا داخل عملية (يستدعى من except): سطر JSON مع الاستثناء وسياق العملية،
+    ويحسب في ميزانية أخطاء العملية حتى لو أعادت None أو False.
+    """
+    log.exception(message)
+    mark_call_failed()
+
 def check_spam_protection(user_id, limit=5, window_seconds=60):
     """
     Rate Limiting 2.0:
@@ -25,52 +145,76 @@ def check_spam_protection(user_id, limit=5, window_seconds=60):
             redis_client.expire(key, window_seconds)
             
         if current_count > limit:
+            RATE_LIMIT_DECISIONS.labels(decision="limited").inc()
             return True # سبام!
+        RATE_LIMIT_DECISIONS.labels(decision="allowed").inc()
         return False
-    except Exception as e:
-        print(f"Redis Error: {e}")
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+        RATE_LIMIT_DECISIONS.labels(decision="redis_error").inc()
         return False # في حال تعطل Redis نسمح بالمرور (Fail-open) أو العكس حسب سياستك
 
+def _sync_user(session, telegram_id, full_name, username):
+    """جلب المستخدم أو إنشاؤه داخل جلسة المستدعي (تعمل commit عند التغيير فقط)"""
+    # ابحث عن المستخدم بالـ ID
+    user = session.query(User).filter_by(id=telegram_id).first()
+    
+    if not user:
+        # إذا لم يوجد، أنشئ واحداً جديداً
+        user = User(
+            id=telegram_id,
+            full_name=full_name,
+            username=username
+        )
+        session.add(user)
+        session.commit() # احفظ التغييرات (Save)
+        log.info("New user added", extra={"full_name": full_name})
+    else:
+        # تحديث البيانات لو تغير اسمه، أو عاد بعد أن حظر البوت (يعود للإعلانات)
+        if user.full_name != full_name or user.username != username or not user.is_active:
+            user.full_name = full_name
+            user.username = username
+            user.is_active = True
+            session.commit()
+    return user
+
 def get_or_create_user(telegram_id, full_name, username):
     session = Session() # فتح اتصال
     try:
-        # ابحث عن المستخدم بالـ ID
-        user = session.query(User).filter_by(id=telegram_id).first()
-        
-        if not user:
-            # إذا لم يوجد، أنشئ واحداً جديداً
-            user = User(
-                id=telegram_id,
-                full_name=full_name,
-                username=username
-            )
-            session.add(user)
-            session.commit() # احفظ التغييرات (Save)
-            print(f"➕ New user added: {full_name}")
-        else:
-            # تحديث البيانات لو تغير اسمه
-            if user.full_name != full_name or user.username != username:
-                user.full_name = full_name
-                user.username = username
-                session.commit()
-                
-        return user
-    except Exception as e:
+        return _sync_user(session, telegram_id, full_name, username)
+    except Exception:
         session.rollback() # لو حصل خطأ، الغِ العملية
-        print(f"Error: {e}")
+        _log_failure("Error syncing user")
     finally:
         session.close() # أغلق الاتصال دائماً!
 
-def create_new_deal(seller_id, amount_dollars, description):
+def get_user_with_deal(telegram_id, full_name, username, public_id):
+    """
+    لروابط الدفع المباشرة: المستخدم والصفقة (برمزها العام) معاً بجلسة (اتصال) واحدة.
+    تعيد (المستخدم، صورة الصفقة أو None).
+    """
     session = Session()
     try:
-        # تحويل الدولار لسنتات
-        d_amount = Decimal(str(amount_dollars))
-        amount_cents = int((d_amount * 100).to_integral_value(rounding=ROUND_HALF_UP))
+        user = _sync_user(session, telegram_id, full_name, username)
+        deal = _query_deal_with_milestones(session).filter_by(public_id=public_id).first()
+        return user, (_deal_snapshot(deal, with_milestones=True) if deal else None)
+    except Exception:
+        session.rollback()
+        _log_failure("Error loading user and deal")
+        return None, None
+    finally:
+        session.close()
+
+def create_new_deal(seller_id, amount_dollars, description, asset=BASE_ASSET):
+    session = Session()
+    try:
+        # تحويل المبلغ لأصغر وحدة للعملة (الدولار لسنتات)
+        amount_cents = to_units(amount_dollars, asset)
         
         new_deal = Deal(
             seller_id=seller_id,
             amount_cents=amount_cents,
+            asset=asset,
             description=description,
             status=DealStatus.PENDING # الحالة الافتراضية
             # buyer_id ما زال فارغاً لأن المشتري لم يدخل بعد
@@ -83,16 +227,190 @@ def create_new_deal(seller_id, amount_dollars, description):
         # (refresh) تجلب الـ ID الذي تولد تلقائياً
         session.refresh(new_deal) 
         
-        print(f"📝 Deal #{new_deal.id} created by {seller_id}")
-        return new_deal.id
+        log.info("Deal created", extra={"deal_id": new_deal.public_id})
+        # للبائع نعطي الرمز العام فقط، الرقم الداخلي لا يخرج من القاعدة
+        return new_deal.public_id
         
-    except Exception as e:
-        print(f"Error creating deal: {e}")
+    except Exception:
+        _log_failure("Error creating deal")
         session.rollback()
         return None
     finally:
         session.close()
 
+def create_deals_bulk(seller_id, rows):
+    """
+    إنشاء عدة صفقات دفعة واحدة: INSERT واحد بعدة صفوف مع RETURNING.
+    rows: قائمة قواميس {"amount": مبلغ عشري، "description": نص، "asset": عملة}.
+    تعيد قائمة الرموز العامة للصفقات بنفس ترتيب الصفوف، أو "TOO_MANY" / "ERROR".
+    """
+    if not rows:
+        return []
+    if len(rows) > MAX_BULK_DEALS:
+        return Result.TOO_MANY
+    session = Session()
+    try:
+        values = [
+            {
+                "public_id": new_public_id(),
+                "seller_id": seller_id,
+                "amount_cents": to_units(r["amount"], r.get("asset") or BASE_ASSET),
+                "asset": r.get("asset") or BASE_ASSET,
+                "description": r["description"],
+                "status": DealStatus.PENDING,
+            }
+            for r in rows
+        ]
+        # Postgres لا يضمن أن يعيد RETURNING الصفوف بترتيب VALUES؛
+        # sort_by_parameter_order يطابق كل صف مع مدخله (SQLAlchemy 2.0.10+)
+        public_ids = session.scalars(
+            insert(Deal).returning(Deal.public_id, sort_by_parameter_order=True),
+            values,
+        ).all()
+        session.commit()
+        log.info("Deals created in bulk", extra={"count": len(public_ids)})
+        return public_ids
+    except Exception:
+        session.rollback()
+        _log_failure("Error creating deals in bulk")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def save_deal_template(seller_id, name, amount, description, asset=BASE_ASSET):
+    """حفظ قالب (أو تحديثه إذا كان الاسم موجوداً)"""
+    session = Session()
+    try:
+        stmt = pg_insert(DealTemplate).values(
+            seller_id=seller_id, name=name, amount_cents=to_units(amount, asset),
+            asset=asset, description=description,
+        )
+        session.execute(stmt.on_conflict_do_update(
+            constraint="uq_deal_templates_seller_name",
+            set_={
+                "amount_cents": stmt.excluded.amount_cents,
+                "asset": stmt.excluded.asset,
+                "description": stmt.excluded.description,
+                "updated_at": datetime.utcnow(),
+            },
+        ))
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        _log_failure("Error saving template")
+        return False
+    finally:
+        session.close()
+
+def get_deal_templates(seller_id):
+    session = Session()
+    try:
+        templates = (
+            session.query(DealTemplate)
+            .filter_by(seller_id=seller_id)
+            .order_by(DealTemplate.name)
+            .all()
+        )
+        return [
+            {
+                "name": t.name,
+                "amount_text": format_amount(t.amount_cents, t.asset or BASE_ASSET),
+                "description": t.description,
+            }
+            for t in templates
+        ]
+    finally:
+        session.close()
+
+def create_deals_from_template(seller_id, name, count):
+    """N صفقات متطابقة من قالب محفوظ. تعيد قائمة الرموز العامة أو NOT_FOUND / TOO_MANY / ERROR"""
+    # قبل بناء القائمة: العدد يأتي من المستخدم مباشرة
+    if count > MAX_BULK_DEALS:
+        return Result.TOO_MANY
+    session = Session()
+    try:
+        template = session.query(DealTemplate).filter_by(seller_id=seller_id, name=name).first()
+        if not template:
+            return Result.NOT_FOUND
+        asset = template.asset or BASE_ASSET
+        row = {
+            "amount": from_units(template.amount_cents, asset),
+            "description": template.description,
+            "asset": asset,
+        }
+    finally:
+        session.close()
+    return create_deals_bulk(seller_id, [row] * count)
+
+def _milestone_rows(milestones, asset):
+    return [
+        {
+            "id": m.id,
+            "no": m.position,
+            "title": m.title,
+            "amount_text": format_amount(m.amount_cents, asset or BASE_ASSET),
+            "status": m.status,
+        }
+        for m in milestones
+    ]
+
+def _deal_snapshot(deal, with_milestones=False):
+    """
+    صورة كاملة للصفقة (قاموس) تعيدها كل الدوال التي تغير الصفقة،
+    حتى لا يحتاج bot.py لجلبها مرة ثانية بعد العملية.
+    يجب أن يكون deal.seller محملاً مسبقاً (joinedload) لتجنب استعلام إضافي،
+    وكذلك deal.milestones مع with_milestones (_query_deal_with_milestones).
+    """
+    snapshot = {
+        "id": deal.id,
+        "public_id": deal.public_id,  # الرمز الذي يظهر للمستخدمين
+        "seller_id": deal.seller_id,
+        "buyer_id": deal.buyer_id,
+        "seller_name": deal.seller.full_name if deal.seller else "مستخدم غير معروف",
+        "amount": float(from_units(deal.amount_cents, deal.asset or BASE_ASSET)),
+        "asset": deal.asset or BASE_ASSET,
+        "amount_text": format_amount(deal.amount_cents, deal.asset or BASE_ASSET), # للعرض: 50$ أو 0.5 TON
+        "description": deal.description,
+        "status": deal.status
+    }
+    if with_milestones:
+        snapshot["milestones"] = _milestone_rows(deal.milestones, deal.asset)
+    return snapshot
+
+@lru_cache(maxsize=10000)
+def _deal_id_for_public_id(public_id):
+    session = Session()
+    try:
+        deal_id = session.query(Deal.id).filter_by(public_id=public_id).scalar()
+    finally:
+        session.close()
+    if deal_id is None:
+        # استثناء بدل None: lru_cache لا يخزن الاستثناءات، فالرموز الخاطئة لا تملأ الكاش
+        raise LookupError(public_id)
+    return deal_id
+
+def resolve_deal_ref(text):
+    """
+    الرقم الداخلي للصفقة من رمزها العام (كما كتبه المستخدم أو من بيانات زر)، أو None.
+    الرمز لا يتغير أبداً، فالنتيجة تخزن في ذاكرة العملية: بحث واحد بالفهرس لكل صفقة.
+    """
+    public_id = normalize_public_id(text)
+    if public_id is None:
+        return None
+    try:
+        return _deal_id_for_public_id(public_id)
+    except LookupError:
+        return None
+
+def _query_deal(session):
+    """استعلام الصفقة مع اسم البائع في نفس الـ JOIN (رحلة واحدة لقاعدة البيانات)"""
+    return session.query(Deal).options(joinedload(Deal.seller, innerjoin=True))
+
+def _query_deal_with_milestones(session):
+    """مثل _query_deal مع مراحل الصفقة في نفس الاستعلام (LEFT JOIN) لشاشات العرض"""
+    return _query_deal(session).options(joinedload(Deal.milestones))
+
 def get_deal_by_id(deal_id):
     session = Session()
     try:
@@ -104,89 +422,212 @@ def get_deal_by_id(deal_id):
             # (في المشاريع الكبيرة نستخدم طرقاً أفضل، لكن هذا يكفي الآن)
             session.expunge(deal) 
             return deal
-    except Exception as e:
-        print(f"Error fetching deal: {e}")
+    except Exception:
+        _log_failure("Error fetching deal")
     finally:
         session.close()
     return None
 
-def process_deal_payment(deal_id, buyer_id):
+@retry_on_conflict
+def process_deal_payment(deal_id, buyer_id, pay_asset=None):
+    """
+    pay_asset: العملة التي يدفع بها المشتري من رصيده (الافتراضي عملة الصفقة).
+    إذا اختلفت عن عملة الصفقة نحول بسعر لقطة الأسعار الحالية ونسجل السعر.
+    """
     session = Session()
     try:
-        # 1. جلب الصفقة
-        deal = session.query(Deal).filter_by(id=deal_id).first()
+        # 1. جلب الصفقة (مع اسم البائع لنعيد صورة كاملة بعد الدفع)
+        deal = _query_deal(session).filter_by(id=deal_id).first()
         if not deal:
-            return "DEAL_NOT_FOUND"
+            return Result.DEAL_NOT_FOUND
             
         # هل الصفقة ما زالت معلقة؟ (لا ندفع لصفقة مدفوعة أصلاً!)
         if deal.status != DealStatus.PENDING:
-            return "DEAL_NOT_PENDING"
+            return Result.DEAL_NOT_PENDING
             
         # 2. جلب المشتري
         buyer = session.query(User).filter_by(id=buyer_id).with_for_update().first()
         if not buyer:
-            print(f"❌ Error: Buyer {buyer_id} not found in DB")
-            return "BUYER_NOT_FOUND"
+            log.warning("Buyer not found in DB")
+            return Result.BUYER_NOT_FOUND
+
+        deal_asset = deal.asset or BASE_ASSET
+        pay_asset = pay_asset or deal_asset
+        snapshot = None
+        if pay_asset != deal_asset or deal_asset != BASE_ASSET:
+            # نحتاج الأسعار للتحويل أو لتقدير قيمة الصفقة بالدولار
+            snapshot = get_rate_snapshot()
+            if snapshot is None:
+                return Result.RATES_UNAVAILABLE
+
+        paid_units, rate = convert_units(deal.amount_cents, deal_asset, pay_asset, snapshot and snapshot["rates"])
         
-        # 3. التحقق من الرصيد
-        if buyer.balance_cents < deal.amount_cents:
-            return "INSUFFICIENT_FUNDS" # ليس لديه مال كافٍ
+        # 3. التحقق من الرصيد (بالعملة التي سيدفع بها)
+        if _locked_balance(session, buyer, pay_asset) < paid_units:
+            return Result.INSUFFICIENT_FUNDS # ليس لديه مال كافٍ
             
         # --- اللحظة الحاسمة (Atomic Transaction) ---
         
         # أ. نربط المشتري بالصفقة
         deal.buyer_id = buyer_id
+        deal.paid_asset = pay_asset
+        deal.paid_units = paid_units
+        deal.usd_value_cents = convert_units(
+            deal.amount_cents, deal_asset, BASE_ASSET, snapshot and snapshot["rates"]
+        )[0]
         
-        # ب. نخصم المال من المشتري
-        buyer.balance_cents -= deal.amount_cents
+        # ب. ننقل المال من محفظة المشتري إلى حساب الضمان الخاص بالصفقة (قيد مزدوج)
+        # (مع التحويل: يمر عبر حسابي الصرف للعملتين)
+        # صفقة المراحل: حساب ضمان لكل مرحلة، فتحرير مرحلة لا يقفل حسابات الأخرى
+        milestones = session.query(DealMilestone).filter_by(deal_id=deal.id).all()
+        if milestones:
+            targets = [
+                (escrow_account(deal.id, asset=deal_asset, milestone_id=m.id), m.amount_cents)
+                for m in milestones
+            ]
+            for m in milestones:
+                m.status = DealStatus.ACTIVE
+        else:
+            targets = [(escrow_account(deal.id, asset=deal_asset), deal.amount_cents)]
+        post_transaction(session, "ESCROW_HOLD", _conversion_legs(
+            user_account(buyer_id, pay_asset), paid_units, targets,
+        ), deal_id=deal.id)
+        if pay_asset != deal_asset:
+            _record_conversion(session, buyer_id, deal.id, "PAYMENT",
+                               pay_asset, paid_units, deal_asset, deal.amount_cents,
+                               1 / rate, snapshot)
         
         # ج. نغير حالة الصفقة لنشطة
         deal.status = DealStatus.ACTIVE
         
         # د. الحفظ النهائي
         session.commit()
-        print(f"🔒 Funds locked for Deal #{deal_id}. Buyer: {buyer_id}")
-        return "SUCCESS"
+        log.info("Funds locked")
+        return {"status": Result.SUCCESS, "deal": _deal_snapshot(deal)}
         
-    except Exception as e:
+    except Exception:
+        _retry_if_conflict()
         session.rollback() # تراجع فوراً عند أي خطأ
-        print(f"Payment Error: {e}")
-        return "ERROR"
+        _log_failure("Payment Error")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def get_rate_snapshot():
+    """
+    آخر لقطة أسعار: {"rates": {العملة: السعر بالدولار}, "fetched_at": datetime}
+    أو None إذا لم تُحدث منذ RATES_TTL_SECONDS (انتهت صلاحيتها في Redis).
+    """
+    try:
+        raw = redis_client.get(RATES_KEY)
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+        return None
+    if not raw:
+        return None
+    data = json.loads(raw)
+    return {"rates": data["rates"], "fetched_at": datetime.fromisoformat(data["fetched_at"])}
+
+def save_rate_snapshot(rates):
+    """rates: {العملة: السعر بالدولار كنص}. تنتهي صلاحيتها تلقائياً بعد RATES_TTL_SECONDS"""
+    payload = {"rates": rates, "fetched_at": datetime.utcnow().isoformat()}
+    redis_client.setex(RATES_KEY, RATES_TTL_SECONDS, json.dumps(payload))
+
+def _locked_balance(session, user, asset):
+    """رصيد المستخدم بعملة معينة مع قفل الصف (داخل معاملة المستدعي)"""
+    if asset == BASE_ASSET:
+        return user.balance_cents
+    return (
+        session.query(UserBalance.amount_units)
+        .filter_by(user_id=user.id, asset=asset)
+        .with_for_update()
+        .scalar()
+    ) or 0
+
+def _conversion_legs(source, source_units, targets):
+    """
+    أرجل قيد ينقل مالاً من حساب إلى حساب أو أكثر (targets: [(مواصفات، مبلغ)] بنفس العملة).
+    إذا اختلفت العملتان يمر عبر حسابي الصرف حتى يبقى القيد متوازناً داخل كل عملة.
+    """
+    legs = [(source, -source_units)]
+    target_asset = targets[0][0]["asset"]
+    if source["asset"] != target_asset:
+        legs.append((exchange_account(source["asset"]), source_units))
+        legs.append((exchange_account(target_asset), -sum(units for _, units in targets)))
+    return legs + targets
+
+def _record_conversion(session, user_id, deal_id, purpose, from_asset, from_units_, to_asset, to_units_, rate, snapshot):
+    session.add(ExchangeConversion(
+        user_id=user_id,
+        deal_id=deal_id,
+        purpose=purpose,
+        from_asset=from_asset,
+        from_units=from_units_,
+        to_asset=to_asset,
+        to_units=to_units_,
+        rate=str(rate),
+        rates_fetched_at=snapshot["fetched_at"] if snapshot else None,
+    ))
+
+def get_user_balances(user_id):
+    """كل أرصدة المستخدم: {العملة: المبلغ بأصغر وحدة} (الأساسية دائماً موجودة)"""
+    session = Session()
+    try:
+        balances = {BASE_ASSET: session.query(User.balance_cents).filter_by(id=user_id).scalar() or 0}
+        rows = session.query(UserBalance.asset, UserBalance.amount_units).filter(
+            UserBalance.user_id == user_id, UserBalance.amount_units != 0
+        )
+        balances.update({asset: units for asset, units in rows})
+        return balances
     finally:
         session.close()
 
-def add_balance_to_user(telegram_id, amount_usd):
+@retry_on_conflict
+def add_balance_to_user(telegram_id, amount_usd, asset=BASE_ASSET, invoice_id=None):
     """
-    تقوم بإضافة مبلغ بالدولار إلى رصيد المستخدم في قاعدة البيانات.
-    يتم تحويل المبلغ لسنتات لضمان الدقة المالية.
+    تقوم بإضافة مبلغ إلى رصيد المستخدم في قاعدة البيانات (بالدولار افتراضياً أو بعملة أخرى).
+    يتم تحويل المبلغ لأصغر وحدة (سنت للدولار) لضمان الدقة المالية.
+    invoice_id: فاتورة CryptoBot تشحن مرة واحدة فقط (الـ webhook يعاد، وزر "لقد دفعت" أيضاً).
+    تعيد True، أو Result.UNCHANGED إذا شحنت هذه الفاتورة من قبل، أو False عند الفشل.
     """
     session = Session()
     try:
+        txn_id = None
+        if invoice_id is not None:
+            txn_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"cryptobot:invoice:{invoice_id}"))
+            if transaction_exists(session, txn_id):
+                return Result.UNCHANGED
+
         # 1. البحث عن المستخدم
         user = session.query(User).filter_by(id=telegram_id).with_for_update().first()
         
         if not user:
-            print(f"❌ User {telegram_id} not found in database!")
+            log.warning("User not found in database")
             return False
 
-        # 2. تحويل المبلغ لسنتات (الضرب في 100)
+        # 2. تحويل المبلغ لسنتات (الضرب في 100) أو أصغر وحدة للعملة
         # نستخدم int لضمان عدم وجود كسور عشرية في قاعدة البيانات
-        d_amount = Decimal(str(amount_usd))
-        cents_to_add = int((d_amount * 100).to_integral_value(rounding=ROUND_HALF_UP))
+        cents_to_add = to_units(amount_usd, asset)
 
-        # 3. تحديث الرصيد
-        user.balance_cents += cents_to_add
+        # 3. تحديث الرصيد: المال يدخل من الخارج (CryptoBot) لمحفظة المستخدم
+        post_transaction(session, "DEPOSIT", [
+            (external_account(asset), -cents_to_add),
+            (user_account(telegram_id, asset), cents_to_add),
+        ], txn_id=txn_id)
         
         # 4. حفظ التغييرات قطعياً
         session.commit()
-        log_audit_event(telegram_id, "DEPOSIT", cents_to_add, "شحن رصيد خارجي")
-        print(f"💰 Balance Updated: User {telegram_id} received {amount_usd}$.")
+        # التسوية تجمع DEPOSIT بالعملة الأساسية فقط، فالعملات الأخرى بإجراء منفصل
+        action = "DEPOSIT" if asset == BASE_ASSET else f"DEPOSIT_{asset}"
+        log_audit_event(telegram_id, action, cents_to_add, "شحن رصيد خارجي")
+        log.info("Balance updated", extra={"amount": format_amount(cents_to_add, asset)})
         return True
 
-    except Exception as e:
+    except Exception:
+        _retry_if_conflict()
         # في حال حدوث أي خطأ (انقطاع كهرباء، خطأ في الهاردسك) تراجع فوراً
         session.rollback()
-        print(f"❌ Database Error in add_balance: {e}")
+        _log_failure("Database Error in add_balance")
         return False
     finally:
         # إغلاق الجلسة لتحرير موارد السيرفر
@@ -199,291 +640,977 @@ def get_deal_details(deal_id):
     """
     session = Session()
     try:
-        deal = session.query(Deal).filter_by(id=deal_id).first()
+        # نحتاج اسم البائع لنعرضه للمشتري (زيادة في الثقة)
+        # نجلبه بـ JOIN في نفس الاستعلام بدلاً من تحميل deal.seller لاحقاً باستعلام ثانٍ،
+        # ومعه المراحل: شاشة المعاينة والإدارة تعرضها دون رحلة ثانية
+        deal = _query_deal_with_milestones(session).filter_by(id=deal_id).first()
         
         if not deal:
             return None
             
-        # نحتاج اسم البائع لنعرضه للمشتري (زيادة في الثقة)
-        # بما أننا نستخدم expire_on_commit=False في models.py، يمكننا الوصول للعلاقات
-        seller_name = deal.seller.full_name if deal.seller else "مستخدم غير معروف"
-        
-        return {
-            "id": deal.id,
-            "seller_id": deal.seller_id,
-            "buyer_id": deal.buyer_id,
-            "seller_name": seller_name,
-            "amount": deal.amount_cents / 100.0, # تحويل لدولار
-            "description": deal.description,
-            "status": deal.status
-        }
-    except Exception as e:
-        print(f"❌ Error fetching deal details: {e}")
+        return _deal_snapshot(deal, with_milestones=True)
+    except Exception:
+        _log_failure("Error fetching deal details")
         return None
     finally:
         session.close()
 
-def mark_deal_delivered(deal_id, seller_id):
+def mark_deal_delivered(deal_id, seller_id, milestone_no=None):
     """
-    يقوم البائع بتحويل حالة الصفقة إلى 'تم التسليم'.
+    يقوم البائع بتحويل حالة الصفقة (أو مرحلة منها) إلى 'تم التسليم'.
     """
     session = Session()
     try:
         # 1. جلب الصفقة والتأكد أن هذا المستخدم هو البائع فعلاً
-        deal = session.query(Deal).filter_by(id=deal_id, seller_id=seller_id).first()
+        deal = _query_deal(session).filter_by(id=deal_id, seller_id=seller_id).first()
         
         if not deal:
-            return "NOT_FOUND" # صفقة غير موجودة أو ليس هو البائع
+            return Result.NOT_FOUND # صفقة غير موجودة أو ليس هو البائع
+
+        if milestone_no is not None:
+            # صفقة بمراحل: نقفل صف المرحلة فقط، لا الصفقة
+            milestone = _lock_milestone(session, deal.id, milestone_no)
+            if not milestone:
+                return Result.NOT_FOUND
+            if deal.status != DealStatus.ACTIVE or milestone.status != DealStatus.ACTIVE:
+                return Result.WRONG_STATUS
+            milestone.status = DealStatus.DELIVERED
+            session.commit()
+            return {
+                "status": Result.SUCCESS, "buyer_id": deal.buyer_id,
+                "deal": _deal_snapshot(deal), "milestone": _milestone_snapshot(milestone, deal),
+            }
+        if _has_milestones(session, deal.id):
+            return Result.MILESTONE_REQUIRED
             
         # 2. هل الصفقة في حالة نشطة؟ (لا يمكن تسليم صفقة ملغاة أو منتهية)
         if deal.status != DealStatus.ACTIVE:
-            return "WRONG_STATUS"
+            return Result.WRONG_STATUS
             
         # 3. تغيير الحالة
         deal.status = DealStatus.DELIVERED
         session.commit()
         
         # نعيد ID المشتري لنرسل له تنبيهاً
-        return {"status": "SUCCESS", "buyer_id": deal.buyer_id}
+        return {"status": Result.SUCCESS, "buyer_id": deal.buyer_id, "deal": _deal_snapshot(deal)}
         
-    except Exception as e:
+    except Exception:
         session.rollback()
-        print(f"Error marking delivered: {e}")
-        return "ERROR"
+        _log_failure("Error marking delivered")
+        return Result.ERROR
     finally:
         session.close()
 
-def release_deal_funds(deal_id, buyer_id):
+@retry_on_conflict
+def release_deal_funds(deal_id, buyer_id, milestone_no=None):
     """
     يقوم المشتري بتأكيد الاستلام، فيتم تحويل المال للبائع بعد خصم العمولة.
+    milestone_no: في صفقات المراحل نحرر مرحلة واحدة فقط.
     """
     session = Session()
     try:
         # 1. جلب الصفقة
-        deal = session.query(Deal).filter_by(id=deal_id, buyer_id=buyer_id).first()
+        deal = _query_deal(session).filter_by(id=deal_id, buyer_id=buyer_id).first()
         
         if not deal:
-            return "NOT_FOUND"
+            return Result.NOT_FOUND
+
+        milestone = None
+        if milestone_no is not None:
+            milestone = _lock_milestone(session, deal.id, milestone_no)
+            if not milestone:
+                return Result.NOT_FOUND
+            if deal.status != DealStatus.ACTIVE or milestone.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
+                return Result.WRONG_STATUS
+        elif _has_milestones(session, deal.id):
+            return Result.MILESTONE_REQUIRED
             
         # هل الحالة تسمح؟ (يجب أن تكون ACTIVE أو DELIVERED)
-        if deal.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
-            return "WRONG_STATUS"
+        elif deal.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
+            return Result.WRONG_STATUS
             
-        # 2. جلب البائع (لنعطيه المال)
-        seller = session.query(User).filter_by(id=deal.seller_id).with_for_update().first()
-        
         # --- الحسابات المالية (The Money Logic) ---
-        total_amount = deal.amount_cents
-        
-        # حساب العمولة (مثلاً 5%)
-        # معادلة: المبلغ * 0.05
-        FEE_RATE = Decimal('0.05') 
-        
-        # المبلغ الصافي للبائع
-        calculated_fee = (Decimal(total_amount) * FEE_RATE).to_integral_value(rounding=ROUND_HALF_UP)
-        fee_cents = int(calculated_fee)
-        net_amount = total_amount - fee_cents
-        
-        # 3. تنفيذ التحويل (Atomic Transaction)
-        seller.balance_cents += net_amount  # زيادة رصيد البائع
-        deal.status = DealStatus.COMPLETED  # إغلاق الصفقة
-        
-        # (اختياري) يمكنك إضافة جدول للأرباح لتسجيل الـ fee_cents لك
+        # تنفيذ التحويل (Atomic Transaction): الصافي للبائع والعمولة لحساب المنصة
+        net_amount, fee_cents = _pay_out_to_seller(session, deal, source="release", milestone=milestone)
         
         session.commit()
-        
-        return {
-            "status": "SUCCESS",
-            "seller_id": seller.id,
-            "net_amount": net_amount / 100.0, # للطباعة
-            "fee": fee_cents / 100.0          # للطباعة
+        _invalidate_seller_stats(deal.seller_id)
+
+        result = {
+            "status": Result.SUCCESS,
+            "seller_id": deal.seller_id,
+            "net_amount": format_amount(net_amount, deal.asset or BASE_ASSET), # للطباعة (10.5$ أو 0.2 TON)
+            "fee": format_amount(fee_cents, deal.asset or BASE_ASSET),         # للطباعة
+            "deal": _deal_snapshot(deal)
         }
-        
-    except Exception as e:
+        if milestone:
+            result["milestone"] = _milestone_snapshot(milestone, deal)
+            result["deal_status"] = _close_deal_if_finished(deal.id)
+        return result
+
+    except _RatesUnavailable:
+        session.rollback()
+        return Result.RATES_UNAVAILABLE
+    except Exception:
+        _retry_if_conflict()
         session.rollback()
-        print(f"Error releasing funds: {e}")
-        return "ERROR"
+        _log_failure("Error releasing funds")
+        return Result.ERROR
     finally:
         session.close()
 
-def get_user_active_deals(user_id):
-    """تجلب الصفقات التي يكون فيها المستخدم بائعاً أو مشترياً وحالتها نشطة"""
+def _pay_out_to_seller(session, deal, source, milestone=None):
+    """
+    إتمام صفقة (أو مرحلة منها) لصالح البائع (داخل معاملة المستدعي):
+    العمولة من جدول العمولات، قيد الدفتر، سطر في دفتر الإيرادات، وعداد الصفقات المكتملة.
+    تعيد (الصافي للبائع، العمولة) بأصغر وحدة لعملة الصفقة.
+    """
+    completed_deals = (
+        session.query(SellerStats.completed_deals).filter_by(seller_id=deal.seller_id).scalar()
+    )
+    tier = fee_tier_for(completed_deals)
+    asset = deal.asset or BASE_ASSET
+    amount = milestone.amount_cents if milestone else deal.amount_cents
+    # جدول العمولات بالدولار: نستخدم قيمة الصفقة وقت الدفع (حصة المرحلة منها)
+    usd_value = _deal_usd_value(deal, amount)
+    fee_usd, rate_bps = calculate_fee(usd_value, tier)
+    if asset == BASE_ASSET:
+        fee_units = fee_usd
+    elif usd_value <= 0:
+        # مرحلة صغيرة أو صفقة زهيدة قيمتها أقل من سنت: لا عمولة (بدل القسمة على صفر
+        # التي تعيد ERROR في كل محاولة وتترك المال محجوزاً)
+        fee_units = 0
+    else:
+        # نفس نسبة العمولة من مبلغ الصفقة بعملتها (بدون الحاجة لسعر جديد)
+        fee_units = int((Decimal(amount) * fee_usd / usd_value).to_integral_value(rounding=ROUND_HALF_UP))
+    net_cents = amount - fee_units
+
+    # حساب الضمان (أو ضمان المرحلة) يُفرغ
+    # (opening: لو دُفعت الصفقة قبل تفعيل الدفتر فالمال محجوز بدون حساب)
+    escrow = escrow_account(deal.id, opening_cents=amount, asset=asset,
+                            milestone_id=milestone.id if milestone else None)
+    post_transaction(session, "RELEASE", [
+        (escrow, -amount),
+        (user_account(deal.seller_id, asset), net_cents),
+        (fee_account(asset), fee_units),
+    ], deal_id=deal.id, memo=None if source == "release" else source)
+
+    if milestone:
+        milestone.status = DealStatus.COMPLETED
+        # عداد الصفقات يزيد مرة واحدة عند إغلاق الصفقة كلها (_close_deal_if_finished)
+        _record_completed_deal(session, deal.seller_id, usd_value, deals=0)
+    else:
+        deal.status = DealStatus.COMPLETED  # إغلاق الصفقة
+        _record_completed_deal(session, deal.seller_id, usd_value)
+
+    _record_revenue(session, deal, milestone, tier, rate_bps, usd_value, fee_usd, fee_units, source)
+    return net_cents, fee_units
+
+def _deal_usd_value(deal, amount):
+    """
+    قيمة amount (جزء من مبلغ الصفقة بعملتها) بالدولار: حصته من usd_value_cents وقت الدفع.
+    صفقة بدون usd_value_cents (قبل تسجيله): مبلغها هو قيمتها بالدولار فقط في العملة الأساسية،
+    وغيرها بلقطة الأسعار الحالية أو _RatesUnavailable (لا نعامل 1 TON كأنه سنت).
+    """
+    if deal.usd_value_cents is not None:
+        return deal.usd_value_cents * amount // deal.amount_cents
+    asset = deal.asset or BASE_ASSET
+    if asset == BASE_ASSET:
+        return amount
+    snapshot = get_rate_snapshot()
+    if snapshot is None:
+        raise _RatesUnavailable()
+    return convert_units(amount, asset, BASE_ASSET, snapshot["rates"])[0]
+
+def _refund_to_buyer(session, deal, memo, milestone=None):
+    """
+    إعادة مبلغ الصفقة (أو المرحلة) للمشتري داخل معاملة المستدعي،
+    بنفس العملة التي دفع بها (عكس التحويل بسعره الأصلي).
+    """
+    asset = deal.asset or BASE_ASSET
+    amount = milestone.amount_cents if milestone else deal.amount_cents
+    paid_asset = deal.paid_asset or asset
+    paid_total = deal.paid_units if deal.paid_units is not None else deal.amount_cents
+    if paid_asset == asset:
+        paid_units = amount
+    else:
+        # حصة المرحلة مما دفعه فعلاً
+        paid_units = int((Decimal(paid_total) * amount / deal.amount_cents).to_integral_value(rounding=ROUND_HALF_UP))
+
+    escrow = escrow_account(deal.id, opening_cents=amount, asset=asset,
+                            milestone_id=milestone.id if milestone else None)
+    post_transaction(session, "REFUND", _conversion_legs(
+        escrow, amount, [(user_account(deal.buyer_id, paid_asset), paid_units)], # استرداد كامل
+    ), deal_id=deal.id, memo=memo)
+    if paid_asset != asset:
+        _record_conversion(session, deal.buyer_id, deal.id, "REFUND",
+                           asset, amount, paid_asset, paid_units,
+                           from_units(paid_units, paid_asset) / from_units(amount, asset), None)
+
+    if milestone:
+        milestone.status = DealStatus.CANCELED
+    else:
+        deal.status = DealStatus.CANCELED # إلغاء الصفقة
+
+# --- طابور النزاعات ---
+def _open_dispute_case(session, deal, milestone, user_id):
+    """قضية جديدة في الطابور (داخل معاملة فتح النزاع)"""
+    amount = milestone.amount_cents if milestone else deal.amount_cents
+    # نفس حساب قيمة الدولار في _pay_out_to_seller (حصة المرحلة من قيمة الصفقة وقت الدفع)
+    usd_value = _deal_usd_value(deal, amount)
+    session.add(DisputeCase(
+        deal_id=deal.id,
+        milestone_id=milestone.id if milestone else None,
+        opened_by=user_id,
+        amount_usd_cents=usd_value,
+        status=DisputeCaseStatus.OPEN,
+    ))
+
+def _lock_dispute_case(session, deal_id, milestone):
+    return (
+        session.query(DisputeCase)
+        .filter(
+            DisputeCase.deal_id == deal_id,
+            DisputeCase.milestone_id == (milestone.id if milestone else None),
+            DisputeCase.status != DisputeCaseStatus.RESOLVED,
+        )
+        .with_for_update()
+        .first()
+    )
+
+def _close_dispute_case(session, dispute_case, winner_role, admin_id):
+    """إغلاق القضية وتحديث عدادات الوكيل (قضية لم يستلمها أحد تحسب لمن حكم فيها)"""
+    if dispute_case.assigned_to:
+        session.query(Admin).filter_by(user_id=dispute_case.assigned_to).update(
+            {Admin.open_cases: Admin.open_cases - 1}, synchronize_session=False
+        )
+    elif admin_id:
+        dispute_case.assigned_to = int(admin_id)
+    if dispute_case.assigned_to:
+        session.query(Admin).filter_by(user_id=dispute_case.assigned_to).update(
+            {Admin.resolved_cases: Admin.resolved_cases + 1}, synchronize_session=False
+        )
+    dispute_case.status = DisputeCaseStatus.RESOLVED
+    dispute_case.resolution = winner_role
+    dispute_case.resolved_at = datetime.utcnow()
+
+def _dispute_queue_order():
+    """تجاوز المهلة أولاً، ثم الأكبر مبلغاً، ثم الأقدم"""
+    overdue = case((DisputeCase.opened_at < datetime.utcnow() - DISPUTE_SLA, 0), else_=1)
+    return [overdue, DisputeCase.amount_usd_cents.desc(), DisputeCase.opened_at]
+
+def _dispute_case_snapshot(dispute_case, public_id, buyer_id, seller_id, milestone_no=None):
+    return {
+        "case_id": dispute_case.id,
+        "public_id": public_id,
+        "milestone": milestone_no,
+        "amount_text": format_amount(dispute_case.amount_usd_cents, BASE_ASSET),
+        "age_hours": int((datetime.utcnow() - dispute_case.opened_at).total_seconds() // 3600),
+        "overdue": dispute_case.opened_at < datetime.utcnow() - DISPUTE_SLA,
+        "buyer_id": buyer_id,
+        "seller_id": seller_id,
+        "opened_by": dispute_case.opened_by,
+    }
+
+def get_dispute_queue(limit=20):
+    """
+    لوحة فريق النزاعات: القضايا المفتوحة بترتيب الأولوية + عبء كل وكيل.
+    تعيد {"cases": [...], "total": عدد المفتوحة، "agents": [...]}.
+    """
     session = Session()
     try:
-        deals = session.query(Deal).filter(
-            ((Deal.seller_id == user_id) | (Deal.buyer_id == user_id)),
-            Deal.status.in_([DealStatus.ACTIVE, DealStatus.DELIVERED])
-        ).all()
-        
-        # استخراج البيانات المهمة فقط
-        results = []
-        for d in deals:
-            role = "بائع" if d.seller_id == user_id else "مشتري"
-            results.append({"id": d.id, "amount": d.amount_cents/100, "role": role, "status": d.status})
-        return results
+        rows = (
+            session.query(DisputeCase, Deal.public_id, Deal.buyer_id, Deal.seller_id, DealMilestone.position)
+            .join(Deal, Deal.id == DisputeCase.deal_id)
+            .outerjoin(DealMilestone, DealMilestone.id == DisputeCase.milestone_id)
+            .filter(DisputeCase.status == DisputeCaseStatus.OPEN)
+            .order_by(*_dispute_queue_order())
+            .limit(limit)
+            .all()
+        )
+        cases = [
+            _dispute_case_snapshot(*row) for row in rows
+        ]
+        total = (
+            session.query(func.count(DisputeCase.id))
+            .filter(DisputeCase.status == DisputeCaseStatus.OPEN)
+            .scalar()
+        )
+        agents = (
+            session.query(Admin.user_id, User.full_name, Admin.open_cases, Admin.resolved_cases)
+            .join(User, User.id == Admin.user_id)
+            .filter(Admin.role.in_([AdminRole.DISPUTE_AGENT, AdminRole.SUPER_ADMIN]))
+            .order_by(Admin.open_cases.desc())
+            .all()
+        )
+        return {
+            "cases": cases,
+            "total": total,
+            "agents": [
+                {"user_id": a.user_id, "name": a.full_name,
+                 "open_cases": a.open_cases or 0, "resolved_cases": a.resolved_cases or 0}
+                for a in agents
+            ],
+        }
     finally:
         session.close()
 
-def open_dispute(deal_id, user_id):
+def claim_dispute_case(admin_id, public_id=None):
     """
-    يقوم أحد الطرفين برفع حالة 'نزاع'.
+    وكيل يستلم قضية: الأعلى أولوية، أو قضية صفقة معينة (برمزها العام).
+    SKIP LOCKED: وكيلان يضغطان معاً يأخذ كل منهما قضية مختلفة بدل الانتظار أو التكرار.
+    تعيد صورة القضية أو "NOT_FOUND" / "EMPTY" / "ERROR".
     """
+    deal_id = None
+    if public_id is not None:
+        deal_id = resolve_deal_ref(public_id)
+        if deal_id is None:
+            return Result.NOT_FOUND
+
     session = Session()
     try:
-        deal = session.query(Deal).filter_by(id=deal_id).first()
-        
-        # 1. هل الصفقة موجودة؟
-        if not deal: return False
-        
-        # 2. هل الشخص الذي ضغط الزر له علاقة بالصفقة؟ (أمان)
-        if user_id not in [deal.buyer_id, deal.seller_id]:
-            return False
+        query = session.query(DisputeCase).filter(DisputeCase.status == DisputeCaseStatus.OPEN)
+        if deal_id is not None:
+            query = query.filter(DisputeCase.deal_id == deal_id)
+        dispute_case = (
+            query.order_by(*_dispute_queue_order())
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if not dispute_case:
+            return Result.EMPTY
 
-        # 3. هل الصفقة في حالة تسمح بالنزاع؟ (يجب أن تكون نشطة أو مسلمة)
-        if deal.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
-            return False
+        dispute_case.status = DisputeCaseStatus.CLAIMED
+        dispute_case.assigned_to = admin_id
+        dispute_case.claimed_at = datetime.utcnow()
+        session.query(Admin).filter_by(user_id=admin_id).update(
+            {Admin.open_cases: Admin.open_cases + 1}, synchronize_session=False
+        )
 
-        # 4. تغيير الحالة وتجميد كل شيء
-        deal.status = DealStatus.DISPUTE
+        deal = session.query(Deal).filter_by(id=dispute_case.deal_id).first()
+        milestone_no = None
+        if dispute_case.milestone_id:
+            milestone_no = (
+                session.query(DealMilestone.position)
+                .filter_by(id=dispute_case.milestone_id)
+                .scalar()
+            )
+        snapshot = _dispute_case_snapshot(
+            dispute_case, deal.public_id, deal.buyer_id, deal.seller_id, milestone_no
+        )
         session.commit()
-        return True
-        
-    except Exception as e:
-        print(f"Error opening dispute: {e}")
+        return snapshot
+    except Exception:
         session.rollback()
-        return False
+        _log_failure("Error claiming dispute case")
+        return Result.ERROR
     finally:
         session.close()
 
-def solve_dispute_by_admin(deal_id, winner_role):
+def _has_milestones(session, deal_id):
+    return session.query(exists().where(DealMilestone.deal_id == deal_id)).scalar()
+
+def _lock_milestone(session, deal_id, milestone_no):
+    """قفل صف المرحلة وحده (FOR UPDATE) بدل صف الصفقة"""
+    return (
+        session.query(DealMilestone)
+        .filter_by(deal_id=deal_id, position=milestone_no)
+        .with_for_update()
+        .first()
+    )
+
+def _milestone_snapshot(milestone, deal):
+    asset = deal.asset or BASE_ASSET
+    return {
+        "id": milestone.id,
+        "no": milestone.position,
+        "title": milestone.title,
+        "amount_text": format_amount(milestone.amount_cents, asset),
+        "status": milestone.status,
+    }
+
+@retry_on_conflict
+def _close_deal_if_finished(deal_id):
     """
-    الأدمن يقرر الفائز:
-    - winner_role = 'seller' -> المال يذهب للبائع (إتمام الصفقة).
-    - winner_role = 'buyer'  -> المال يعود للمشتري (إلغاء الصفقة).
+    بعد إغلاق مرحلة: إذا انتهت كل المراحل نغلق الصفقة نفسها.
+    معاملة قصيرة منفصلة، فصف الصفقة لا يُقفل إلا عند إغلاق آخر مرحلة.
+    تعيد الحالة الجديدة للصفقة أو None إذا بقيت مراحل مفتوحة.
+    (المرحلتان الأخيرتان تغلقان معاً فيتعارض الإغلاقان: يعاد، وما بقي تلتقطه close_finished_milestone_deals)
     """
     session = Session()
     try:
-        deal = session.query(Deal).filter_by(id=deal_id).first()
-        
-        # التأكد أن الصفقة في حالة نزاع فعلاً
-        if not deal or deal.status != DealStatus.DISPUTE:
-            return "NOT_DISPUTE"
-
-        # جلب أطراف النزاع
-        seller = session.query(User).filter_by(id=deal.seller_id).with_for_update().first()
-        buyer = session.query(User).filter_by(id=deal.buyer_id).with_for_update().first()
-
-        # --- السيناريو 1: الحكم للبائع ---
-        if winner_role == "seller":
-            # نحسب العمولة كالمعتاد
-            FEE_RATE = Decimal('0.05')
-            calculated_fee = (Decimal(deal.amount_cents) * FEE_RATE).to_integral_value(rounding=ROUND_HALF_UP)
-            fee = int(calculated_fee)
-            net_profit = deal.amount_cents - fee
-            
-            seller.balance_cents += net_profit # إضافة المال للبائع
-            deal.status = DealStatus.COMPLETED # إغلاق كصفقة ناجحة
-            
-            msg = "تم الحكم لصالح البائع."
+        open_count = session.query(func.count(DealMilestone.id)).filter(
+            DealMilestone.deal_id == deal_id,
+            DealMilestone.status.notin_([DealStatus.COMPLETED, DealStatus.CANCELED]),
+        ).scalar()
+        if open_count:
+            return None
 
-        # --- السيناريو 2: الحكم للمشتري ---
-        elif winner_role == "buyer":
-            # نعيد المبلغ كاملاً للمشتري (بدون خصم عمولة عادةً، أو حسب سياستك)
-            buyer.balance_cents += deal.amount_cents # استرداد كامل
-            deal.status = DealStatus.CANCELED # إلغاء الصفقة
-            
-            msg = "تم الحكم لصالح المشتري واسترداد المال."
-        
-        else:
-            return "INVALID_WINNER"
+        deal = session.query(Deal).filter_by(id=deal_id).with_for_update().first()
+        if not deal or deal.status != DealStatus.ACTIVE:
+            return None  # أغلقها طلب آخر قبلنا
 
+        any_completed = session.query(exists().where(
+            DealMilestone.deal_id == deal_id, DealMilestone.status == DealStatus.COMPLETED
+        )).scalar()
+        deal.status = DealStatus.COMPLETED if any_completed else DealStatus.CANCELED
+        if any_completed:
+            # الحجم أضيف مع كل مرحلة، هنا نعد الصفقة فقط
+            _record_completed_deal(session, deal.seller_id, 0)
         session.commit()
-        return {"status": "SUCCESS", "msg": msg, "buyer_id": deal.buyer_id, "seller_id": deal.seller_id}
-
-    except Exception as e:
-        print(f"Admin Resolve Error: {e}")
+        return deal.status
+    except Exception:
+        _retry_if_conflict()
         session.rollback()
-        return "ERROR"
+        _log_failure("Error closing milestone deal")
+        return None
     finally:
         session.close()
 
-def save_message_to_log(deal_id, sender_id, text=None, file_id=None):
+def close_finished_milestone_deals(limit=100):
+    """
+    شبكة أمان لـ _close_deal_if_finished: صفقة ACTIVE انتهت كل مراحلها لكن إغلاقها
+    فشل بعد commit المرحلة الأخيرة (تعارض، توقف العملية). تعيد عدد الصفقات المغلقة.
+    """
     session = Session()
     try:
-        new_log = MessageLog(
-            deal_id=deal_id,
-            sender_id=sender_id,
-            message_text=text,
-            file_id=file_id,
-            is_image=(file_id is not None) # إذا وجد ملف، فهي صورة
+        open_milestone = exists().where(
+            DealMilestone.deal_id == Deal.id,
+            DealMilestone.status.notin_([DealStatus.COMPLETED, DealStatus.CANCELED]),
         )
-        session.add(new_log)
+        deal_ids = session.scalars(
+            select(Deal.id)
+            .where(Deal.status == DealStatus.ACTIVE)
+            .where(exists().where(DealMilestone.deal_id == Deal.id))
+            .where(~open_milestone)
+            .limit(limit)
+        ).all()
+    finally:
+        session.close()
+
+    closed = sum(1 for deal_id in deal_ids if _close_deal_if_finished(deal_id))
+    if closed:
+        log.warning("Closed finished milestone deals left active", extra={"count": closed})
+    return closed
+
+def set_deal_milestones(deal_id, seller_id, amounts, titles=None):
+    """
+    تقسيم صفقة معلقة (قبل الدفع) إلى مراحل بالترتيب.
+    amounts: مبالغ المراحل بعملة الصفقة، ومجموعها يجب أن يساوي مبلغ الصفقة.
+    """
+    session = Session()
+    try:
+        deal = session.query(Deal).filter_by(id=deal_id, seller_id=seller_id).with_for_update().first()
+        if not deal:
+            return Result.NOT_FOUND
+        if deal.status != DealStatus.PENDING:
+            return Result.WRONG_STATUS
+
+        asset = deal.asset or BASE_ASSET
+        units = [to_units(a, asset) for a in amounts]
+        if len(units) < 2 or any(u <= 0 for u in units):
+            return Result.INVALID
+        if sum(units) != deal.amount_cents:
+            return Result.SUM_MISMATCH
+
+        session.query(DealMilestone).filter_by(deal_id=deal.id).delete()
+        session.execute(insert(DealMilestone), [
+            {
+                "deal_id": deal.id,
+                "position": n,
+                "title": (titles[n - 1] if titles else None) or f"المرحلة {n}",
+                "amount_cents": u,
+                "status": DealStatus.PENDING,
+            }
+            for n, u in enumerate(units, start=1)
+        ])
         session.commit()
-    except Exception as e:
-        print(f"❌ Error logging message: {e}")
+        return [format_amount(u, asset) for u in units]
+    except Exception:
+        session.rollback()
+        _log_failure("Error setting milestones")
+        return Result.ERROR
     finally:
         session.close()
 
-def get_deal_logs(deal_id):
-    """جلب كامل الشريط الزمني للصفقة"""
+def get_deal_milestones(deal_id):
+    """مراحل الصفقة مرتبة (قائمة فارغة للصفقات العادية)"""
     session = Session()
     try:
-        logs = session.query(MessageLog).filter_by(deal_id=deal_id).order_by(MessageLog.created_at).all()
-        # نستخدم expunge لنتمكن من استخدام البيانات بعد إغلاق الجلسة
-        session.expunge_all()
-        return logs
+        deal = (
+            session.query(Deal)
+            .options(joinedload(Deal.milestones))
+            .filter_by(id=deal_id)
+            .first()
+        )
+        return _milestone_rows(deal.milestones, deal.asset) if deal else []
     finally:
         session.close()
+
+def _record_revenue(session, deal, milestone, tier, rate_bps, gross_cents, fee_cents, fee_units, source):
+    """
+    سطر في دفتر الإيرادات (إدراج فقط). المبالغ بالسنت بالدولار.
+    دلو اليوم في revenue_daily لا يحدث هنا: صف واحد تمر به كل عمولة يجعل كل
+    التحريرات متتابعة، فيجمعه aggregate_revenue_daily في الخلفية.
+    """
+    session.add(RevenueEntry(
+        deal_id=deal.id, milestone_id=milestone.id if milestone else None,
+        seller_id=deal.seller_id, fee_tier=tier, rate_bps=rate_bps,
+        gross_cents=gross_cents, fee_cents=fee_cents, source=source, created_at=datetime.utcnow(),
+        asset=deal.asset or BASE_ASSET, fee_units=fee_units,
+    ))
+
+def get_revenue_report(period="day", periods=None):
+    """
+    تقرير الإيرادات مجمعاً باليوم أو الأسبوع أو الشهر من جدول revenue_daily
+    (صف واحد لكل يوم، فالتقرير الشهري لسنة كاملة يقرأ 365 صفاً على الأكثر).
+    اليوم الحالي متأخر حتى REVENUE_AGGREGATE_SECONDS (يجمعه revenue_aggregator).
+    تعيد قائمة قواميس مرتبة من الأحدث، أو None لفترة غير معروفة.
+    """
+    if period not in REVENUE_PERIODS:
+        return None
+    periods = periods or REVENUE_PERIODS[period]
+    today = datetime.utcnow().date()
+    if period == "day":
+        start = today - timedelta(days=periods - 1)
+    elif period == "week":
+        start = today - timedelta(days=today.weekday() + 7 * (periods - 1))
+    else:
+        year, month = today.year, today.month - (periods - 1)
+        while month < 1:
+            year, month = year - 1, month + 12
+        start = today.replace(year=year, month=month, day=1)
+
+    session = Session()
+    try:
+        bucket = func.date_trunc(period, RevenueDaily.day).label("bucket")
+        rows = session.execute(
+            select(
+                bucket,
+                func.sum(RevenueDaily.deals_count),
+                func.sum(RevenueDaily.gross_cents),
+                func.sum(RevenueDaily.fee_cents),
+            )
+            .where(RevenueDaily.day >= start)
+            .group_by(bucket)
+            .order_by(bucket.desc())
+        ).all()
+        return [
+            {
+                "period_start": b.date(),
+                "deals": int(count),
+                "gross": int(gross) / 100.0,
+                "fee": int(fee) / 100.0,
+            }
+            for b, count, gross, fee in rows
+        ]
+    finally:
+        session.close()
+
+@retry_on_conflict
+def aggregate_revenue_daily():
+    """
+    يعيد حساب دلاء الأيام التي ما زالت تتغير (اليوم، وأمس خلال هامش منتصف الليل)
+    من revenue_entries. القيم تكتب كاملة لا كزيادة، فالتكرار آمن.
+    """
+    session = Session()
+    try:
+        since_day = datetime.combine((datetime.utcnow() - REVENUE_IN_FLIGHT_MARGIN).date(), datetime.min.time())
+        entry_day = func.date(RevenueEntry.created_at)
+        daily = (
+            select(
+                entry_day.label("day"),
+                func.count().label("deals_count"),
+                func.sum(RevenueEntry.gross_cents).label("gross_cents"),
+                func.sum(RevenueEntry.fee_cents).label("fee_cents"),
+            )
+            .where(RevenueEntry.created_at >= since_day)
+            .group_by(entry_day)
+        )
+        stmt = pg_insert(RevenueDaily).from_select(["day", "deals_count", "gross_cents", "fee_cents"], daily)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[RevenueDaily.day],
+            set_={
+                "deals_count": stmt.excluded.deals_count,
+                "gross_cents": stmt.excluded.gross_cents,
+                "fee_cents": stmt.excluded.fee_cents,
+            },
+        ))
+        session.commit()
+        return True
+    except Exception:
+        _retry_if_conflict()
+        session.rollback()
+        _log_failure("Error aggregating revenue")
+        return False
+    finally:
+        session.close()
+
+def rebuild_revenue_daily():
+    """إعادة بناء revenue_daily من دفتر الإيرادات (بعد أي إصلاح يدوي)"""
+    session = Session()
+    try:
+        session.query(RevenueDaily).delete()
+        entry_day = func.date(RevenueEntry.created_at)
+        daily = select(
+            entry_day, func.count(), func.sum(RevenueEntry.gross_cents), func.sum(RevenueEntry.fee_cents)
+        ).group_by(entry_day)
+        session.execute(
+            insert(RevenueDaily).from_select(["day", "deals_count", "gross_cents", "fee_cents"], daily)
+        )
+        session.commit()
+        log.info("revenue_daily rebuilt from revenue_entries")
+        return True
+    except Exception:
+        session.rollback()
+        _log_failure("Error rebuilding revenue")
+        return False
+    finally:
+        session.close()
+
+def _record_completed_deal(session, seller_id, amount_cents, deals=1):
+    """زيادة عداد الصفقات المكتملة وحجمها للبائع في seller_stats (داخل معاملة المستدعي)"""
+    now = datetime.utcnow()
+    stmt = pg_insert(SellerStats).values(
+        seller_id=seller_id, completed_deals=deals,
+        completed_volume_cents=amount_cents, updated_at=now
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[SellerStats.seller_id],
+        set_={
+            "completed_deals": SellerStats.completed_deals + deals,
+            "completed_volume_cents": SellerStats.completed_volume_cents + amount_cents,
+            "updated_at": now,
+        },
+    ))
+
+def get_user_active_deals(user_id):
+    """تجلب الصفقات التي يكون فيها المستخدم بائعاً أو مشترياً وحالتها نشطة"""
+    session = Session()
+    try:
+        deals = session.query(Deal).filter(
+            ((Deal.seller_id == user_id) | (Deal.buyer_id == user_id)),
+            Deal.status.in_([DealStatus.ACTIVE, DealStatus.DELIVERED])
+        ).all()
         
-def log_audit_event(user_id, action, amount_cents, details=""):
+        # استخراج البيانات المهمة فقط
+        results = []
+        for d in deals:
+            role = "بائع" if d.seller_id == user_id else "مشتري"
+            results.append({
+                "id": d.id, "public_id": d.public_id,
+                "amount": d.amount_cents/100, "role": role, "status": d.status,
+                "amount_text": format_amount(d.amount_cents, d.asset or BASE_ASSET),
+            })
+        return results
+    finally:
+        session.close()
+
+def open_dispute(deal_id, user_id, milestone_no=None):
     """
-    تسجل الحركة المالية بنظام Hash Chain (بلوك تشين مصغر).
+    يقوم أحد الطرفين برفع حالة 'نزاع' (على الصفقة كلها أو على مرحلة واحدة).
+    تعيد صورة الصفقة بعد التجميد (قاموس) عند النجاح، أو False.
     """
     session = Session()
     try:
-        # 1. نجلب آخر سجل تم حفظه ونقوم بـ "قفله" لمنع تضارب الكتابة المتزامنة
-        last_log = session.query(AuditLog).order_by(AuditLog.id.desc()).with_for_update().first()
+        deal = _query_deal(session).filter_by(id=deal_id).first()
         
-        # 2. تحديد الـ Hash السابق
-        prev_hash = last_log.current_hash if last_log else "GENESIS_BLOCK_HASH"
+        # 1. هل الصفقة موجودة؟
+        if not deal: return False
         
-        # 3. تجهيز البيانات للتشفير (String)
-        # ندمج: الهاش السابق + هوية المستخدم + الفعل + المبلغ + الوقت التقريبي
-        # ملاحظة: الوقت نستخدمه للتوقيع ولكن لا نعتمد عليه كلياً في التشفير لتجنب مشاكل الميكرو ثانية
-        raw_data = f"{prev_hash}{user_id}{action}{amount_cents}{details}"
+        # 2. هل الشخص الذي ضغط الزر له علاقة بالصفقة؟ (أمان)
+        if user_id not in [deal.buyer_id, deal.seller_id]:
+            return False
+
+        if milestone_no is not None:
+            # نجمد المرحلة فقط، وباقي المراحل تستمر طبيعياً
+            milestone = _lock_milestone(session, deal.id, milestone_no)
+            if not milestone or deal.status != DealStatus.ACTIVE:
+                return False
+            if milestone.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
+                return False
+            milestone.status = DealStatus.DISPUTE
+            _open_dispute_case(session, deal, milestone, user_id)
+            session.commit()
+            snapshot = _deal_snapshot(deal)
+            snapshot["milestone"] = _milestone_snapshot(milestone, deal)
+            return snapshot
+        if _has_milestones(session, deal.id):
+            return False
+
+        # 3. هل الصفقة في حالة تسمح بالنزاع؟ (يجب أن تكون نشطة أو مسلمة)
+        if deal.status not in [DealStatus.ACTIVE, DealStatus.DELIVERED]:
+            return False
+
+        # 4. تغيير الحالة وتجميد كل شيء
+        deal.status = DealStatus.DISPUTE
+        _open_dispute_case(session, deal, None, user_id)
+        session.commit()
+        return _deal_snapshot(deal)
+
+    except _RatesUnavailable:
+        session.rollback()
+        log.warning("Dispute not opened: rates unavailable", extra={"deal_id": deal_id})
+        return False
+    except Exception:
+        _log_failure("Error opening dispute")
+        session.rollback()
+        return False
+    finally:
+        session.close()
+
+@retry_on_conflict
+def solve_dispute_by_admin(deal_id, winner_role, milestone_no=None, admin_id=None):
+    """
+    الأدمن يقرر الفائز:
+    - winner_role = 'seller' -> المال يذهب للبائع (إتمام الصفقة).
+    - winner_role = 'buyer'  -> المال يعود للمشتري (إلغاء الصفقة).
+    milestone_no: الحكم على مرحلة واحدة في صفقات المراحل.
+    admin_id: من أصدر الحكم (قضية استلمها وكيل آخر لا يحكم فيها غيره).
+    """
+    session = Session()
+    try:
+        deal = _query_deal(session).filter_by(id=deal_id).first()
+        if not deal:
+            return Result.NOT_DISPUTE
+
+        milestone = None
+        if milestone_no is not None:
+            milestone = _lock_milestone(session, deal.id, milestone_no)
+            if not milestone or milestone.status != DealStatus.DISPUTE:
+                return Result.NOT_DISPUTE
+        # التأكد أن الصفقة في حالة نزاع فعلاً
+        elif deal.status != DealStatus.DISPUTE:
+            return Result.NOT_DISPUTE
+
+        dispute_case = _lock_dispute_case(session, deal.id, milestone)
+        if (dispute_case and dispute_case.assigned_to and admin_id
+                and dispute_case.assigned_to != int(admin_id)):
+            return Result.CLAIMED_BY_OTHER
+
+        # --- السيناريو 1: الحكم للبائع ---
+        if winner_role == "seller":
+            # نحسب العمولة كالمعتاد (نفس جدول العمولات)
+            _pay_out_to_seller(session, deal, source="dispute", milestone=milestone)
+            
+            msg = "تم الحكم لصالح البائع."
+
+        # --- السيناريو 2: الحكم للمشتري ---
+        elif winner_role == "buyer":
+            # نعيد المبلغ كاملاً للمشتري (بدون خصم عمولة عادةً، أو حسب سياستك)
+            _refund_to_buyer(session, deal, memo="dispute", milestone=milestone)
+            
+            msg = "تم الحكم لصالح المشتري واسترداد المال."
         
-        # 4. توليد الـ Hash الجديد (SHA256)
-        current_hash = hashlib.sha256(raw_data.encode('utf-8')).hexdigest()
+        else:
+            return Result.INVALID_WINNER
+
+        if dispute_case:
+            _close_dispute_case(session, dispute_case, winner_role, admin_id)
+        session.commit()
+        if winner_role == "seller":
+            _invalidate_seller_stats(deal.seller_id)
+        if milestone:
+            msg = f"{milestone.title}: {msg}"
+            _close_deal_if_finished(deal.id)
+        return {"status": Result.SUCCESS, "msg": msg, "buyer_id": deal.buyer_id, "seller_id": deal.seller_id, "deal": _deal_snapshot(deal)}
+
+    except _RatesUnavailable:
+        session.rollback()
+        return Result.RATES_UNAVAILABLE
+    except Exception:
+        _retry_if_conflict()
+        _log_failure("Admin Resolve Error")
+        session.rollback()
+        return Result.ERROR
+    finally:
+        session.close()
+
+def save_message_to_log(deal_id, sender_id, text=None, file_id=None):
+    session = Session()
+    try:
+        new_log = MessageLog(
+            deal_id=deal_id,
+            sender_id=sender_id,
+            message_text=text,
+            file_id=file_id,
+            is_image=(file_id is not None) # إذا وجد ملف، فهي صورة
+        )
+        session.add(new_log)
+        session.commit()
+    except Exception:
+        _log_failure("Error logging message")
+    finally:
+        session.close()
+
+def save_message_logs_bulk(rows):
+    """
+    إدخال مجموعة أدلة دفعة واحدة (INSERT متعدد في commit واحد).
+    rows: قائمة قواميس بأعمدة MessageLog. تعيد True عند النجاح.
+    """
+    if not rows:
+        return True
+    session = Session()
+    try:
+        session.execute(insert(MessageLog), rows)
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        _log_failure("Error bulk logging messages")
+        return False
+    finally:
+        session.close()
+
+def get_deal_logs(deal_id):
+    """جلب كامل الشريط الزمني للصفقة (مع النسخة المحلية للصور إن وجدت)"""
+    session = Session()
+    try:
+        logs = (
+            session.query(MessageLog)
+            .options(joinedload(MessageLog.evidence))
+            .filter_by(deal_id=deal_id)
+            .order_by(MessageLog.created_at)
+            .all()
+        )
+        # نستخدم expunge لنتمكن من استخدام البيانات بعد إغلاق الجلسة
+        session.expunge_all()
+        return logs
+    finally:
+        session.close()
         
-        # 5. الحفظ
-        new_log = AuditLog(
-            user_id=user_id,
-            action=action,
-            amount_cents=amount_cents,
-            details=details,
-            previous_hash=prev_hash,
-            current_hash=current_hash
+def get_unarchived_evidence(limit=50):
+    """صور الأدلة التي لم تُنسخ محلياً بعد (الأقدم أولاً)"""
+    session = Session()
+    try:
+        rows = (
+            session.query(MessageLog.id, MessageLog.file_id)
+            .outerjoin(EvidenceFile, EvidenceFile.message_log_id == MessageLog.id)
+            .filter(MessageLog.is_image == True, EvidenceFile.id == None)
+            .order_by(MessageLog.id)
+            .limit(limit)
+            .all()
         )
+        return [{"message_log_id": r.id, "file_id": r.file_id} for r in rows]
+    except Exception:
+        _log_failure("Error fetching unarchived evidence")
+        return []
+    finally:
+        session.close()
+
+def save_evidence_files(rows):
+    """تسجيل نتائج الأرشفة دفعة واحدة"""
+    if not rows:
+        return True
+    session = Session()
+    try:
+        session.execute(insert(EvidenceFile), rows)
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        _log_failure("Error saving evidence files")
+        return False
+    finally:
+        session.close()
         
-        session.add(new_log)
+def log_audit_event(user_id, action, amount_cents, details=""):
+    """
+    تسجل الحركة المالية بنظام Hash Chain (بلوك تشين مصغر).
+    """
+    session = Session()
+    try:
+        _append_audit(session, user_id, action, amount_cents, details)
         session.commit()
         # print(f"🔒 Audit Logged: {current_hash[:10]}...") 
         
-    except Exception as e:
-        print(f"❌ CRITICAL SECURITY ERROR: Failed to log audit: {e}")
+    except Exception:
+        log.critical("Failed to log audit", exc_info=True)
+        mark_call_failed()
         session.rollback()
         # هنا يجب مستقبلاً إيقاف البوت لأن النظام المالي لا يعمل بدون رقابة
     finally:
         session.close()
-        
+
+def _append_audit(session, user_id, action, amount_cents, details=""):
+    """حلقة جديدة في سلسلة التدقيق داخل معاملة المستدعي (تثبت أو تلغى مع التغيير نفسه)"""
+    # 1. نجلب آخر سجل تم حفظه ونقوم بـ "قفله" لمنع تضارب الكتابة المتزامنة
+    lock_start = time.perf_counter()
+    last_log = session.query(AuditLog).order_by(AuditLog.id.desc()).with_for_update().first()
+    AUDIT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - lock_start)
+
+    # 2. تحديد الـ Hash السابق
+    prev_hash = last_log.current_hash if last_log else "GENESIS_BLOCK_HASH"
+
+    # 3. تجهيز البيانات للتشفير (String)
+    # ندمج: الهاش السابق + هوية المستخدم + الفعل + المبلغ + الوقت التقريبي
+    # ملاحظة: الوقت نستخدمه للتوقيع ولكن لا نعتمد عليه كلياً في التشفير لتجنب مشاكل الميكرو ثانية
+    raw_data = f"{prev_hash}{user_id}{action}{amount_cents}{details}"
+
+    # 4. توليد الـ Hash الجديد (SHA256)
+    current_hash = hashlib.sha256(raw_data.encode('utf-8')).hexdigest()
+
+    # 5. الحفظ
+    new_log = AuditLog(
+        user_id=user_id,
+        action=action,
+        amount_cents=amount_cents,
+        details=details,
+        previous_hash=prev_hash,
+        current_hash=current_hash
+    )
+
+    session.add(new_log)
+
+@retry_on_conflict
+def set_user_ban(admin_id, target_id, banned, reason=""):
+    """
+    حظر مستخدم أو فك حظره: يحدث users.is_banned ويسجل في سلسلة التدقيق،
+    ثم يعلن الحدث على Redis لتطبقه كل نسخ البوت فوراً.
+    تعيد "SUCCESS" / "NOT_FOUND" / "IS_ADMIN" / "UNCHANGED" / "ERROR".
+    """
+    if banned and permissions.get_role(target_id) is not None:
+        return Result.IS_ADMIN
+    session = Session()
+    try:
+        user = session.query(User).filter_by(id=target_id).with_for_update().first()
+        if not user:
+            return Result.NOT_FOUND
+        if bool(user.is_banned) == banned:
+            return Result.UNCHANGED
+        user.is_banned = banned
+        # في نفس المعاملة: لا حظر بدون سجله في السلسلة ولا سجل لحظر لم يثبت
+        _append_audit(session, admin_id, "BAN" if banned else "UNBAN", 0, f"User {target_id}: {reason}".strip(": "))
+        session.commit()
+    except Exception:
+        _retry_if_conflict()
+        session.rollback()
+        _log_failure("Error updating ban")
+        return Result.ERROR
+    finally:
+        session.close()
+
+    event = f"{'ban' if banned else 'unban'}:{target_id}"
+    apply_ban_event(event)  # هذه النسخة لا تنتظر عودة الرسالة من Redis
+    try:
+        redis_client.publish(BANS_CHANNEL, event)
+    except Exception:
+        log.warning("Redis error", exc_info=True)  # النسخ الأخرى تلتقطه عند إعادة التحميل من القاعدة
+    return Result.SUCCESS
+
 def add_review(deal_id, buyer_id, seller_id, stars):
-    """يضيف تقييماً ويحدث سمعة البائع"""
+    """
+    يضيف تقييماً ويحدث إحصائيات البائع (seller_stats) في نفس المعاملة.
+    لا نلمس صف البائع في users، فلا تتعطل عمليات رصيده بسبب التقييمات.
+    """
+    if stars not in (1, 2, 3, 4, 5):
+        return None
     session = Session()
     try:
         # 1. هل قام بالتقييم مسبقاً لهذه الصفقة؟
         existing = session.query(Review).filter_by(deal_id=deal_id).first()
         if existing:
-            return "ALREADY_REVIEWED"
+            return Result.ALREADY_REVIEWED
 
         # 2. إضافة التقييم
         new_review = Review(
@@ -494,41 +1621,221 @@ def add_review(deal_id, buyer_id, seller_id, stars):
         )
         session.add(new_review)
         
-        # 3. تحديث إحصائيات البائع (السمعة)
-        seller = session.query(User).filter_by(id=seller_id).with_for_update().first()
-        
-        # [cite_start]reputation في models.py [cite: 96] سنستخدمه لتخزين "مجموع النجوم"
-        # [cite_start]deals_count [cite: 96] سنستخدمه لتخزين "عدد المقيمين"
-        seller.reputation += stars
-        seller.deals_count += 1
+        # 3. تحديث الإحصائيات بزيادة تراكمية (UPSERT) بدل إعادة الحساب
+        now = datetime.utcnow()
+        star_column = f"stars_{stars}"
+        stats_stmt = pg_insert(SellerStats).values(
+            seller_id=seller_id, reviews_count=1, stars_sum=stars,
+            last_review_at=now, updated_at=now, **{star_column: 1}
+        )
+        stats_stmt = stats_stmt.on_conflict_do_update(
+            index_elements=[SellerStats.seller_id],
+            set_={
+                "reviews_count": SellerStats.reviews_count + 1,
+                "stars_sum": SellerStats.stars_sum + stars,
+                star_column: getattr(SellerStats, star_column) + 1,
+                "last_review_at": now,
+                "updated_at": now,
+            },
+        ).returning(SellerStats.reviews_count, SellerStats.stars_sum)
+        count, total = session.execute(stats_stmt).one()
+
+        # 4. نفس الشيء في دلو اليوم (لنافذة آخر 30 يوماً)
+        daily_stmt = pg_insert(SellerStatsDaily).values(
+            seller_id=seller_id, day=now.date(), reviews_count=1, stars_sum=stars
+        )
+        session.execute(daily_stmt.on_conflict_do_update(
+            index_elements=[SellerStatsDaily.seller_id, SellerStatsDaily.day],
+            set_={
+                "reviews_count": SellerStatsDaily.reviews_count + 1,
+                "stars_sum": SellerStatsDaily.stars_sum + stars,
+            },
+        ))
         
         session.commit()
+        _invalidate_seller_stats(seller_id)
         
         # حساب المتوسط الجديد للعرض
-        avg_score = seller.reputation / seller.deals_count
-        return avg_score # نرجع المتوسط لنعرضه للمشتري
+        return total / count # نرجع المتوسط لنعرضه للمشتري
         
-    except Exception as e:
-        print(f"❌ Review Error: {e}")
+    except Exception:
+        _log_failure("Review Error")
         session.rollback()
         return None
     finally:
         session.close()
 
+def _invalidate_seller_stats(seller_id):
+    try:
+        redis_client.delete(f"seller_stats:{seller_id}")
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+
+def get_seller_stats(seller_id):
+    """
+    إحصائيات البائع الجاهزة (من الكاش أولاً ثم من seller_stats).
+    تعيد قاموساً: count, avg, histogram, recent_count, recent_avg
+    """
+    cache_key = f"seller_stats:{seller_id}"
+    try:
+        cached = redis_client.get(cache_key)
+        if cached:
+            return json.loads(cached)
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+
+    session = Session()
+    try:
+        stats = session.query(SellerStats).filter_by(seller_id=seller_id).first()
+        window_start = datetime.utcnow().date() - timedelta(days=RECENT_WINDOW_DAYS - 1)
+        recent_count, recent_sum = session.query(
+            func.coalesce(func.sum(SellerStatsDaily.reviews_count), 0),
+            func.coalesce(func.sum(SellerStatsDaily.stars_sum), 0),
+        ).filter(
+            SellerStatsDaily.seller_id == seller_id,
+            SellerStatsDaily.day >= window_start,
+        ).one()
+
+        count = stats.reviews_count if stats else 0
+        total = stats.stars_sum if stats else 0
+        result = {
+            "count": count,
+            "avg": round(total / count, 2) if count else None,
+            "histogram": {
+                str(n): (getattr(stats, f"stars_{n}") if stats else 0) for n in range(1, 6)
+            },
+            "recent_count": int(recent_count),
+            "recent_avg": round(int(recent_sum) / int(recent_count), 2) if recent_count else None,
+        }
+    except Exception:
+        _log_failure("Error fetching seller stats")
+        return None
+    finally:
+        session.close()
+
+    try:
+        redis_client.setex(cache_key, SELLER_STATS_CACHE_TTL, json.dumps(result))
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+    return result
+
 def get_user_rating(user_id):
     """جلب تقييم المستخدم للعرض (مثال: 4.8)"""
+    stats = get_seller_stats(user_id)
+    if not stats or stats["count"] == 0:
+        return "جديد 🆕"
+    return f"⭐ {stats['avg']:.1f} ({stats['count']})" # رقم عشري واحد (4.5)
+
+def rebuild_seller_stats():
+    """
+    إعادة بناء seller_stats و seller_stats_daily من جدول reviews بالكامل.
+    تستخدم مرة واحدة للبيانات القديمة (أو بعد أي إصلاح يدوي).
+    """
     session = Session()
     try:
-        user = session.query(User).filter_by(id=user_id).first()
-        if not user or user.deals_count == 0:
-            return "جديد 🆕"
+        session.query(SellerStatsDaily).delete()
+        session.query(SellerStats).delete()
+
+        histogram = {
+            f"stars_{n}": func.count().filter(Review.stars == n) for n in range(1, 6)
+        }
+        totals = select(
+            Review.target_id,
+            func.count(),
+            func.sum(Review.stars),
+            func.max(Review.created_at),
+            *histogram.values(),
+        ).group_by(Review.target_id)
+        session.execute(
+            insert(SellerStats).from_select(
+                ["seller_id", "reviews_count", "stars_sum", "last_review_at", *histogram.keys()],
+                totals,
+            )
+        )
+
+        # حجم التعامل من الصفقات المكتملة بالدولار، كما يضيفه _record_completed_deal
+        # (amount_cents بعملة الصفقة: قيمته بالدولار فقط في العملة الأساسية، وغيرها بدون
+        # usd_value_cents لا يحسب بدل أن يخلط وحدات TON مع السنتات)
+        usd_volume = func.coalesce(
+            Deal.usd_value_cents,
+            case((func.coalesce(Deal.asset, BASE_ASSET) == BASE_ASSET, Deal.amount_cents)),
+        )
+        completed = select(
+            Deal.seller_id, func.count(), func.coalesce(func.sum(usd_volume), 0)
+        ).where(Deal.status == DealStatus.COMPLETED).group_by(Deal.seller_id)
+        completed_stmt = pg_insert(SellerStats).from_select(
+            ["seller_id", "completed_deals", "completed_volume_cents"], completed
+        )
+        session.execute(completed_stmt.on_conflict_do_update(
+            index_elements=[SellerStats.seller_id],
+            set_={
+                "completed_deals": completed_stmt.excluded.completed_deals,
+                "completed_volume_cents": completed_stmt.excluded.completed_volume_cents,
+            },
+        ))
+
+        review_day = func.date(Review.created_at)
+        daily = select(
+            Review.target_id, review_day, func.count(), func.sum(Review.stars)
+        ).group_by(Review.target_id, review_day)
+        session.execute(
+            insert(SellerStatsDaily).from_select(
+                ["seller_id", "day", "reviews_count", "stars_sum"], daily
+            )
+        )
+        session.commit()
+        log.info("seller_stats rebuilt from reviews")
+        return True
+    except Exception:
+        session.rollback()
+        _log_failure("Error rebuilding seller stats")
+        return False
+    finally:
+        session.close()
         
-        avg = user.reputation / user.deals_count
-        return f"⭐ {avg:.1f}" # رقم عشري واحد (4.5)
+def get_seller_stats_changed_since(after_time=None, after_id=0, limit=500):
+    """
+    صفحة من seller_stats تغيرت بعد علامة (updated_at, seller_id).
+    ترقيم Keyset: لا OFFSET، فكل صفحة تكلف نفس الوقت مهما كبر الجدول.
+    العلامة ليست حداً آمناً بين التحديثات (updated_at قبل commit): المستدعي
+    يبدأ من العلامة ناقص هامش (leaderboard.IN_FLIGHT_MARGIN).
+    """
+    session = Session()
+    try:
+        query = session.query(
+            SellerStats.seller_id,
+            SellerStats.reviews_count,
+            SellerStats.stars_sum,
+            SellerStats.completed_deals,
+            SellerStats.updated_at,
+            User.full_name,
+        ).join(User, User.id == SellerStats.seller_id)
+        if after_time is not None:
+            query = query.filter(
+                (SellerStats.updated_at > after_time)
+                | ((SellerStats.updated_at == after_time) & (SellerStats.seller_id > after_id))
+            )
+        rows = query.order_by(SellerStats.updated_at, SellerStats.seller_id).limit(limit).all()
+        return [r._asdict() for r in rows]
+    except Exception:
+        _log_failure("Error paging seller stats")
+        return []
+    finally:
+        session.close()
+
+def get_global_rating_mean():
+    """متوسط كل التقييمات في المنصة (يستخدم كقيمة مسبقة في الترتيب البايزي)"""
+    session = Session()
+    try:
+        count, total = session.query(
+            func.coalesce(func.sum(SellerStats.reviews_count), 0),
+            func.coalesce(func.sum(SellerStats.stars_sum), 0),
+        ).one()
+        return int(total) / int(count) if count else None
     finally:
         session.close()
         
-def confirm_invoice_payment(invoice_id, amount_usd, user_id):
+def confirm_invoice_payment(invoice_id, amount_usd, user_id, asset=BASE_ASSET):
     """
     دالة خاصة بالـ Webhook: تضيف الرصيد فقط إذا لم تكن الفاتورة مسجلة من قبل
     """
@@ -538,12 +1845,12 @@ def confirm_invoice_payment(invoice_id, amount_usd, user_id):
         # سنبحث في AuditLog هل يوجد عملية لهذه الفاتورة؟
         existing_log = session.query(AuditLog).filter_by(details=f"Invoice #{invoice_id}").first()
         if existing_log:
-            print(f"⚠️ Invoice {invoice_id} already processed.")
+            log.warning("Invoice already processed", extra={"invoice_id": invoice_id})
             return False
 
         # 2. إضافة الرصيد للمستخدم
         # نستخدم الدالة الموجودة أصلاً لضمان القفل والحسابات
-        success = add_balance_to_user(user_id, amount_usd)
+        success = add_balance_to_user(user_id, amount_usd, asset)
         
         if success:
             # 3. تسجيل أن هذه الفاتورة تمت معالجتها في السجل
@@ -556,38 +1863,339 @@ def confirm_invoice_payment(invoice_id, amount_usd, user_id):
             pass
             
         return success
-    except Exception as e:
-        print(f"❌ Error confirming invoice: {e}")
+    except Exception:
+        _log_failure("Error confirming invoice")
         return False
     finally:
         session.close()
         
-def verify_admin_action(user_id, pin_input, required_role=None):
+@retry_on_conflict
+def request_withdrawal(user_id, amount_usd):
     """
-    يتحقق من: 
-    1. هل المستخدم أدمن؟
-    2. هل يملك الصلاحية (Role)؟
-    3. هل الـ PIN صحيح؟
+    طلب سحب: ينقل المبلغ من المحفظة إلى حجز خاص بالطلب في نفس المعاملة.
+    التحويل الفعلي يتم لاحقاً بواسطة العامل (withdrawal_worker).
     """
     session = Session()
     try:
-        admin = session.query(Admin).filter_by(user_id=user_id).first()
-        
-        if not admin:
-            return "NOT_ADMIN"
-            
-        if required_role and admin.role != required_role and admin.role != AdminRole.SUPER_ADMIN:
-            return "NO_PERMISSION"
-            
-        # التحقق من الـ PIN (2FA)
-        # pin_input يأتي من رسالة التليجرام، pin_hash مخزن في القاعدة
-        if not bcrypt.checkpw(pin_input.encode('utf-8'), admin.pin_hash.encode('utf-8')):
-            return "WRONG_PIN"
-            
-        return "AUTHORIZED"
+        d_amount = Decimal(str(amount_usd))
+        amount_cents = int((d_amount * 100).to_integral_value(rounding=ROUND_HALF_UP))
+        if amount_cents < MIN_WITHDRAWAL_CENTS:
+            return Result.AMOUNT_TOO_SMALL
+
+        user = session.query(User).filter_by(id=user_id).with_for_update().first()
+        if not user:
+            return Result.USER_NOT_FOUND
+        if user.balance_cents < amount_cents:
+            return Result.INSUFFICIENT_FUNDS
+
+        needs_approval = amount_cents >= WITHDRAWAL_APPROVAL_THRESHOLD_CENTS
+        withdrawal = Withdrawal(
+            user_id=user_id,
+            amount_cents=amount_cents,
+            status=WithdrawalStatus.PENDING_APPROVAL if needs_approval else WithdrawalStatus.QUEUED,
+        )
+        session.add(withdrawal)
+        session.flush()  # نحتاج الرقم لـ spend_id ولحساب الحجز
+        withdrawal.spend_id = f"escrowbot-wd-{withdrawal.id}"
+
+        post_transaction(session, "WITHDRAWAL_HOLD", [
+            (user_account(user_id), -amount_cents),
+            (withdrawal_account(withdrawal.id), amount_cents),
+        ], memo=withdrawal.spend_id)
+
+        session.commit()
+        log_audit_event(user_id, "WITHDRAWAL_REQUEST", amount_cents, f"Withdrawal #{withdrawal.id}")
+        return {
+            "status": Result.SUCCESS,
+            "withdrawal_id": withdrawal.id,
+            "amount": amount_cents / 100.0,
+            "needs_approval": needs_approval,
+        }
+    except Exception:
+        _retry_if_conflict()
+        session.rollback()
+        _log_failure("Withdrawal request error")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def claim_withdrawals_batch(limit=20):
+    """
+    يحجز دفعة طلبات جاهزة للعامل (SKIP LOCKED: عاملان لا يأخذان نفس الطلب).
+    يعيد قائمة قواميس.
+    """
+    session = Session()
+    try:
+        stuck_before = datetime.utcnow() - WITHDRAWAL_STUCK_AFTER
+        ready = (
+            select(Withdrawal.id)
+            .where(
+                (Withdrawal.status == WithdrawalStatus.QUEUED)
+                | ((Withdrawal.status == WithdrawalStatus.PROCESSING) & (Withdrawal.updated_at < stuck_before))
+            )
+            .order_by(Withdrawal.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        rows = session.execute(
+            update(Withdrawal)
+            .where(Withdrawal.id.in_(ready.scalar_subquery()))
+            .values(
+                status=WithdrawalStatus.PROCESSING,
+                attempts=Withdrawal.attempts + 1,
+                updated_at=datetime.utcnow(),
+            )
+            .returning(Withdrawal.id, Withdrawal.user_id, Withdrawal.amount_cents,
+                       Withdrawal.asset, Withdrawal.spend_id, Withdrawal.attempts)
+        ).all()
+        session.commit()
+        return [r._asdict() for r in rows]
+    except Exception:
+        session.rollback()
+        _log_failure("Error claiming withdrawals")
+        return []
     finally:
         session.close()
 
+@retry_on_conflict
+def finish_withdrawal(withdrawal_id, success, transfer_id=None, error=None):
+    """
+    نتيجة التحويل:
+    - نجاح: الحجز يخرج للعالم الخارجي (CryptoBot).
+    - فشل نهائي: الحجز يعود لمحفظة المستخدم.
+    """
+    session = Session()
+    try:
+        withdrawal = session.query(Withdrawal).filter_by(id=withdrawal_id).with_for_update().first()
+        if not withdrawal or withdrawal.status != WithdrawalStatus.PROCESSING:
+            return Result.WRONG_STATUS
+
+        action = _settle_withdrawal(session, withdrawal, success, transfer_id, error)
+        session.commit()
+        log_audit_event(withdrawal.user_id, action, withdrawal.amount_cents, f"Withdrawal #{withdrawal.id}")
+        return {"status": Result.SUCCESS, "user_id": withdrawal.user_id, "amount": withdrawal.amount_cents / 100.0}
+    except Exception:
+        _retry_if_conflict()
+        session.rollback()
+        _log_failure(f"Error finishing withdrawal #{withdrawal_id}")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def _settle_withdrawal(session, withdrawal, success, transfer_id=None, error=None):
+    """
+    قيد النتيجة النهائية داخل معاملة المستدعي:
+    نجاح = الحجز يخرج لـ CryptoBot، فشل = الحجز يعود لمحفظة المستخدم. تعيد اسم حدث التدقيق.
+    """
+    if success:
+        post_transaction(session, "WITHDRAWAL_PAYOUT", [
+            (withdrawal_account(withdrawal.id), -withdrawal.amount_cents),
+            (external_account(), withdrawal.amount_cents),
+        ], memo=withdrawal.spend_id)
+        withdrawal.status = WithdrawalStatus.COMPLETED
+        withdrawal.transfer_id = str(transfer_id) if transfer_id else None
+        return "WITHDRAWAL_COMPLETED"
+    post_transaction(session, "WITHDRAWAL_REVERSAL", [
+        (withdrawal_account(withdrawal.id), -withdrawal.amount_cents),
+        (user_account(withdrawal.user_id), withdrawal.amount_cents),
+    ], memo=withdrawal.spend_id)
+    withdrawal.status = WithdrawalStatus.FAILED
+    withdrawal.last_error = (error or "")[:250]
+    return "WITHDRAWAL_REVERSED"
+
+def requeue_withdrawal(withdrawal_id, error, needs_review=False):
+    """
+    خطأ مؤقت (شبكة/رصيد التطبيق): يعود للطابور ويعاد بنفس spend_id.
+    needs_review: نتيجة التحويل مجهولة (تكررت الأخطاء أو رفض بعد محاولة بلا رد)،
+    فيحال لفريق المالية (NEEDS_REVIEW) بدل إعادة المحاولة أو إعادة المال تلقائياً.
+    """
+    new_status = WithdrawalStatus.NEEDS_REVIEW if needs_review else WithdrawalStatus.QUEUED
+    session = Session()
+    try:
+        session.query(Withdrawal).filter_by(
+            id=withdrawal_id, status=WithdrawalStatus.PROCESSING
+        ).update({"status": new_status, "last_error": (error or "")[:250]})
+        session.commit()
+    except Exception:
+        session.rollback()
+        _log_failure(f"Error requeueing withdrawal #{withdrawal_id}")
+    finally:
+        session.close()
+
+def get_pending_withdrawals(limit=50, status=WithdrawalStatus.PENDING_APPROVAL):
+    """طلبات السحب الكبيرة التي تنتظر موافقة المالية (أو NEEDS_REVIEW: تنتظر التحقق)"""
+    session = Session()
+    try:
+        rows = (
+            session.query(Withdrawal.id, Withdrawal.user_id, Withdrawal.amount_cents, Withdrawal.created_at,
+                          Withdrawal.attempts, Withdrawal.last_error)
+            .filter_by(status=status)
+            .order_by(Withdrawal.id)
+            .limit(limit)
+            .all()
+        )
+        return [r._asdict() for r in rows]
+    finally:
+        session.close()
+
+def approve_withdrawals(admin_id, withdrawal_ids=None):
+    """
+    موافقة جماعية بتحديث واحد: كل الطلبات المعلقة أو قائمة أرقام محددة.
+    الطلبات المحالة للتحقق (NEEDS_REVIEW) لا تمر من هنا: resolve_reviewed_withdrawal.
+    تعيد عدد الطلبات التي تمت الموافقة عليها.
+    """
+    session = Session()
+    try:
+        stmt = (
+            update(Withdrawal)
+            .where(Withdrawal.status == WithdrawalStatus.PENDING_APPROVAL)
+            .values(status=WithdrawalStatus.QUEUED, approved_by=admin_id, updated_at=datetime.utcnow())
+        )
+        if withdrawal_ids:
+            stmt = stmt.where(Withdrawal.id.in_(withdrawal_ids))
+        approved = session.execute(stmt).rowcount
+        session.commit()
+        if approved:
+            log_audit_event(admin_id, "WITHDRAWALS_APPROVED", 0, f"{approved} withdrawals")
+        return approved
+    except Exception:
+        session.rollback()
+        _log_failure("Error approving withdrawals")
+        return 0
+    finally:
+        session.close()
+
+@retry_on_conflict
+def resolve_reviewed_withdrawal(admin_id, withdrawal_id, decision, note=""):
+    """
+    قرار المالية في طلب NEEDS_REVIEW بعد التحقق من CryptoBot (بالـ spend_id):
+    - "paid": التحويل وصل فعلاً -> مكتمل.
+    - "refund": لم يصل -> FAILED ويعود المبلغ للمحفظة.
+    - "retry": يعاد للطابور بنفس spend_id، وattempts محفوظ (رفض جديد يعيده للتحقق لا للاسترداد).
+    تعيد قاموس النتيجة أو NOT_FOUND / WRONG_STATUS / INVALID / ERROR.
+    """
+    if decision not in ("paid", "refund", "retry"):
+        return Result.INVALID
+    session = Session()
+    try:
+        withdrawal = session.query(Withdrawal).filter_by(id=withdrawal_id).with_for_update().first()
+        if not withdrawal:
+            return Result.NOT_FOUND
+        if withdrawal.status != WithdrawalStatus.NEEDS_REVIEW:
+            return Result.WRONG_STATUS
+
+        if decision == "retry":
+            withdrawal.status = WithdrawalStatus.QUEUED
+            action = "WITHDRAWAL_RETRY_APPROVED"
+        else:
+            action = _settle_withdrawal(session, withdrawal, decision == "paid", error=note or "refunded after review")
+        withdrawal.approved_by = admin_id
+        details = f"Withdrawal #{withdrawal.id} by admin {admin_id}: {note}".strip(": ")
+        _append_audit(session, withdrawal.user_id, action, withdrawal.amount_cents, details)
+        session.commit()
+        return {
+            "status": Result.SUCCESS,
+            "user_id": withdrawal.user_id,
+            "amount": withdrawal.amount_cents / 100.0,
+            "decision": decision,
+        }
+    except Exception:
+        _retry_if_conflict()
+        session.rollback()
+        _log_failure(f"Error resolving withdrawal #{withdrawal_id}")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def get_admin_session(user_id):
+    """صلاحية جلسة الأدمن الفعالة (AdminRole) أو None"""
+    try:
+        role = redis_client.get(f"admin_session:{user_id}")
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+        return None  # بدون Redis نرجع لطلب الـ PIN في كل أمر
+    return AdminRole(role) if role else None
+
+def end_admin_session(user_id):
+    try:
+        redis_client.delete(f"admin_session:{user_id}")
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+
+def _pin_failures(user_id):
+    try:
+        return int(redis_client.get(f"admin_pin_fail:{user_id}") or 0)
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+        return 0
+
+def _record_pin_failure(user_id):
+    """تعيد عدد المحاولات الخاطئة المتتالية (العداد يبدأ من جديد بعد مدة القفل)"""
+    key = f"admin_pin_fail:{user_id}"
+    try:
+        failures = redis_client.incr(key)
+        if failures == 1:
+            redis_client.expire(key, PIN_LOCKOUT_SECONDS)
+        return failures
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+        return 0
+
+def _start_admin_session(user_id, role):
+    try:
+        pipe = redis_client.pipeline()
+        pipe.delete(f"admin_pin_fail:{user_id}")
+        pipe.setex(f"admin_session:{user_id}", ADMIN_SESSION_TTL_SECONDS, role.value)
+        pipe.execute()
+    except Exception:
+        log.warning("Redis error", exc_info=True)
+
+def verify_admin_action(user_id, pin_input=None, required_role=None):
+    """
+    يتحقق من: 
+    1. هل المستخدم أدمن؟ وهل يملك الصلاحية (Role)؟ (من كاش الصلاحيات، بدون قاعدة البيانات)
+    2. جلسة فعالة تغني عن الـ PIN
+    3. هل الدخول مقفل بسبب محاولات خاطئة؟
+    4. هل الـ PIN صحيح؟ (ثم نفتح جلسة)
+    تعيد AUTHORIZED / NOT_ADMIN / NO_PERMISSION / PIN_REQUIRED / LOCKED / WRONG_PIN.
+    دالة متزامنة وبطيئة (bcrypt): من البوت استخدم verify_admin_action_async.
+    """
+    user_id = int(user_id)
+    # الصلاحية تقرأ من الكاش دائماً (لا من الجلسة): سحب الصلاحية يسري فوراً
+    role = permissions.get_role(user_id)
+    if role is None:
+        return Result.NOT_ADMIN
+    if not permissions.role_allows(role, required_role):
+        return Result.NO_PERMISSION
+
+    if get_admin_session(user_id) is not None:
+        return Result.AUTHORIZED
+
+    if not pin_input:
+        return Result.PIN_REQUIRED
+
+    # المقفل لا يصل لـ bcrypt أصلاً: التخمين لا يستهلك المعالج
+    if _pin_failures(user_id) >= PIN_MAX_FAILURES:
+        return Result.LOCKED
+        
+    # التحقق من الـ PIN (2FA)
+    # pin_input يأتي من رسالة التليجرام، pin_hash مخزن في القاعدة (ومنسوخ في الكاش)
+    if not bcrypt.checkpw(pin_input.encode('utf-8'), permissions.get_pin_hash(user_id).encode('utf-8')):
+        log.warning("Wrong admin PIN")
+        if _record_pin_failure(user_id) >= PIN_MAX_FAILURES:
+            return Result.LOCKED
+        return Result.WRONG_PIN
+
+    _start_admin_session(user_id, role)
+    return Result.AUTHORIZED
+
+async def verify_admin_action_async(user_id, pin_input=None, required_role=None):
+    """نفس verify_admin_action لكن في مجمع خيوط الـ PIN (لا توقف باقي المستخدمين)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _pin_check_pool, verify_admin_action, user_id, pin_input, required_role
+    )
+
 def create_initial_admin(user_id, raw_pin):
     """دالة مساعدة لإنشاء أول أدمن (تستخدمها أنت مرة واحدة)"""
     session = Session()
@@ -596,4 +2204,293 @@ def create_initial_admin(user_id, raw_pin):
     admin = Admin(user_id=user_id, role=AdminRole.SUPER_ADMIN, pin_hash=hashed)
     session.merge(admin) # merge تنشئ أو تحدث
     session.commit()
-    session.close()
\ No newline at end of file
+    session.close()
+
+
+# --- الرسائل الصادرة (outbox) ---
+def enqueue_outbound(messages):
+    """
+    تسجيل إشعارات للإرسال (INSERT واحد لكل الدفعة).
+    messages: قائمة قواميس فيها chat_id, kind, text, parse_mode (اختياري).
+    تعيد أرقام الإشعارات، أو [] عند الخطأ.
+    """
+    if not messages:
+        return []
+    session = Session()
+    try:
+        now = datetime.utcnow()
+        ids = session.execute(
+            insert(OutboundMessage).returning(OutboundMessage.id),
+            [
+                {
+                    "chat_id": m["chat_id"],
+                    "kind": m["kind"],
+                    "text": m["text"],
+                    "parse_mode": m.get("parse_mode"),
+                    "status": OutboundStatus.PENDING,
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                    "created_at": now,
+                }
+                for m in messages
+            ],
+        ).scalars().all()
+        session.commit()
+        return list(ids)
+    except Exception:
+        session.rollback()
+        _log_failure("Error enqueueing outbound messages")
+        return []
+    finally:
+        session.close()
+
+def claim_outbound_batch(limit=100):
+    """
+    يحجز دفعة إشعارات حان موعدها (SKIP LOCKED: نسختان من البوت لا ترسلان نفس الإشعار).
+    يعيد قائمة قواميس بترتيب التسجيل.
+    """
+    session = Session()
+    try:
+        now = datetime.utcnow()
+        ready = (
+            select(OutboundMessage.id)
+            .where(
+                ((OutboundMessage.status == OutboundStatus.PENDING) & (OutboundMessage.next_attempt_at <= now))
+                | ((OutboundMessage.status == OutboundStatus.SENDING)
+                   & (OutboundMessage.next_attempt_at < now - OUTBOUND_STUCK_AFTER))
+            )
+            .order_by(OutboundMessage.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        rows = session.execute(
+            update(OutboundMessage)
+            .where(OutboundMessage.id.in_(ready.scalar_subquery()))
+            .values(
+                status=OutboundStatus.SENDING,
+                attempts=OutboundMessage.attempts + 1,
+                next_attempt_at=now,
+            )
+            .returning(OutboundMessage.id, OutboundMessage.chat_id, OutboundMessage.kind,
+                       OutboundMessage.text, OutboundMessage.parse_mode, OutboundMessage.attempts)
+        ).all()
+        session.commit()
+        return sorted((r._asdict() for r in rows), key=lambda r: r["id"])
+    except Exception:
+        session.rollback()
+        _log_failure("Error claiming outbound messages")
+        return []
+    finally:
+        session.close()
+
+def finish_outbound(message_id, status, error=None, telegram_message_id=None, retry_at=None):
+    """
+    نتيجة محاولة الإرسال. retry_at: يعود الإشعار لـ PENDING حتى هذا الموعد
+    (بعد RetryAfter من تليجرام أو خطأ شبكة).
+    """
+    values = {"last_error": (error or "")[:250] or None}
+    if retry_at is not None:
+        values.update(status=OutboundStatus.PENDING, next_attempt_at=retry_at)
+    else:
+        values["status"] = status
+        if status == OutboundStatus.SENT:
+            values.update(sent_at=datetime.utcnow(), telegram_message_id=telegram_message_id)
+    session = Session()
+    try:
+        message = session.query(OutboundMessage).filter_by(
+            id=message_id, status=OutboundStatus.SENDING
+        ).with_for_update().first()
+        if message:
+            for key, value in values.items():
+                setattr(message, key, value)
+            if status == OutboundStatus.BLOCKED and retry_at is None:
+                _mark_users_inactive(session, [message.chat_id])
+        session.commit()
+        return Result.SUCCESS
+    except Exception:
+        session.rollback()
+        _log_failure("Error finishing outbound message")
+        return Result.ERROR
+    finally:
+        session.close()
+
+
+# --- الإعلانات (broadcast) ---
+def _mark_users_inactive(session, user_ids):
+    """من حظر البوت يخرج من الإعلانات القادمة (يعود تلقائياً عند تفاعله من جديد)"""
+    if user_ids:
+        session.query(User).filter(User.id.in_(user_ids), User.is_active.is_(True)).update(
+            {User.is_active: False}, synchronize_session=False
+        )
+
+def _broadcast_snapshot(broadcast):
+    return {
+        "id": broadcast.id,
+        "created_by": broadcast.created_by,
+        "text": broadcast.text,
+        "parse_mode": broadcast.parse_mode,
+        "status": broadcast.status,
+        "last_user_id": broadcast.last_user_id,
+        "total_recipients": broadcast.total_recipients,
+        "sent_count": broadcast.sent_count,
+        "blocked_count": broadcast.blocked_count,
+        "failed_count": broadcast.failed_count,
+        "created_at": broadcast.created_at,
+        "started_at": broadcast.started_at,
+        "finished_at": broadcast.finished_at,
+    }
+
+def _broadcast_recipients_filter():
+    return (User.is_active.is_(True), User.is_banned.is_not(True))
+
+def create_broadcast(admin_id, text, parse_mode=None):
+    """تسجيل إعلان جديد (يرسله broadcast_worker). تعيد صورته أو ERROR"""
+    session = Session()
+    try:
+        total = session.query(func.count(User.id)).filter(*_broadcast_recipients_filter()).scalar()
+        broadcast = Broadcast(
+            created_by=admin_id,
+            text=text,
+            parse_mode=parse_mode,
+            status=BroadcastStatus.PENDING,
+            total_recipients=total or 0,
+        )
+        session.add(broadcast)
+        session.commit()
+        log_audit_event(admin_id, "BROADCAST_CREATED", 0, f"Broadcast #{broadcast.id} to ~{total} users")
+        return _broadcast_snapshot(broadcast)
+    except Exception:
+        session.rollback()
+        _log_failure("Error creating broadcast")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def claim_broadcast():
+    """
+    يأخذ إعلاناً للإرسال: الأقدم المنتظر، أو إعلان RUNNING توقف عامله (لا نبض منذ مدة).
+    SKIP LOCKED: نسختان من البوت لا ترسلان نفس الإعلان. تعيد صورته أو None.
+    """
+    session = Session()
+    try:
+        stale_before = datetime.utcnow() - BROADCAST_STALE_AFTER
+        broadcast = (
+            session.query(Broadcast)
+            .filter(
+                (Broadcast.status == BroadcastStatus.PENDING)
+                | ((Broadcast.status == BroadcastStatus.RUNNING) & (Broadcast.updated_at < stale_before))
+            )
+            .order_by(Broadcast.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if not broadcast:
+            return None
+        broadcast.status = BroadcastStatus.RUNNING
+        broadcast.started_at = broadcast.started_at or datetime.utcnow()
+        broadcast.updated_at = datetime.utcnow()
+        session.commit()
+        return _broadcast_snapshot(broadcast)
+    except Exception:
+        session.rollback()
+        _log_failure("Error claiming broadcast")
+        return None
+    finally:
+        session.close()
+
+def get_broadcast_recipients(after_user_id, limit=1000):
+    """
+    الدفعة التالية من المستلمين بالـ keyset (id > آخر id): كل دفعة بحث في فهرس المفتاح
+    الأساسي مهما تقدم الإعلان، بدون OFFSET يتباطأ مع كل صفحة.
+    """
+    session = Session()
+    try:
+        rows = (
+            session.query(User.id)
+            .filter(User.id > after_user_id, *_broadcast_recipients_filter())
+            .order_by(User.id)
+            .limit(limit)
+            .all()
+        )
+        return [r.id for r in rows]
+    finally:
+        session.close()
+
+def checkpoint_broadcast(broadcast_id, last_user_id, sent, blocked_ids, failed):
+    """
+    نقطة حفظ بعد دفعة كاملة: آخر id + العدادات + إيقاف من حظر البوت، في معاملة واحدة.
+    تعيد حالة الإعلان الحالية (ليتوقف العامل إن ألغي أثناء الإرسال)، أو ERROR.
+    """
+    session = Session()
+    try:
+        broadcast = session.query(Broadcast).filter_by(id=broadcast_id).with_for_update().first()
+        if not broadcast:
+            return Result.NOT_FOUND
+        broadcast.last_user_id = max(broadcast.last_user_id, last_user_id)
+        broadcast.sent_count += sent
+        broadcast.blocked_count += len(blocked_ids)
+        broadcast.failed_count += failed
+        broadcast.updated_at = datetime.utcnow()
+        _mark_users_inactive(session, blocked_ids)
+        session.commit()
+        return broadcast.status
+    except Exception:
+        session.rollback()
+        _log_failure("Error saving broadcast checkpoint")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def finish_broadcast(broadcast_id):
+    """انتهت الدفعات: COMPLETED (إلا إن ألغي). تعيد الصورة النهائية أو None"""
+    session = Session()
+    try:
+        broadcast = session.query(Broadcast).filter_by(id=broadcast_id).with_for_update().first()
+        if not broadcast:
+            return None
+        if broadcast.status == BroadcastStatus.RUNNING:
+            broadcast.status = BroadcastStatus.COMPLETED
+        broadcast.finished_at = datetime.utcnow()
+        session.commit()
+        return _broadcast_snapshot(broadcast)
+    except Exception:
+        session.rollback()
+        _log_failure("Error finishing broadcast")
+        return None
+    finally:
+        session.close()
+
+def cancel_broadcast(broadcast_id):
+    """إيقاف إعلان منتظر أو جارٍ (العامل يتوقف عند نقطة الحفظ التالية)"""
+    session = Session()
+    try:
+        updated = session.query(Broadcast).filter(
+            Broadcast.id == broadcast_id,
+            Broadcast.status.in_([BroadcastStatus.PENDING, BroadcastStatus.RUNNING]),
+        ).update({"status": BroadcastStatus.CANCELLED, "finished_at": datetime.utcnow()})
+        session.commit()
+        return Result.SUCCESS if updated else Result.WRONG_STATUS
+    except Exception:
+        session.rollback()
+        _log_failure("Error cancelling broadcast")
+        return Result.ERROR
+    finally:
+        session.close()
+
+def get_broadcast(broadcast_id=None):
+    """صورة إعلان معين، أو آخر إعلان إن لم يحدد"""
+    session = Session()
+    try:
+        query = session.query(Broadcast)
+        if broadcast_id is not None:
+            broadcast = query.filter_by(id=broadcast_id).first()
+        else:
+            broadcast = query.order_by(Broadcast.id.desc()).first()
+        return _broadcast_snapshot(broadcast) if broadcast else None
+    finally:
+        session.close()
+
+
+# قياس زمن وتتبع كل دالة عامة هنا (يجب أن يبقى في آخر الملف بعد تعريف كل الدوال)
+instrument_db_module(globals())
+trace_db_module(globals())
@@ -0,0 +1,31 @@
+import secrets
+
+# رمز الصفقة العام: يظهر للمستخدمين بدل الرقم التسلسلي (الرقم يبقى داخلياً فقط).
+# Crockford base32 بدون حروف ملتبسة (I L O U)، 12 حرفاً = 60 بت عشوائية:
+# لا يمكن تخمين صفقات الآخرين بالعد 105، 106، 107...
+PUBLIC_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+PUBLIC_ID_LENGTH = 12
+PAY_PREFIX = "pay_"
+
+# ما يكتبه المستخدم خطأً يصحح تلقائياً (كما في مواصفات Crockford)
+_TYPO_FIXES = str.maketrans({"I": "1", "L": "1", "O": "0"})
+
+
+def new_public_id():
+    return "".join(secrets.choice(PUBLIC_ID_ALPHABET) for _ in range(PUBLIC_ID_LENGTH))
+
+
+def normalize_public_id(text):
+    """
+    الرمز كما يخزن (أحرف كبيرة بدون #)، أو None إذا لم يكن رمزاً صالحاً.
+    الرمز غير الصالح يرفض هنا قبل أن يصل لقاعدة البيانات.
+    """
+    code = (text or "").strip().lstrip("#").upper().translate(_TYPO_FIXES)
+    if len(code) != PUBLIC_ID_LENGTH or any(c not in PUBLIC_ID_ALPHABET for c in code):
+        return None
+    return code
+
+
+def deal_pay_link(bot_username, public_id):
+    """رابط يفتح شاشة الدفع مباشرة: t.me/<bot>?start=pay_<رمز الصفقة>"""
+    return f"https://t.me/{bot_username}?start={PAY_PREFIX}{public_id}"
@@ -0,0 +1,135 @@
+import os
+import io
+import asyncio
+import hashlib
+import logging
+from telegram.error import BadRequest
+from db_services import get_unarchived_evidence, save_evidence_files
+
+log = logging.getLogger(__name__)
+
+# Pillow اختياري: بدونه نحفظ الصور الأصلية فقط بدون مصغرات
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# المجلد الجذر للتخزين حسب البصمة: evidence_store/ab/cd/abcd....jpg
+EVIDENCE_DIR = os.getenv("EVIDENCE_DIR", "evidence_store")
+# أقصى عدد تحميلات متزامنة من تليجرام (حتى لا نضغط على الـ API)
+FETCH_CONCURRENCY = int(os.getenv("EVIDENCE_FETCH_CONCURRENCY", "4"))
+ARCHIVE_BATCH = int(os.getenv("EVIDENCE_ARCHIVE_BATCH", "50"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("EVIDENCE_ARCHIVE_INTERVAL", "30"))
+THUMB_SIZE = (320, 320)
+
+
+def evidence_path(sha256, suffix=".jpg"):
+    """المسار المحلي لملف حسب بصمته (مجلدان فرعيان لتوزيع الملفات)"""
+    return os.path.join(EVIDENCE_DIR, sha256[:2], sha256[2:4], f"{sha256}{suffix}")
+
+
+def _write_atomic(path, data):
+    """نكتب في ملف مؤقت ثم نعيد تسميته، فلا يرى أحد ملفاً نصف مكتوب"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _make_thumbnail(data, thumb_path):
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail(THUMB_SIZE)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=80)
+        _write_atomic(thumb_path, buf.getvalue())
+        return thumb_path
+    except Exception:
+        log.warning("Thumbnail error", extra={"path": thumb_path}, exc_info=True)
+        return None
+
+
+def store_evidence_blob(data):
+    """
+    يحفظ الملف حسب بصمته SHA-256.
+    إذا كانت الصورة موجودة مسبقاً (نفس البصمة) لا نكتبها مرة أخرى.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = evidence_path(sha256)
+    thumb_path = evidence_path(sha256, "_thumb.jpg")
+
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    if not os.path.exists(thumb_path):
+        thumb_path = _make_thumbnail(data, thumb_path)
+
+    return sha256, path, thumb_path
+
+
+class EvidenceArchiver:
+    """
+    عامل خلفي ينسخ صور الأدلة من تليجرام إلى التخزين المحلي.
+    يعمل بدفعات، وعدد التحميلات المتزامنة محدود بـ Semaphore.
+    """
+
+    def __init__(self, bot, concurrency=FETCH_CONCURRENCY):
+        self.bot = bot
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def archive_one(self, item):
+        async with self._semaphore:
+            try:
+                tg_file = await self.bot.get_file(item["file_id"])
+                data = bytes(await tg_file.download_as_bytearray())
+            except BadRequest as e:
+                # file_id لم يعد صالحاً: نسجل الفشل حتى لا نعيد المحاولة للأبد
+                return {"message_log_id": item["message_log_id"], "error": str(e)[:250]}
+            except Exception:
+                # خطأ شبكة مؤقت: نتركه للدورة القادمة
+                log.warning(
+                    "Evidence fetch failed",
+                    extra={"message_log_id": item["message_log_id"]},
+                    exc_info=True,
+                )
+                return None
+
+        # الكتابة على القرص والتصغير عمل متزامن، نخرجه من حلقة الأحداث
+        sha256, path, thumb_path = await asyncio.to_thread(store_evidence_blob, data)
+        return {
+            "message_log_id": item["message_log_id"],
+            "sha256": sha256,
+            "path": path,
+            "thumb_path": thumb_path,
+            "size_bytes": len(data),
+        }
+
+    async def run_once(self):
+        """دفعة واحدة: تعيد عدد السجلات التي تمت معالجتها"""
+        items = await asyncio.to_thread(get_unarchived_evidence, ARCHIVE_BATCH)
+        if not items:
+            return 0
+
+        results = await asyncio.gather(*(self.archive_one(item) for item in items))
+        rows = [r for r in results if r]
+        # الأعمدة يجب أن تكون موحدة في الإدخال الجماعي
+        for r in rows:
+            for key in ("sha256", "path", "thumb_path", "error"):
+                r.setdefault(key, None)
+            r.setdefault("size_bytes", 0)
+
+        await asyncio.to_thread(save_evidence_files, rows)
+        return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                done = await self.run_once()
+            except Exception:
+                log.exception("Evidence archiver error")
+                done = 0
+            # لو الدفعة كانت ممتلئة غالباً يوجد المزيد، نكمل فوراً
+            if done < ARCHIVE_BATCH:
+                await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
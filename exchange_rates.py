@@ -0,0 +1,38 @@
+import os
+import asyncio
+import logging
+from assets import ASSET_DECIMALS
+from db_services import save_rate_snapshot
+from payment_services import get_exchange_rates
+
+log = logging.getLogger(__name__)
+
+# كل كم ثانية نجلب الأسعار من CryptoBot (أقل بكثير من صلاحية اللقطة RATES_TTL_SECONDS)
+RATES_REFRESH_SECONDS = int(os.getenv("RATES_REFRESH_SECONDS", "60"))
+
+
+async def refresh_rates():
+    """
+    طلب واحد لـ CryptoBot يحدث لقطة الأسعار لكل العملات المدعومة (سعر كل عملة بالدولار).
+    تعيد عدد العملات التي تم تحديثها.
+    """
+    rates = await get_exchange_rates()
+    snapshot = {
+        r.source: str(r.rate)
+        for r in rates
+        if r.is_valid and r.target == "USD" and r.source in ASSET_DECIMALS
+    }
+    if snapshot:
+        await asyncio.to_thread(save_rate_snapshot, snapshot)
+    return len(snapshot)
+
+
+async def rates_refresher():
+    """حلقة خلفية: الطلبات لا تنتظر API الأسعار أبداً، بل تقرأ آخر لقطة من Redis"""
+    while True:
+        try:
+            await refresh_rates()
+        except Exception:
+            # لو تعطل التحديث تنتهي صلاحية اللقطة ويرفض التحويل (بدل سعر قديم)
+            log.exception("Rates refresh error")
+        await asyncio.sleep(RATES_REFRESH_SECONDS)
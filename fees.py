@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+from decimal import Decimal, ROUND_HALF_UP
+
+log = logging.getLogger(__name__)
+
+# جدول العمولات الافتراضي.
+# - tiers: مستوى البائع حسب عدد صفقاته المكتملة (أقل عدد للدخول في المستوى)
+# - bands: لكل مستوى شرائح حسب مبلغ الصفقة بالسنت: [بداية الشريحة، النسبة بنقاط الأساس (bps)]
+#   (500 bps = 5%)
+# - min_fee_cents: أقل عمولة تؤخذ من أي صفقة
+DEFAULT_FEE_SCHEDULE = {
+    "tiers": {"standard": 0, "trusted": 25, "pro": 200},
+    "bands": {
+        "standard": [[0, 500], [50000, 400], [500000, 300]],
+        "trusted": [[0, 400], [50000, 300], [500000, 250]],
+        "pro": [[0, 300], [50000, 250], [500000, 200]],
+    },
+    "min_fee_cents": 10,
+}
+
+
+def load_fee_schedule():
+    """
+    الجدول من متغير البيئة FEE_SCHEDULE (JSON بنفس شكل DEFAULT_FEE_SCHEDULE)
+    أو الجدول الافتراضي. المفاتيح الناقصة تؤخذ من الافتراضي.
+    """
+    raw = os.getenv("FEE_SCHEDULE")
+    if not raw:
+        return DEFAULT_FEE_SCHEDULE
+    try:
+        return {**DEFAULT_FEE_SCHEDULE, **json.loads(raw)}
+    except ValueError:
+        log.warning("Invalid FEE_SCHEDULE, using default", exc_info=True)
+        return DEFAULT_FEE_SCHEDULE
+
+
+FEE_SCHEDULE = load_fee_schedule()
+
+
+def fee_tier_for(completed_deals, schedule=FEE_SCHEDULE):
+    """أعلى مستوى وصل إليه البائع"""
+    tier = None
+    threshold = -1
+    for name, min_deals in schedule["tiers"].items():
+        if (completed_deals or 0) >= min_deals > threshold:
+            tier, threshold = name, min_deals
+    return tier
+
+
+def calculate_fee(amount_cents, tier, schedule=FEE_SCHEDULE):
+    """
+    الدالة الوحيدة لحساب العمولة.
+    تعيد (العمولة بالسنت، النسبة المطبقة bps). العمولة لا تتجاوز مبلغ الصفقة.
+    """
+    bands = schedule["bands"].get(tier) or schedule["bands"][fee_tier_for(0, schedule)]
+    rate_bps = 0
+    for band_start, band_rate in sorted(bands):
+        if amount_cents >= band_start:
+            rate_bps = band_rate
+
+    fee = (Decimal(amount_cents) * rate_bps / 10000).to_integral_value(rounding=ROUND_HALF_UP)
+    fee_cents = max(int(fee), schedule.get("min_fee_cents", 0))
+    return min(fee_cents, amount_cents), rate_bps
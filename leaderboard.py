@@ -0,0 +1,140 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from db_services import redis_client, get_seller_stats_changed_since, get_global_rating_mean
+
+log = logging.getLogger(__name__)
+
+# مفاتيح Redis
+LEADERBOARD_KEY = "leaderboard:sellers"      # Sorted Set: seller_id -> score
+NAMES_KEY = "leaderboard:names"              # Hash: seller_id -> الاسم
+STATS_KEY = "leaderboard:stats"              # Hash: seller_id -> "avg|count|completed"
+WATERMARK_KEY = "leaderboard:watermark"      # آخر (updated_at|seller_id) تمت معالجته
+PRIOR_MEAN_KEY = "leaderboard:prior_mean"
+
+# الترتيب البايزي: كأن كل بائع يبدأ بـ PRIOR_WEIGHT تقييمات بمتوسط المنصة،
+# فلا يتصدر بائع بتقييم 5 واحد على بائع بمئة تقييم متوسطها 4.8
+PRIOR_WEIGHT = int(os.getenv("LEADERBOARD_PRIOR_WEIGHT", "10"))
+DEFAULT_PRIOR_MEAN = 4.0
+# وزن حجم التعامل: كل مضاعفة ×10 في الصفقات المكتملة تضيف هذا المقدار للنتيجة
+VOLUME_WEIGHT = float(os.getenv("LEADERBOARD_VOLUME_WEIGHT", "0.5"))
+
+REFRESH_INTERVAL_SECONDS = int(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "60"))
+FULL_REBUILD_SECONDS = int(os.getenv("LEADERBOARD_FULL_REBUILD", str(6 * 3600)))
+PAGE_SIZE = 500
+# updated_at يكتب قبل commit: صف بوقت أقدم من العلامة قد يظهر بعد قراءتها،
+# فكل تحديث تدريجي يعيد قراءة هذه المدة قبل العلامة (إعادة zadd لنفس البائع لا تضر)
+IN_FLIGHT_MARGIN = timedelta(minutes=5)
+
+
+def seller_score(reviews_count, stars_sum, completed_deals, prior_mean):
+    bayes = (PRIOR_WEIGHT * prior_mean + stars_sum) / (PRIOR_WEIGHT + reviews_count)
+    return round(bayes + VOLUME_WEIGHT * math.log10(1 + completed_deals), 6)
+
+
+def _apply_page(pipe, key, rows, prior_mean):
+    for r in rows:
+        score = seller_score(r["reviews_count"], r["stars_sum"], r["completed_deals"], prior_mean)
+        avg = r["stars_sum"] / r["reviews_count"] if r["reviews_count"] else 0
+        pipe.zadd(key, {r["seller_id"]: score})
+        pipe.hset(NAMES_KEY, r["seller_id"], r["full_name"] or "")
+        pipe.hset(STATS_KEY, r["seller_id"], f"{avg:.2f}|{r['reviews_count']}|{r['completed_deals']}")
+
+
+def refresh_leaderboard(full=False):
+    """
+    تحديث الترتيب في Redis.
+    - تدريجي (الافتراضي): نقرأ فقط البائعين الذين تغيرت إحصائياتهم بعد آخر علامة.
+    - كامل: نبني مفتاحاً جديداً ثم نستبدله دفعة واحدة (RENAME) لتحديث المتوسط العام للجميع.
+    تعيد عدد البائعين الذين تم تحديثهم.
+    """
+    if full:
+        prior_mean = get_global_rating_mean() or DEFAULT_PRIOR_MEAN
+        redis_client.set(PRIOR_MEAN_KEY, prior_mean)
+        target_key = f"{LEADERBOARD_KEY}:building"
+        redis_client.delete(target_key)
+        after_time, after_id = None, 0
+    else:
+        prior_mean = float(redis_client.get(PRIOR_MEAN_KEY) or DEFAULT_PRIOR_MEAN)
+        target_key = LEADERBOARD_KEY
+        after_time, after_id = None, 0
+        watermark = redis_client.get(WATERMARK_KEY)
+        if watermark:
+            raw_time, _ = watermark.split("|")
+            after_time = datetime.fromisoformat(raw_time) - IN_FLIGHT_MARGIN
+
+    updated = 0
+    while True:
+        rows = get_seller_stats_changed_since(after_time, after_id, PAGE_SIZE)
+        if not rows:
+            break
+        pipe = redis_client.pipeline()
+        _apply_page(pipe, target_key, rows, prior_mean)
+        last = rows[-1]
+        after_time, after_id = last["updated_at"], last["seller_id"]
+        pipe.set(WATERMARK_KEY, f"{after_time.isoformat()}|{after_id}")
+        pipe.execute()
+        updated += len(rows)
+        if len(rows) < PAGE_SIZE:
+            break
+
+    if full and updated:
+        redis_client.rename(target_key, LEADERBOARD_KEY)
+    return updated
+
+
+def get_top_sellers(limit=10):
+    """أفضل N بائع: O(log n + N) من الـ Sorted Set"""
+    entries = redis_client.zrevrange(LEADERBOARD_KEY, 0, limit - 1, withscores=True)
+    if not entries:
+        return []
+    ids = [seller_id for seller_id, _ in entries]
+    names = redis_client.hmget(NAMES_KEY, ids)
+    stats = redis_client.hmget(STATS_KEY, ids)
+
+    results = []
+    for rank, ((seller_id, score), name, stat) in enumerate(zip(entries, names, stats), start=1):
+        avg, count, completed = (stat or "0|0|0").split("|")
+        results.append({
+            "rank": rank,
+            "seller_id": int(seller_id),
+            "name": name or "مستخدم",
+            "score": score,
+            "avg": float(avg),
+            "reviews": int(count),
+            "completed": int(completed),
+        })
+    return results
+
+
+def get_seller_rank(seller_id):
+    """ترتيب بائع معين (يبدأ من 1) أو None إذا لم يكن في القائمة: O(log n)"""
+    rank = redis_client.zrevrank(LEADERBOARD_KEY, seller_id)
+    return rank + 1 if rank is not None else None
+
+
+def search_top_sellers(text, limit=10, scan=200):
+    """بحث بالاسم داخل أفضل 'scan' بائع (للبحث المضمن Inline)"""
+    text = (text or "").strip().lower()
+    sellers = get_top_sellers(scan)
+    if text:
+        sellers = [s for s in sellers if text in s["name"].lower()]
+    return sellers[:limit]
+
+
+async def leaderboard_refresher():
+    """حلقة خلفية: تحديث تدريجي كل دقيقة، وبناء كامل كل بضع ساعات"""
+    last_full = 0
+    while True:
+        try:
+            full = time.time() - last_full > FULL_REBUILD_SECONDS
+            # الاستعلامات متزامنة، فنخرجها من حلقة الأحداث
+            await asyncio.to_thread(refresh_leaderboard, full)
+            if full:
+                last_full = time.time()
+        except Exception:
+            log.exception("Leaderboard refresh error")
+        await asyncio.sleep(REFRESH_INTERVAL_SECONDS)
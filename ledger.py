@@ -0,0 +1,339 @@
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta
+from collections import defaultdict
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import Session, User, UserBalance, LedgerAccount, JournalEntry, LedgerSnapshot, AccountType
+from assets import BASE_ASSET
+
+log = logging.getLogger(__name__)
+
+# كل كم قيد نأخذ لقطة للحساب (يحدد أقصى طول للذيل عند حساب رصيد تاريخي)
+SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "500"))
+
+FEE_ACCOUNT_KEY = "fee:platform"
+EXTERNAL_ACCOUNT_KEY = "external:cryptobot"
+EQUITY_ACCOUNT_KEY = "equity:opening"
+
+
+def _asset_key(key, asset):
+    """حسابات العملة الأساسية تبقى بمفاتيحها القديمة، والعملات الأخرى تضاف للمفتاح"""
+    return key if asset == BASE_ASSET else f"{key}:{asset}"
+
+
+# --- تعريف الحسابات (مواصفات تُمرر لـ post_transaction) ---
+def user_account(user_id, asset=BASE_ASSET):
+    return {
+        "key": _asset_key(f"user:{user_id}", asset),
+        "type": AccountType.USER,
+        "user_id": user_id,
+        "asset": asset,
+    }
+
+
+def escrow_account(deal_id, opening_cents=0, asset=BASE_ASSET, milestone_id=None):
+    """
+    opening_cents: لصفقات دُفعت قبل تفعيل الدفتر، المال محجوز فعلاً
+    لكن لا يوجد له حساب، فنفتحه برصيد افتتاحي.
+    (عملة الحساب هي عملة الصفقة، والمفتاح لا يتغير لأن الصفقة بعملة واحدة)
+    milestone_id: صفقات المراحل لها حساب ضمان لكل مرحلة
+    """
+    key = f"escrow:deal:{deal_id}"
+    if milestone_id is not None:
+        key = f"{key}:m{milestone_id}"
+    return {
+        "key": key,
+        "type": AccountType.ESCROW,
+        "deal_id": deal_id,
+        "opening_cents": opening_cents,
+        "asset": asset,
+    }
+
+
+def fee_account(asset=BASE_ASSET):
+    return {"key": _asset_key(FEE_ACCOUNT_KEY, asset), "type": AccountType.FEE, "asset": asset}
+
+
+def external_account(asset=BASE_ASSET):
+    return {"key": _asset_key(EXTERNAL_ACCOUNT_KEY, asset), "type": AccountType.EXTERNAL, "asset": asset}
+
+
+def exchange_account(asset):
+    """
+    حساب الصرف لعملة معينة: في التحويل يدخل فيه ما دفعه المستخدم بعملته
+    ويخرج منه المقابل بالعملة الأخرى، فيبقى كل قيد متوازناً داخل كل عملة.
+    رصيده = مركز المنصة المفتوح في هذه العملة.
+    """
+    return {"key": f"exchange:{asset}", "type": AccountType.EXCHANGE, "asset": asset}
+
+
+def withdrawal_account(withdrawal_id):
+    """حجز خاص بطلب سحب واحد (مثل حساب الضمان للصفقة)"""
+    return {
+        "key": f"withdrawal:{withdrawal_id}",
+        "type": AccountType.WITHDRAWAL,
+    }
+
+
+def _equity_account():
+    return {"key": EQUITY_ACCOUNT_KEY, "type": AccountType.EQUITY}
+
+
+# حسابات المنصة المشتركة: كل إيداع/تحرير/تحويل يمر بنفس الصف، فقفله وتحديث رصيده
+# يجعل كل العمليات المالية متتابعة (وتتعارض تحت SERIALIZABLE). هذه الحسابات تسجل
+# قيودها فقط بدون رصيد جارٍ، ورصيدها = آخر لقطة + ذيل القيود (get_balance_at).
+POOLED_TYPES = {AccountType.EXTERNAL, AccountType.FEE, AccountType.EXCHANGE, AccountType.EQUITY}
+# لقطات الحسابات المشتركة تشمل فقط القيود الأقدم من هذا: قيد بـ id أصغر قد يكون
+# في معاملة لم تنته بعد، ولو أخذت اللقطة فوقه لسقط من الرصيد نهائياً
+POOLED_SNAPSHOT_MARGIN = timedelta(minutes=5)
+
+
+# --- المحرك ---
+def _lock_account(session, spec):
+    """
+    يجلب الحساب مع قفله (FOR UPDATE)، وينشئه إن لم يوجد.
+    الحسابات المشتركة (POOLED_TYPES) لا تقفل: لا نعدل صفها أبداً.
+    تعيد (الحساب، هل أنشئ الآن؟)
+    """
+    pooled = spec["type"] in POOLED_TYPES
+    query = session.query(LedgerAccount).filter_by(account_key=spec["key"])
+    account = (query if pooled else query.with_for_update()).first()
+    if account:
+        return account, False
+
+    created = session.execute(
+        pg_insert(LedgerAccount)
+        .values(
+            account_key=spec["key"],
+            account_type=spec["type"],
+            user_id=spec.get("user_id"),
+            deal_id=spec.get("deal_id"),
+            asset=spec.get("asset", BASE_ASSET),
+            balance_cents=0,
+            entries_since_snapshot=0,
+        )
+        .on_conflict_do_nothing(index_elements=[LedgerAccount.account_key])
+        .returning(LedgerAccount.id)
+    ).first()
+
+    account = (query if pooled else query.with_for_update()).first()
+    return account, created is not None
+
+
+def _opening_balance(session, spec):
+    """الرصيد الموجود فعلاً قبل أن يكون للحساب سجل في الدفتر"""
+    if spec["type"] == AccountType.USER:
+        if spec.get("asset", BASE_ASSET) != BASE_ASSET:
+            return 0  # الأرصدة بالعملات الأخرى بدأت مع الدفتر
+        return (
+            session.query(User.balance_cents)
+            .filter_by(id=spec["user_id"])
+            .with_for_update()
+            .scalar()
+        ) or 0
+    return spec.get("opening_cents", 0)
+
+
+def _append(session, txn_id, account, amount_cents, entry_type, deal_id, memo, mirror=True):
+    entry = JournalEntry(
+        transaction_id=txn_id,
+        account_id=account.id,
+        amount_cents=amount_cents,
+        entry_type=entry_type,
+        deal_id=deal_id,
+        memo=memo,
+    )
+    session.add(entry)
+    if account.account_type in POOLED_TYPES:
+        return entry
+    account.balance_cents += amount_cents
+    account.entries_since_snapshot += 1
+
+    # محفظة المستخدم تنعكس في users.balance_cents (الرقم الذي يراه البوت)
+    # أو في user_balances للعملات الأخرى
+    if mirror and account.account_type == AccountType.USER:
+        if account.asset == BASE_ASSET:
+            session.query(User).filter_by(id=account.user_id).update(
+                {User.balance_cents: User.balance_cents + amount_cents},
+                synchronize_session="evaluate",
+            )
+        else:
+            stmt = pg_insert(UserBalance).values(
+                user_id=account.user_id, asset=account.asset, amount_units=amount_cents
+            )
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[UserBalance.user_id, UserBalance.asset],
+                set_={
+                    "amount_units": UserBalance.amount_units + amount_cents,
+                    "updated_at": datetime.utcnow(),
+                },
+            ))
+    return entry
+
+
+def post_transaction(session, entry_type, legs, deal_id=None, memo=None, txn_id=None):
+    """
+    تسجيل عملية مالية بالقيد المزدوج داخل معاملة المستدعي (لا تعمل commit).
+    legs: قائمة (مواصفات الحساب، المبلغ بأصغر وحدة لعملته)،
+    ومجموع المبالغ يجب أن يكون صفراً داخل كل عملة على حدة.
+    txn_id: معرف ثابت للعملية (مثلاً مشتق من رقم الفاتورة) لمنع تسجيلها مرتين.
+    تعيد transaction_id.
+    """
+    per_asset = defaultdict(int)
+    for spec, amount in legs:
+        per_asset[spec.get("asset", BASE_ASSET)] += amount
+    if any(per_asset.values()):
+        raise ValueError(f"Unbalanced ledger transaction: {legs}")
+
+    # نقفل الحسابات بترتيب ثابت (حسب المفتاح) لتجنب الـ Deadlock
+    specs = {spec["key"]: spec for spec, _ in legs}
+    accounts = {}
+    new_entries = []
+    for key in sorted(specs):
+        account, created = _lock_account(session, specs[key])
+        accounts[key] = account
+        if created:
+            opening = _opening_balance(session, specs[key])
+            if opening:
+                equity, _ = _lock_account(session, _equity_account())
+                opening_txn = str(uuid.uuid4())
+                new_entries.append(_append(session, opening_txn, account, opening, "OPENING", deal_id, key, mirror=False))
+                new_entries.append(_append(session, opening_txn, equity, -opening, "OPENING", deal_id, key))
+                accounts[EQUITY_ACCOUNT_KEY] = equity
+
+    txn_id = txn_id or str(uuid.uuid4())
+    for spec, amount in legs:
+        if amount:
+            new_entries.append(
+                _append(session, txn_id, accounts[spec["key"]], amount, entry_type, deal_id, memo)
+            )
+
+    # لقطة لكل حساب تجاوز عدد القيود المحدد منذ آخر لقطة
+    session.flush()
+    for account in accounts.values():
+        if account.entries_since_snapshot >= SNAPSHOT_EVERY:
+            last_entry_id = max(e.id for e in new_entries if e.account_id == account.id)
+            _take_snapshot(session, account, last_entry_id)
+
+    return txn_id
+
+
+def _take_snapshot(session, account, last_entry_id):
+    session.add(
+        LedgerSnapshot(
+            account_id=account.id,
+            last_entry_id=last_entry_id,
+            balance_cents=account.balance_cents,
+        )
+    )
+    account.entries_since_snapshot = 0
+
+
+def transaction_exists(session, txn_id):
+    return session.query(JournalEntry.id).filter_by(transaction_id=txn_id).first() is not None
+
+
+def _snapshot_pooled(session, account):
+    """لقطة حساب مشترك = اللقطة السابقة + قيوده بعدها حتى هامش القيود الجارية"""
+    previous = (
+        session.query(LedgerSnapshot)
+        .filter_by(account_id=account.id)
+        .order_by(LedgerSnapshot.last_entry_id.desc())
+        .first()
+    )
+    after_entry_id = previous.last_entry_id if previous else 0
+    tail_cents, last_entry_id = (
+        session.query(func.coalesce(func.sum(JournalEntry.amount_cents), 0), func.max(JournalEntry.id))
+        .filter(
+            JournalEntry.account_id == account.id,
+            JournalEntry.id > after_entry_id,
+            JournalEntry.created_at < datetime.utcnow() - POOLED_SNAPSHOT_MARGIN,
+        )
+        .one()
+    )
+    if not last_entry_id:
+        return False
+    session.add(
+        LedgerSnapshot(
+            account_id=account.id,
+            last_entry_id=last_entry_id,
+            balance_cents=(previous.balance_cents if previous else 0) + int(tail_cents),
+        )
+    )
+    return True
+
+
+def take_ledger_snapshots():
+    """
+    مهمة دورية (مثلاً كل ليلة): لقطة لكل حساب عليه قيود جديدة منذ آخر لقطة.
+    """
+    session = Session()
+    try:
+        accounts = (
+            session.query(LedgerAccount)
+            .filter(LedgerAccount.entries_since_snapshot > 0)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for account in accounts:
+            last_entry_id = (
+                session.query(func.max(JournalEntry.id))
+                .filter_by(account_id=account.id)
+                .scalar()
+            )
+            if last_entry_id:
+                _take_snapshot(session, account, last_entry_id)
+        pooled = (
+            session.query(LedgerAccount)
+            .filter(LedgerAccount.account_type.in_(POOLED_TYPES))
+            .all()
+        )
+        taken = sum(_snapshot_pooled(session, account) for account in pooled)
+        session.commit()
+        return len(accounts) + taken
+    except Exception:
+        session.rollback()
+        log.exception("Ledger snapshot error")
+        return 0
+    finally:
+        session.close()
+
+
+def get_balance_at(account_key, at_time=None):
+    """
+    رصيد حساب في لحظة معينة (أو الآن):
+    أقرب لقطة قبل اللحظة + مجموع القيود بعدها (ذيل محدود بـ SNAPSHOT_EVERY تقريباً).
+    """
+    at_time = at_time or datetime.utcnow()
+    session = Session()
+    try:
+        account = session.query(LedgerAccount).filter_by(account_key=account_key).first()
+        if not account:
+            return None
+
+        snapshot = (
+            session.query(LedgerSnapshot)
+            .filter(
+                LedgerSnapshot.account_id == account.id,
+                LedgerSnapshot.taken_at <= at_time,
+            )
+            .order_by(LedgerSnapshot.last_entry_id.desc())
+            .first()
+        )
+        base_cents = snapshot.balance_cents if snapshot else 0
+        after_entry_id = snapshot.last_entry_id if snapshot else 0
+
+        tail_cents = (
+            session.query(func.coalesce(func.sum(JournalEntry.amount_cents), 0))
+            .filter(
+                JournalEntry.account_id == account.id,
+                JournalEntry.id > after_entry_id,
+                JournalEntry.created_at <= at_time,
+            )
+            .scalar()
+        )
+        return base_cents + int(tail_cents)
+    finally:
+        session.close()
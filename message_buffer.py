@@ -0,0 +1,208 @@
+import os
+import json
+import glob
+import time
+import asyncio
+import logging
+from datetime import datetime
+from db_services import save_message_logs_bulk
+
+log = logging.getLogger(__name__)
+
+# مكان ملفات الـ Write-Ahead (كل ملف = مقطع من الرسائل لم يصل للقاعدة بعد)
+WAL_DIR = os.getenv("MESSAGE_WAL_DIR", "message_wal")
+# نكتب للقاعدة كل N رسالة أو كل M ملي ثانية (أيهما أسبق)
+FLUSH_EVERY = int(os.getenv("MESSAGE_FLUSH_EVERY", "50"))
+FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "500"))
+# بعد هذا العدد من الدفعات الفاشلة المتتالية ندخل الأسطر واحداً واحداً ونعزل ما يفشل منها
+MAX_FLUSH_ATTEMPTS = int(os.getenv("MESSAGE_FLUSH_MAX_ATTEMPTS", "5"))
+# لا يطابق segment-*.jsonl: لا يعاد تحميله عند التشغيل، يراجع يدوياً
+DEAD_LETTER_FILE = "dead-letter.jsonl"
+
+
+def _db_row(row):
+    return {**row, "created_at": datetime.fromisoformat(row["created_at"])}
+
+
+def _sync_and_close(f):
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+class MessageLogBuffer:
+    """
+    مخزن مؤقت لأدلة المحادثات (message_logs):
+    1. كل رسالة تكتب أولاً في ملف WAL (write + flush) فلا تضيع لو توقف البوت فجأة.
+       fsync واحد لكل الرسائل مع كل دفعة (Group Commit) في Thread، لا fsync لكل رسالة
+       داخل حلقة الأحداث: انقطاع الكهرباء نفسه قد يفقد آخر flush_interval فقط.
+    2. ثم تتجمع في الذاكرة وتدخل القاعدة دفعة واحدة (Bulk INSERT).
+    3. بعد نجاح الإدخال فقط نحذف ملفات الـ WAL الخاصة بها.
+    4. سطر يفشل الدفعة كل مرة (صفقة حذفت مثلاً) ينقل لملف dead-letter بدل أن يوقف كل ما بعده.
+    بهذا لا ينتظر المستخدم commit في القاعدة مع كل رسالة.
+    """
+
+    def __init__(self, wal_dir=WAL_DIR, flush_every=FLUSH_EVERY, flush_interval_ms=FLUSH_INTERVAL_MS):
+        self.wal_dir = wal_dir
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval_ms / 1000.0
+
+        self._rows = []             # رسائل المقطع الحالي (المفتوح)
+        self._wal = None            # ملف المقطع الحالي
+        self._wal_path = None
+        self._closed_rows = []      # رسائل مقاطع مغلقة تنتظر الإدخال
+        self._closed_segments = []  # مسارات تلك المقاطع (نحذفها بعد النجاح)
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._failures = 0          # دفعات فاشلة متتالية
+
+    # --- إدارة الملفات ---
+    def _open_segment(self):
+        os.makedirs(self.wal_dir, exist_ok=True)
+        self._wal_path = os.path.join(self.wal_dir, f"segment-{time.time_ns()}.jsonl")
+        self._wal = open(self._wal_path, "a", encoding="utf-8")
+
+    def _rotate(self):
+        """
+        ننقل المقطع الحالي لقائمة المقاطع المنتظرة ونفتح مقطعاً جديداً.
+        تعيد ملف المقطع القديم مفتوحاً: المستدعي يعمل له fsync ثم يغلقه.
+        """
+        old = self._wal
+        self._closed_segments.append(self._wal_path)
+        self._closed_rows.extend(self._rows)
+        self._rows = []
+        self._open_segment()
+        return old
+
+    def recover(self):
+        """
+        عند التشغيل: أي مقطع موجود على القرص لم يدخل القاعدة (توقف مفاجئ).
+        نقرؤه ونضعه في طابور الإدخال.
+        ملاحظة: لو حصل التوقف بعد الـ commit وقبل الحذف قد يتكرر سطر (At-least-once)،
+        وهذا أفضل من ضياع دليل.
+        """
+        os.makedirs(self.wal_dir, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(self.wal_dir, "segment-*.jsonl"))):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self._closed_rows.append(json.loads(line))
+                    except ValueError:
+                        # سطر ناقص (انقطع أثناء الكتابة) لا يمكن استعادته
+                        log.warning("WAL: corrupt line skipped", extra={"path": path})
+            self._closed_segments.append(path)
+
+        if self._closed_rows:
+            log.info("WAL: recovered unsaved messages", extra={"count": len(self._closed_rows)})
+        self._open_segment()
+
+    # --- الواجهة ---
+    def add(self, deal_id, sender_id, text=None, file_id=None):
+        """تسجيل رسالة كدليل (بدون أي اتصال بالقاعدة)"""
+        if self._wal is None:
+            self.recover()
+
+        row = {
+            "deal_id": deal_id,
+            "sender_id": sender_id,
+            "message_text": text,
+            "file_id": file_id,
+            "is_image": file_id is not None,  # إذا وجد ملف، فهي صورة
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        self._wal.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._wal.flush()  # في ذاكرة النظام: ينجو من توقف البوت، وfsync مع الدفعة
+
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_every:
+            self._wakeup.set()
+
+    async def flush(self):
+        """إدخال كل ما في الذاكرة للقاعدة دفعة واحدة"""
+        async with self._flush_lock:
+            if self._rows:
+                # نبدل المقطع أولاً ثم fsync للقديم (Group Commit): ما يضيفه add أثناء
+                # انتظار fsync يذهب للمقطع الجديد، فلا يدخل القاعدة سطر لم يثبت على القرص
+                old = self._rotate()
+                await asyncio.to_thread(_sync_and_close, old)
+            if not self._closed_rows:
+                return
+
+            rows = [_db_row(r) for r in self._closed_rows]
+            # الإدخال متزامن (SQLAlchemy) فنشغله في Thread حتى لا نوقف البوت
+            saved = await asyncio.to_thread(save_message_logs_bulk, rows)
+            if not saved:
+                self._failures += 1
+                if self._failures < MAX_FLUSH_ATTEMPTS:
+                    return  # نحاول في الدورة القادمة، الملفات ما زالت على القرص
+                if not await self._insert_one_by_one():
+                    # القاعدة نفسها متوقفة: نعود للدفعات، ولا نمر على الطابور سطراً سطراً
+                    # مرة أخرى قبل MAX_FLUSH_ATTEMPTS دفعات فاشلة جديدة
+                    self._failures = 0
+                    return
+            self._failures = 0
+
+            for path in self._closed_segments:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._closed_segments = []
+            self._closed_rows = []
+
+    async def _insert_one_by_one(self):
+        """
+        الدفعة تفشل مرة بعد مرة: غالباً سطر واحد يفشلها كلها. ندخل الأسطر منفردة
+        وننقل ما يفشل منها لملف dead-letter. إن فشلت كلها فالقاعدة نفسها متوقفة:
+        لا ننقل شيئاً (تعيد False) ونحاول لاحقاً.
+        """
+        failed = []
+        for r in self._closed_rows:
+            if not await asyncio.to_thread(save_message_logs_bulk, [_db_row(r)]):
+                failed.append(r)
+        if failed and len(failed) == len(self._closed_rows):
+            return False
+        if failed:
+            await asyncio.to_thread(self._write_dead_letter, failed)
+            log.error("WAL: messages moved to dead letter", extra={"count": len(failed), "file": DEAD_LETTER_FILE})
+        return True
+
+    def _write_dead_letter(self, rows):
+        path = os.path.join(self.wal_dir, DEAD_LETTER_FILE)
+        with open(path, "a", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())  # قبل حذف المقاطع التي تحويها
+
+    async def run(self):
+        """حلقة خلفية: تكتب كل flush_interval أو فور امتلاء الدفعة"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("MessageLogBuffer flush error")
+
+    async def close(self):
+        """عند إيقاف البوت: نكتب ما تبقى"""
+        if self._wal is None:
+            return
+        await self.flush()
+        self._wal.close()
+        # المقطع الأخير فارغ بعد الـ flush
+        if not self._rows and os.path.exists(self._wal_path):
+            os.remove(self._wal_path)
+        self._wal = None
+
+
+message_log_buffer = MessageLogBuffer()
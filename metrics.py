@@ -0,0 +1,230 @@
+import os
+import time
+import logging
+import inspect
+import functools
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from telegram.ext import CommandHandler, CallbackQueryHandler, ConversationHandler, ApplicationHandlerStop
+from models import engine
+from results import FAILURE_RESULTS, outcome_of
+from app_logging import SLOW_CALL_MS, log_context
+
+log = logging.getLogger(__name__)
+
+# النتائج التي تحسب من ميزانية الأخطاء (الباقي نتائج عادية أو أخطاء المستخدم)
+FAILURE_OUTCOMES = {"error", "exception"} | {r.value for r in FAILURE_RESULTS}
+
+# البوت لا يملك خادم HTTP: نعرض مقاييسه على منفذ جانبي (الخادم server.py يعرضها على /metrics)
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
+
+HANDLER_SECONDS = Histogram(
+    "escrow_handler_seconds",
+    "زمن تنفيذ معالجات البوت (لكل أمر أو نمط زر)",
+    ["handler"],
+)
+HANDLER_ERRORS = Counter(
+    "escrow_handler_errors_total",
+    "استثناءات خرجت من معالجات البوت",
+    ["handler"],
+)
+DB_CALL_SECONDS = Histogram(
+    "escrow_db_call_seconds",
+    "زمن دوال db_services (شامل انتظار الاتصال والأقفال)",
+    ["operation"],
+)
+DB_CALL_OUTCOMES = Counter(
+    "escrow_db_call_outcomes_total",
+    "نتائج دوال db_services: نص النتيجة (SUCCESS، NOT_FOUND...) أو ok أو error/exception",
+    ["operation", "outcome"],
+)
+DB_CALL_FAILURES = Counter(
+    "escrow_db_call_failures_total",
+    "فشل دوال db_services بسبب عندنا (ميزانية الأخطاء: يقسم على مجموع الاستدعاءات)",
+    ["operation"],
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "escrow_rate_limit_decisions_total",
+    "قرارات حماية السبام في Redis",
+    ["decision"],  # allowed / limited / redis_error
+)
+CRYPTOBOT_SECONDS = Histogram(
+    "escrow_cryptobot_call_seconds",
+    "زمن طلبات CryptoBot API",
+    ["method"],
+)
+CRYPTOBOT_ERRORS = Counter(
+    "escrow_cryptobot_errors_total",
+    "أخطاء طلبات CryptoBot API (اسم خطأ الـ API أو نوع الاستثناء)",
+    ["method", "error"],
+)
+AUDIT_LOCK_WAIT_SECONDS = Histogram(
+    "escrow_audit_chain_lock_wait_seconds",
+    "انتظار قفل آخر سجل في سلسلة التدقيق (كل الكتابات المالية تمر به بالتسلسل)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+OUTBOUND_MESSAGES = Counter(
+    "escrow_outbound_messages_total",
+    "نتائج إرسال رسائل البوت الصادرة",
+    ["kind", "outcome"],  # sent / retry / blocked / failed
+)
+OUTBOUND_LIMIT_WAIT_SECONDS = Histogram(
+    "escrow_outbound_rate_limit_wait_seconds",
+    "انتظار الرسالة لدورها في حدود المعدل (العام + لكل محادثة)",
+    buckets=(0, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "escrow_http_request_seconds",
+    "زمن طلبات server.py (حسب المسار المعرف لا الرابط الفعلي)",
+    ["route", "status"],
+)
+
+# استخدام الـ pool يقرأ لحظة الجمع (لا حاجة لتحديثه من الكود)
+DB_POOL_CONNECTIONS = Gauge(
+    "escrow_db_pool_connections",
+    "اتصالات SQLAlchemy pool في هذه العملية",
+    ["state"],
+)
+DB_POOL_CONNECTIONS.labels(state="checked_out").set_function(lambda: engine.pool.checkedout())
+DB_POOL_CONNECTIONS.labels(state="idle").set_function(lambda: engine.pool.checkedin())
+DB_POOL_CONNECTIONS.labels(state="overflow").set_function(lambda: max(engine.pool.overflow(), 0))
+DB_POOL_CONNECTIONS.labels(state="size").set_function(lambda: engine.pool.size())
+
+
+def start_bot_metrics_server():
+    """منفذ المقاييس الجانبي للبوت (خيط خلفي من prometheus_client)"""
+    start_http_server(BOT_METRICS_PORT)
+    log.info("Metrics server started", extra={"port": BOT_METRICS_PORT})
+
+
+# --- دوال db_services ---
+# معاملات تضاف لسياق السجلات إن وجدت في توقيع الدالة
+CONTEXT_PARAMS = {
+    "user_id": "user_id",
+    "telegram_id": "user_id",
+    "buyer_id": "user_id",
+    "seller_id": "user_id",
+    "admin_id": "admin_id",
+    "deal_id": "deal_id",
+    "public_id": "deal_id",
+}
+
+
+def timed_db_call(operation, func):
+    log = logging.getLogger(func.__module__)
+    signature = inspect.signature(func)
+    context_params = [p for p in signature.parameters if p in CONTEXT_PARAMS]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        fields = {}
+        if context_params:
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            for param in context_params:
+                if param in bound:
+                    fields.setdefault(CONTEXT_PARAMS[param], bound[param])
+
+        start = time.perf_counter()
+        outcome = "exception"
+        with log_context(operation=operation, **fields) as state:
+            try:
+                result = func(*args, **kwargs)
+                outcome = "error" if state["failed"] else outcome_of(result)
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                DB_CALL_SECONDS.labels(operation=operation).observe(elapsed)
+                DB_CALL_OUTCOMES.labels(operation=operation, outcome=outcome).inc()
+                if outcome in FAILURE_OUTCOMES:
+                    DB_CALL_FAILURES.labels(operation=operation).inc()
+                if elapsed * 1000 >= SLOW_CALL_MS:
+                    log.warning(
+                        "slow_call",
+                        extra={"duration_ms": round(elapsed * 1000, 1), "outcome": outcome},
+                    )
+    return wrapper
+
+
+def instrument_db_module(namespace):
+    """
+    يلف كل الدوال العامة المعرفة في الوحدة (namespace = globals() لها) بمؤقت.
+    يستدعى في آخر db_services، فكل من يستورد منها يحصل على النسخ المقاسة.
+    """
+    module_name = namespace["__name__"]
+    for name, obj in list(namespace.items()):
+        if (
+            name.startswith("_")
+            or not inspect.isfunction(obj)
+            or obj.__module__ != module_name
+            or inspect.iscoroutinefunction(obj)
+        ):
+            continue
+        namespace[name] = timed_db_call(name, obj)
+
+
+# --- CryptoBot ---
+@contextmanager
+def cryptobot_call(method):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        # أخطاء الـ API تحمل اسماً ثابتاً (INSUFFICIENT_FUNDS...)، وغيرها نوع الاستثناء
+        error = getattr(e, "name", None) or type(e).__name__
+        CRYPTOBOT_ERRORS.labels(method=method, error=str(error)).inc()
+        raise
+    finally:
+        CRYPTOBOT_SECONDS.labels(method=method).observe(time.perf_counter() - start)
+
+
+# --- معالجات البوت ---
+def handler_label(handler):
+    """اسم محدود العدد: الأمر أو نمط الزر، وإلا اسم الدالة"""
+    if isinstance(handler, CommandHandler):
+        return "/" + ",".join(sorted(handler.commands))
+    pattern = getattr(handler, "pattern", None)
+    if isinstance(handler, CallbackQueryHandler) and pattern is not None:
+        return "cb:" + getattr(pattern, "pattern", str(pattern))
+    return handler.callback.__name__
+
+
+def _timed_handler(label, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = getattr(update, "effective_user", None)
+        start = time.perf_counter()
+        with log_context(handler=label, user_id=user.id if user else None):
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise  # إيقاف مقصود (بوابة الحظر مثلاً) وليس خطأ
+            except Exception:
+                HANDLER_ERRORS.labels(handler=label).inc()
+                raise
+            finally:
+                HANDLER_SECONDS.labels(handler=label).observe(time.perf_counter() - start)
+    return wrapper
+
+
+def _leaf_handlers(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            yield from _leaf_handlers(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                yield from _leaf_handlers(inner)
+    else:
+        yield handler
+
+
+def iter_handlers(application):
+    """كل المعالجات المسجلة بما فيها ما بداخل ConversationHandler"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            yield from _leaf_handlers(handler)
+
+
+def instrument_handlers(application):
+    """يستدعى بعد تسجيل كل المعالجات (وقبل run_polling)"""
+    for handler in iter_handlers(application):
+        handler.callback = _timed_handler(handler_label(handler), handler.callback)
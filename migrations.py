@@ -0,0 +1,535 @@
+"""
+تطور قاعدة البيانات بدون إيقاف البوت (بدل Base.metadata.create_all وحده).
+
+التشغيل قبل نشر الكود الجديد:
+    python migrations.py          # يطبق ما لم يطبق بعد
+    python migrations.py status   # الإصدار الحالي وما ينتظر
+
+قواعد كل خطوة هنا:
+- قابلة للتكرار (IF NOT EXISTS / فحص قبل التنفيذ): على قاعدة جديدة الخطوة 1 تبني المخطط
+  الحالي كاملاً والخطوات التالية لا تجد ما تفعله، وإن توقفت خطوة في منتصفها تكمل عند إعادة التشغيل.
+- لا قفل طويل على جدول مستخدم: الفهارس CONCURRENTLY، تعبئة الأعمدة على دفعات،
+  وأوامر DDL بـ lock_timeout قصير مع إعادة المحاولة (بدل الوقوف في طابور الأقفال وإيقاف كل ما خلفنا).
+- متوافقة مع الكود السابق: النسخة القديمة تستمر بالعمل أثناء النشر.
+"""
+import os
+import re
+import sys
+import time
+import logging
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from models import Base, engine, AccountType
+from permissions import NOTIFY_TRIGGER_DDL
+
+log = logging.getLogger(__name__)
+
+BACKFILL_BATCH = int(os.getenv("MIGRATION_BACKFILL_BATCH", "5000"))
+# استراحة بين الدفعات: تترك للحركة الحية (وللنسخ المتماثل) وقتاً تلحق فيه
+BACKFILL_PAUSE_SECONDS = float(os.getenv("MIGRATION_BACKFILL_PAUSE", "0.05"))
+LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+LOCK_RETRIES = 10
+# مفتاح pg_advisory_lock: البوت والخادم قد يبدآن معاً، وواحد فقط يطبق الخطوات
+MIGRATIONS_LOCK_KEY = 20240501
+
+# READ COMMITTED: الـ SERIALIZABLE الافتراضي يفشل دفعات التعبئة عند أي تعارض مع الحركة الحية
+_engine = engine.execution_options(isolation_level="READ COMMITTED")
+# CREATE INDEX CONCURRENTLY و ALTER TYPE ... ADD VALUE لا يعملان داخل transaction
+_autocommit = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class SchemaOutdated(RuntimeError):
+    pass
+
+
+# --- أدوات الخطوات ---
+def _ddl(*statements):
+    """أوامر DDL في transaction واحدة قصيرة، تعاد كاملة إن لم تحصل على أقفالها خلال LOCK_TIMEOUT"""
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            with _engine.begin() as conn:
+                conn.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+                for statement in statements:
+                    conn.execute(text(statement))
+            return
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == LOCK_RETRIES:
+                raise
+            log.warning("Migration lock busy, retrying", extra={"attempt": attempt})
+            time.sleep(attempt)
+
+
+def _scalar(sql, **params):
+    with _engine.connect() as conn:
+        return conn.execute(text(sql), params).scalar()
+
+
+def _column_type(table, column):
+    """نوع العمود (integer / bigint ...) أو None إن لم يوجد"""
+    return _scalar(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column",
+        table=table, column=column,
+    )
+
+
+def _constraint_exists(table, name):
+    return bool(_scalar(
+        "SELECT 1 FROM pg_constraint WHERE conrelid = CAST(:table AS regclass) AND conname = :name",
+        table=table, name=name,
+    ))
+
+
+def _add_column(table, column, definition):
+    """عمود قابل للفراغ أو بقيمة افتراضية ثابتة: تعديل وصفي فقط (Postgres 11+)، بدون إعادة كتابة الجدول"""
+    _ddl(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+
+def _create_index(name, table, columns, unique=False, where=None):
+    """
+    CREATE INDEX CONCURRENTLY: الكتابة على الجدول مستمرة أثناء البناء.
+    البناء الذي توقف في منتصفه يترك فهرساً INVALID: نحذفه ونبني من جديد.
+    """
+    with _autocommit.connect() as conn:
+        conn.execute(text("SET statement_timeout = 0"))
+        valid = conn.execute(
+            text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND c.relnamespace = CAST(current_schema() AS regnamespace)"
+            ),
+            {"name": name},
+        ).scalar()
+        if valid:
+            return
+        if valid is False:
+            log.warning("Dropping invalid index left by an interrupted build", extra={"index": name})
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        started = time.monotonic()
+        conn.execute(text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"
+            + (f" WHERE {where}" if where else "")
+        ))
+        log.info("Index built", extra={"index": name, "seconds": round(time.monotonic() - started, 1)})
+
+
+def _add_foreign_key(table, name, definition):
+    """NOT VALID ثم VALIDATE: الفحص الطويل لا يمنع الكتابة على أي من الجدولين"""
+    if not _constraint_exists(table, name):
+        _ddl(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID")
+    _ddl(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+def _set_not_null(table, column):
+    """
+    SET NOT NULL وحده يفحص الجدول كله تحت قفل حصري.
+    قيد CHECK صالح يثبت الشرط مسبقاً فيتخطى Postgres (12+) الفحص.
+    """
+    check = f"{table}_{column}_not_null"
+    if not _constraint_exists(table, check):
+        _ddl(f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID")
+    _ddl(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}")
+    _ddl(
+        f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL",
+        f"ALTER TABLE {table} DROP CONSTRAINT {check}",
+    )
+
+
+def _id_batches(table, key="id"):
+    """نطاقات [start, end) على المفتاح حتى أكبر قيمة الآن (الصفوف الأحدث يكتبها الكود الجديد صحيحة)"""
+    with _engine.connect() as conn:
+        low, high = conn.execute(text(f"SELECT min({key}), max({key}) FROM {table}")).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, BACKFILL_BATCH):
+        yield start, start + BACKFILL_BATCH
+        time.sleep(BACKFILL_PAUSE_SECONDS)
+
+
+def _backfill(table, assignment, condition, key="id"):
+    """
+    UPDATE على دفعات بحسب المفتاح، كل دفعة transaction مستقلة قصيرة.
+    condition تستثني ما تمت تعبئته، فالإعادة بعد التوقف تكمل من حيث توقفت عملياً.
+    """
+    total = 0
+    for start, end in _id_batches(table, key):
+        with _engine.begin() as conn:
+            total += conn.execute(
+                text(
+                    f"UPDATE {table} SET {assignment} "
+                    f"WHERE {key} >= :start AND {key} < :end AND ({condition})"
+                ),
+                {"start": start, "end": end},
+            ).rowcount
+    log.info("Backfill finished", extra={"table": table, "rows": total})
+    return total
+
+
+# --- تحويل أعمدة رقم الصفقة إلى BIGINT بدون إعادة كتابة الجدول تحت قفل ---
+def _column_indexes(table, column):
+    """الفهارس (ومنها المفتاح الأساسي والقيود الفريدة) التي يدخل فيها العمود"""
+    with _engine.connect() as conn:
+        return conn.execute(
+            text(
+                "SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition, "
+                "con.conname AS constraint_name, con.contype AS constraint_type "
+                "FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                "LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.contype IN ('p', 'u') "
+                "WHERE i.indrelid = CAST(:table AS regclass) AND a.attname = :column"
+            ),
+            {"table": table, "column": column},
+        ).mappings().all()
+
+
+def _foreign_keys_touching(columns):
+    """كل FK على أحد هذه الأعمدة أو يشير إليها: تحذف قبل التبديل وتعاد بعده"""
+    found = {}
+    with _engine.connect() as conn:
+        for table, column in columns:
+            rows = conn.execute(
+                text(
+                    "SELECT con.conrelid::regclass::text AS table_name, con.conname AS name, "
+                    "pg_get_constraintdef(con.oid) AS definition "
+                    "FROM pg_constraint con "
+                    "JOIN pg_attribute a ON a.attrelid = CAST(:table AS regclass) AND a.attname = :column "
+                    "WHERE con.contype = 'f' AND ("
+                    "  (con.conrelid = a.attrelid AND a.attnum = ANY(con.conkey)) OR "
+                    "  (con.confrelid = a.attrelid AND a.attnum = ANY(con.confkey)))"
+                ),
+                {"table": table, "column": column},
+            ).mappings().all()
+            for row in rows:
+                found[(row["table_name"], row["name"])] = row["definition"]
+    return found
+
+
+def _shadow_index_name(name):
+    return f"{name[:55]}_bigint"
+
+
+def _prepare_bigint_shadow(table, column):
+    """
+    عمود ظل BIGINT يملؤه trigger للصفوف الجديدة وتعبئة على دفعات للقديمة،
+    ثم نسخ فهارس العمود الأصلي عليه (CONCURRENTLY). الجدول يعمل طوال الوقت.
+    """
+    shadow = f"{column}_bigint"
+    function = f"{table}_{column}_to_bigint"
+    _add_column(table, shadow, "BIGINT")
+    _ddl(
+        f"""
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+        BEGIN
+            NEW.{shadow} := NEW.{column};
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        f"DROP TRIGGER IF EXISTS {function} ON {table}",
+        f"CREATE TRIGGER {function} BEFORE INSERT OR UPDATE ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {function}()",
+    )
+    _backfill(table, f"{shadow} = {column}", f"{shadow} IS DISTINCT FROM {column}")
+
+    if _scalar(
+        "SELECT is_nullable FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column",
+        table=table, column=column,
+    ) == "NO":
+        check = f"{table}_{shadow}_not_null"
+        if not _constraint_exists(table, check):
+            _ddl(f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({shadow} IS NOT NULL) NOT VALID")
+        _ddl(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}")
+
+    indexes = []
+    for index in _column_indexes(table, column):
+        on_table, _, columns = index["definition"].partition(" ON ")[2].partition(" USING ")
+        columns = re.sub(rf"\b{column}\b", shadow, columns)
+        unique = "UNIQUE" in index["definition"].split(" ON ")[0]
+        shadow_name = _shadow_index_name(index["name"])
+        # "btree (deal_id_bigint, milestone_id)" -> الأعمدة فقط
+        _create_index(shadow_name, on_table, columns.partition("(")[2].rpartition(")")[0], unique=unique)
+        indexes.append((index, shadow_name))
+    return indexes
+
+
+def _swap_bigint_statements(table, column, indexes):
+    """أوامر التبديل: وصفية فقط (إعادة تسمية وحذف عمود)، تنفذ كلها في transaction واحدة"""
+    shadow = f"{column}_bigint"
+    function = f"{table}_{column}_to_bigint"
+    default = _scalar(
+        "SELECT column_default FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column",
+        table=table, column=column,
+    )
+    sequence = _scalar("SELECT pg_get_serial_sequence(:table, :column)", table=table, column=column)
+    not_null = _constraint_exists(table, f"{table}_{shadow}_not_null")
+
+    statements = [
+        f"DROP TRIGGER IF EXISTS {function} ON {table}",
+        f"ALTER TABLE {table} RENAME COLUMN {column} TO {column}_int",
+        f"ALTER TABLE {table} RENAME COLUMN {shadow} TO {column}",
+    ]
+    if default:
+        statements += [
+            f"ALTER TABLE {table} ALTER COLUMN {column}_int DROP DEFAULT",
+            f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {default}",
+        ]
+    if sequence:
+        # قبل حذف العمود القديم: حذف العمود المالك يحذف السلسلة معه
+        statements += [
+            f"ALTER SEQUENCE {sequence} AS BIGINT",
+            f"ALTER SEQUENCE {sequence} OWNED BY {table}.{column}",
+        ]
+    if not_null:
+        statements += [
+            f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL",
+            f"ALTER TABLE {table} DROP CONSTRAINT {table}_{shadow}_not_null",
+        ]
+    statements.append(f"ALTER TABLE {table} DROP COLUMN {column}_int")
+    for index, shadow_name in indexes:
+        if index["constraint_type"] == "p":
+            statements.append(
+                f"ALTER TABLE {table} ADD CONSTRAINT {index['constraint_name']} PRIMARY KEY USING INDEX {shadow_name}"
+            )
+        elif index["constraint_type"] == "u":
+            statements.append(
+                f"ALTER TABLE {table} ADD CONSTRAINT {index['constraint_name']} UNIQUE USING INDEX {shadow_name}"
+            )
+        else:
+            statements.append(f"ALTER INDEX {shadow_name} RENAME TO {index['name']}")
+    return statements
+
+
+def _widen_to_bigint(columns):
+    """
+    Integer -> BIGINT بدون ALTER COLUMN TYPE (الذي يعيد كتابة الجدول وفهارسه تحت قفل حصري).
+    الأعمدة المترابطة بـ FK تبدل معاً في transaction واحدة قصيرة، ثم تفحص الـ FK بدون قفل كتابة.
+    """
+    columns = [(t, c) for t, c in columns if _column_type(t, c) == "integer"]
+    if not columns:
+        return
+    prepared = [(t, c, _prepare_bigint_shadow(t, c)) for t, c in columns]
+    foreign_keys = _foreign_keys_touching(columns)
+
+    statements = [f"ALTER TABLE {t} DROP CONSTRAINT {name}" for t, name in foreign_keys]
+    for table, column, indexes in prepared:
+        statements += _swap_bigint_statements(table, column, indexes)
+    statements += [
+        f"ALTER TABLE {t} ADD CONSTRAINT {name} {definition} NOT VALID"
+        for (t, name), definition in foreign_keys.items()
+    ]
+    _ddl(*statements)
+    log.info("Columns switched to BIGINT", extra={"columns": [f"{t}.{c}" for t, c in columns]})
+
+    for t, name in foreign_keys:
+        _ddl(f"ALTER TABLE {t} VALIDATE CONSTRAINT {name}")
+    _ddl(*(f"DROP FUNCTION IF EXISTS {t}_{c}_to_bigint()" for t, c in columns))
+
+
+# --- الخطوات (بالترتيب، ولا تعدل خطوة بعد نشرها: أضف خطوة جديدة) ---
+def _create_missing_tables():
+    # الجداول الجديدة فارغة: إنشاؤها مع فهارسها لا يقفل شيئاً مستخدماً
+    Base.metadata.create_all(engine, checkfirst=True)
+
+
+def _add_new_columns():
+    _add_column("users", "is_active", "BOOLEAN NOT NULL DEFAULT true")
+    _add_column("admins", "open_cases", "INTEGER DEFAULT 0")
+    _add_column("admins", "resolved_cases", "INTEGER DEFAULT 0")
+    _add_column("deals", "public_id", "VARCHAR(16)")
+    _add_column("deals", "asset", "VARCHAR")
+    _add_column("deals", "paid_asset", "VARCHAR")
+    _add_column("deals", "paid_units", "BIGINT")
+    _add_column("deals", "usd_value_cents", "BIGINT")
+    _add_column("seller_stats", "completed_deals", "INTEGER NOT NULL DEFAULT 0")
+    _add_column("seller_stats", "completed_volume_cents", "BIGINT NOT NULL DEFAULT 0")
+    _add_column("ledger_accounts", "asset", "VARCHAR NOT NULL DEFAULT 'USDT'")
+    _add_column("revenue_entries", "milestone_id", "INTEGER")
+    _add_column("revenue_entries", "asset", "VARCHAR")
+    _add_column("revenue_entries", "fee_units", "BIGINT")
+    _add_foreign_key(
+        "revenue_entries", "revenue_entries_milestone_id_fkey",
+        "FOREIGN KEY (milestone_id) REFERENCES deal_milestones (id)",
+    )
+
+
+# نفس أبجدية deal_links.new_public_id وطولها، من 60 بت عشوائية في gen_random_uuid (Postgres 13+)
+# (الخانة 18 وما بعدها في UUID v4 عشوائية بالكامل بعد خانتي الإصدار والنوع)
+PUBLIC_ID_FUNCTION_DDL = """
+CREATE OR REPLACE FUNCTION new_public_id() RETURNS varchar AS $$
+DECLARE
+    alphabet CONSTANT text := '0123456789ABCDEFGHJKMNPQRSTVWXYZ';
+    bits bigint := ('x' || substr(replace(gen_random_uuid()::text, '-', ''), 18, 15))::bit(60)::bigint;
+    code text := '';
+BEGIN
+    FOR i IN 0..11 LOOP
+        code := code || substr(alphabet, ((bits >> (5 * i)) & 31)::int + 1, 1);
+    END LOOP;
+    RETURN code;
+END;
+$$ LANGUAGE plpgsql VOLATILE
+"""
+
+
+def _backfill_deals_and_revenue():
+    # الصفقات والعمولات قبل تعدد العملات كانت كلها بالدولار (USDT بالسنت)
+    _backfill("deals", "asset = 'USDT'", "asset IS NULL")
+    _backfill("revenue_entries", "asset = 'USDT', fee_units = fee_cents", "asset IS NULL")
+    # القيمة الافتراضية في القاعدة قبل التعبئة: الكود القديم (لا يعرف العمود) يستمر
+    # بإنشاء صفقات أثناء النشر، فتأخذ رمزاً ولا يفشل VALIDATE ولا إدراجها بعد NOT NULL
+    _ddl(PUBLIC_ID_FUNCTION_DDL, "ALTER TABLE deals ALTER COLUMN public_id SET DEFAULT new_public_id()")
+    _backfill("deals", "public_id = new_public_id()", "public_id IS NULL")
+    _set_not_null("deals", "public_id")
+
+
+def _add_indexes():
+    _create_index("ix_deals_public_id", "deals", "public_id", unique=True)
+    _create_index("ix_deals_updated_at", "deals", "updated_at")
+    _create_index("ix_seller_stats_updated_at", "seller_stats", "updated_at")
+
+
+def _revenue_unique_per_milestone():
+    """عمولة لكل مرحلة: القيد الفريد على (deal_id, milestone_id) بدل deal_id وحده"""
+    _create_index("uq_revenue_entries_deal_milestone", "revenue_entries", "deal_id, milestone_id", unique=True)
+    statements = []
+    if not _constraint_exists("revenue_entries", "uq_revenue_entries_deal_milestone"):
+        statements.append(
+            "ALTER TABLE revenue_entries ADD CONSTRAINT uq_revenue_entries_deal_milestone "
+            "UNIQUE USING INDEX uq_revenue_entries_deal_milestone"
+        )
+    statements.append("ALTER TABLE revenue_entries DROP CONSTRAINT IF EXISTS revenue_entries_deal_id_key")
+    _ddl(*statements)
+
+
+def _revenue_unique_per_deal():
+    """
+    القيد (deal_id, milestone_id) لا يمنع عمولتين لصفقة عادية (milestone_id NULL)
+    كما كان revenue_entries_deal_id_key يفعل قبل الخطوة 5.
+    """
+    _create_index(
+        "uq_revenue_entries_deal_whole", "revenue_entries", "deal_id",
+        unique=True, where="milestone_id IS NULL",
+    )
+
+
+def _extend_account_type():
+    # SQLAlchemy يخزن اسم العضو (WITHDRAWAL) لا قيمته
+    with _autocommit.connect() as conn:
+        for member in AccountType:
+            conn.execute(text(f"ALTER TYPE accounttype ADD VALUE IF NOT EXISTS '{member.name}'"))
+
+
+def _widen_deal_ids():
+    _widen_to_bigint([
+        ("deals", "id"),
+        ("message_logs", "deal_id"),
+        ("reviews", "deal_id"),
+        ("deal_milestones", "deal_id"),
+        ("dispute_cases", "deal_id"),
+        ("ledger_accounts", "deal_id"),
+        ("journal_entries", "deal_id"),
+        ("revenue_entries", "deal_id"),
+        ("exchange_conversions", "deal_id"),
+    ])
+
+
+def _install_admins_trigger():
+    # كان يثبت عند كل تشغيل للبوت (DROP/CREATE TRIGGER يقفل جدول admins بالكامل)
+    _ddl(*NOTIFY_TRIGGER_DDL)
+
+
+MIGRATIONS = [
+    (1, "create missing tables", _create_missing_tables),
+    (2, "add new columns", _add_new_columns),
+    (3, "backfill deal assets and public ids", _backfill_deals_and_revenue),
+    (4, "indexes on existing tables", _add_indexes),
+    (5, "revenue unique per milestone", _revenue_unique_per_milestone),
+    (6, "account types withdrawal and exchange", _extend_account_type),
+    (7, "deal ids to bigint", _widen_deal_ids),
+    (8, "admins_changed notify trigger", _install_admins_trigger),
+    (9, "revenue unique per whole deal", _revenue_unique_per_deal),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# --- التطبيق والفحص ---
+def _ensure_versions_table():
+    _ddl(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            duration_ms INTEGER
+        )
+        """
+    )
+
+
+def applied_versions():
+    if not _scalar("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return set()
+    with _engine.connect() as conn:
+        return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def schema_version():
+    return max(applied_versions(), default=0)
+
+
+def migrate():
+    """يطبق الخطوات الناقصة بالترتيب (واحدة بعد الأخرى، وكل خطوة تسجل فور انتهائها)"""
+    with _autocommit.connect() as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        try:
+            _ensure_versions_table()
+            applied = applied_versions()
+            for version, name, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                log.info("Applying migration", extra={"version": version, "migration": name})
+                started = time.monotonic()
+                step()
+                duration_ms = int((time.monotonic() - started) * 1000)
+                with _engine.begin() as conn:
+                    conn.execute(
+                        text(
+                            "INSERT INTO schema_migrations (version, name, duration_ms) "
+                            "VALUES (:version, :name, :duration_ms)"
+                        ),
+                        {"version": version, "name": name, "duration_ms": duration_ms},
+                    )
+                log.info("Migration applied", extra={"version": version, "duration_ms": duration_ms})
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+    return schema_version()
+
+
+def check_schema():
+    """
+    يستدعى عند تشغيل البوت والخادم: يرفض العمل على قاعدة لم تطبق عليها كل خطوات هذا الكود.
+    القاعدة الأحدث من الكود مسموحة (النسخة السابقة تبقى تعمل أثناء النشر).
+    """
+    current = schema_version()
+    if current < LATEST_VERSION:
+        missing = [f"{v}: {name}" for v, name, _ in MIGRATIONS if v > current]
+        raise SchemaOutdated(
+            f"Database schema is at version {current}, code needs {LATEST_VERSION}. "
+            f"Run `python migrations.py` first. Pending: {'; '.join(missing)}"
+        )
+    return current
+
+
+if __name__ == "__main__":
+    from app_logging import configure_logging
+
+    configure_logging("escrow-migrations")
+    if sys.argv[1:] == ["status"]:
+        applied = applied_versions()
+        for version, name, _ in MIGRATIONS:
+            print(f"{'✅' if version in applied else '⏳'} {version}: {name}")
+    else:
+        print(f"✅ Schema version {migrate()}")
@@ -0,0 +1,19 @@
+import os
+import asyncio
+import logging
+from db_services import close_finished_milestone_deals
+
+log = logging.getLogger(__name__)
+
+# صفقة انتهت مراحلها وبقيت ACTIVE تغلق خلال هذه المدة على الأكثر
+MILESTONE_SWEEP_SECONDS = int(os.getenv("MILESTONE_SWEEP_SECONDS", "300"))
+
+
+async def milestone_sweeper():
+    """حلقة خلفية: تغلق الصفقات التي فشل إغلاقها بعد آخر مرحلة"""
+    while True:
+        try:
+            await asyncio.to_thread(close_finished_milestone_deals)
+        except Exception:
+            log.exception("Milestone sweep error")
+        await asyncio.sleep(MILESTONE_SWEEP_SECONDS)
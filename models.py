@@ -12,11 +12,13 @@ from sqlalchemy import (
     String,
     Boolean,
     DateTime,
+    Date,
 )
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
-from sqlalchemy import ForeignKey, Text, Enum  # استيرادات إضافية
-from sqlalchemy.orm import relationship
+from sqlalchemy import ForeignKey, Text, Enum, Index, UniqueConstraint  # استيرادات إضافية
+from sqlalchemy.orm import relationship, backref
+from deal_links import new_public_id
 
 # 1. إنشاء "القاعدة" (Base) التي سنبني عليها الجداول
 Base = declarative_base()
@@ -46,6 +48,8 @@ class User(Base):
     # 5. الأمان
     is_banned = Column(Boolean, default=False)  # هل هو محظور؟
     is_admin = Column(Boolean, default=False)  # هل هو مشرف؟
+    # False = حظر البوت (ظهر عند الإرسال): لا نرسل له الإعلانات حتى يعود ويتفاعل
+    is_active = Column(Boolean, default=True, server_default="true", nullable=False)
 
     # 6. التوقيت
     # default=datetime.utcnow: يسجل وقت الانضمام تلقائياً
@@ -75,6 +79,10 @@ class Admin(Base):
     # كلمة مرور العمليات الخطيرة (مشفرة)
     # لا تخزن الـ PIN كما هو أبداً!
     pin_hash = Column(String, nullable=False) 
+
+    # عبء العمل: يتحدثان مع استلام النزاعات وحلها (بدون COUNT على جدول القضايا)
+    open_cases = Column(Integer, default=0, server_default="0")
+    resolved_cases = Column(Integer, default=0, server_default="0")
     
     user = relationship("User")
 
@@ -88,11 +96,51 @@ class DealStatus:
     DISPUTE = "dispute"  # في مشكلة
 
 
+class DealTemplate(Base):
+    """قالب صفقة محفوظ للبائع: ينشئ منه صفقات متطابقة بأمر واحد"""
+    __tablename__ = "deal_templates"
+
+    id = Column(Integer, primary_key=True)
+    seller_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    name = Column(String(64), nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)  # بأصغر وحدة لعملة القالب
+    asset = Column(String, default="USDT")
+    description = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("seller_id", "name", name="uq_deal_templates_seller_name"),
+    )
+
+class DealMilestone(Base):
+    """
+    مرحلة من صفقة كبيرة: تُسلم وتُحرر (أو يُفتح عليها نزاع) وحدها.
+    لكل مرحلة حساب ضمان خاص بها، فالعمليات على مراحل مختلفة لا تقفل نفس الصفوف.
+    الحالة تستخدم نفس قيم DealStatus.
+    """
+    __tablename__ = "deal_milestones"
+
+    id = Column(Integer, primary_key=True)
+    deal_id = Column(BigInteger, ForeignKey("deals.id"), nullable=False)
+    position = Column(Integer, nullable=False)  # ترتيب المرحلة (1، 2، 3...)
+    title = Column(String, nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)  # بأصغر وحدة لعملة الصفقة
+    status = Column(String, default=DealStatus.PENDING)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("deal_id", "position", name="uq_deal_milestones_deal_position"),
+    )
+
 class Deal(Base):
     __tablename__ = "deals"
 
-    # 1. رقم الصفقة الفريد
-    id = Column(Integer, primary_key=True)
+    # 1. رقم الصفقة الفريد (داخلي فقط: للربط بين الجداول، لا يظهر للمستخدمين)
+    id = Column(BigInteger, primary_key=True)
+    # الرمز العام العشوائي الذي يراه المستخدمون ويكتبونه (/msg 7KQ2M9XD4RTA)
+    public_id = Column(String(16), unique=True, index=True, nullable=False, default=new_public_id)
 
     # 2. ربط الصفقة بالبشر (Foreign Keys)
     # المشتري: يربط مع users.id
@@ -101,25 +149,35 @@ class Deal(Base):
     seller_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
 
     # 3. المال والوصف
-    amount_cents = Column(BigInteger, default=0)  # المبلغ بالسنت (5000 = 50$)
+    # المبلغ بأصغر وحدة لعملة الصفقة (USDT بالسنت: 5000 = 50$، TON بالنانو...)
+    amount_cents = Column(BigInteger, default=0)
+    asset = Column(String, default="USDT")  # عملة تسعير الصفقة
     description = Column(Text, nullable=False)  # تفاصيل الاتفاق
 
+    # ما دفعه المشتري فعلاً (قد يدفع بعملة أخرى فنحول وقت الدفع)
+    paid_asset = Column(String, nullable=True)
+    paid_units = Column(BigInteger, nullable=True)
+    # قيمة الصفقة بالدولار (سنت) وقت الدفع: للعمولة والإحصائيات والتقارير
+    usd_value_cents = Column(BigInteger, nullable=True)
+
     # 4. الحالة (أخطر عمود)
     status = Column(String, default=DealStatus.PENDING)
 
     # 5. التوقيتات
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # مفهرس: التسوية الليلية تعيد حساب أطراف الصفقات التي تغيرت فقط
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # --- العلاقات البرمجية (Relationships) ---
     # هذه الأسماء (buyer, seller) سنستخدمها في بايثون للوصول لبيانات المستخدم بسهولة
     # مثال: deal.buyer.full_name سيجلب اسم المشتري مباشرة
     buyer = relationship("User", foreign_keys=[buyer_id], backref="purchases")
     seller = relationship("User", foreign_keys=[seller_id], backref="sales")
+    milestones = relationship("DealMilestone", order_by="DealMilestone.position", backref="deal")
 
     # دالة للعرض الجميل
     def __repr__(self):
-        return f"<Deal(id={self.id}, status={self.status}, amount={self.amount_cents})>"
+        return f"<Deal(id={self.id}, public_id={self.public_id}, status={self.status}, amount={self.amount_cents})>"
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -143,7 +201,7 @@ class MessageLog(Base):
     __tablename__ = "message_logs"
 
     id = Column(Integer, primary_key=True)
-    deal_id = Column(Integer, ForeignKey("deals.id"), nullable=False)
+    deal_id = Column(BigInteger, ForeignKey("deals.id"), nullable=False)
     sender_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
 
     # التعديلات الجديدة:
@@ -156,11 +214,12 @@ class MessageLog(Base):
     sender = relationship("User", backref="sent_messages")
 
 
-# دالة لإنشاء الجداول فعلياً
+# دالة لإنشاء الجداول فعلياً (أو تحديثها): عبر migrations.py لا create_all مباشرة
 def init_db():
-    Base.metadata.create_all(engine)
-    # استبدلنا المتغير المحذوف بنص مباشر ليعمل الكود
-    print(f"✅ تم ربط PostgreSQL وإنشاء جميع الجداول بنجاح!")
+    from migrations import migrate  # migrations يستورد هذا الملف
+
+    version = migrate()
+    print(f"✅ تم ربط PostgreSQL وتحديث الجداول حتى الإصدار {version} بنجاح!")
 
 class AuditLog(Base):
     __tablename__ = 'audit_logs'
@@ -182,7 +241,7 @@ class Review(Base):
     __tablename__ = 'reviews'
 
     id = Column(Integer, primary_key=True)
-    deal_id = Column(Integer, ForeignKey('deals.id'), nullable=False)
+    deal_id = Column(BigInteger, ForeignKey('deals.id'), nullable=False)
     reviewer_id = Column(BigInteger, ForeignKey('users.id'), nullable=False) # المشتري
     target_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)   # البائع
     stars = Column(Integer, nullable=False) # من 1 إلى 5
@@ -191,6 +250,351 @@ class Review(Base):
     # علاقات
     deal = relationship("Deal")
 
+class EvidenceFile(Base):
+    """
+    نسخة محلية من صور الأدلة (بدل الاعتماد على file_id في تليجرام فقط).
+    الملفات تخزن حسب بصمتها SHA-256، فالصورة المكررة تحفظ مرة واحدة.
+    """
+    __tablename__ = 'evidence_files'
+
+    id = Column(Integer, primary_key=True)
+    message_log_id = Column(Integer, ForeignKey('message_logs.id'), nullable=False, unique=True)
+    sha256 = Column(String(64), nullable=True, index=True)  # فارغ إذا فشل التحميل نهائياً
+    path = Column(String, nullable=True)        # مسار الصورة الأصلية على القرص
+    thumb_path = Column(String, nullable=True)  # مسار الصورة المصغرة
+    size_bytes = Column(BigInteger, default=0)
+    error = Column(String, nullable=True)       # سبب الفشل (file_id منتهي مثلاً)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    message = relationship("MessageLog", backref=backref("evidence", uselist=False))
+
+class SellerStats(Base):
+    """
+    إحصائيات التقييم المحسوبة مسبقاً لكل بائع (تتحدث مع كل تقييم جديد).
+    القراءة منها صف واحد بدل حساب المتوسط من جدول reviews.
+    """
+    __tablename__ = 'seller_stats'
+
+    seller_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
+    reviews_count = Column(Integer, default=0, nullable=False)
+    stars_sum = Column(Integer, default=0, nullable=False)
+
+    # توزيع النجوم (Histogram)
+    stars_1 = Column(Integer, default=0, nullable=False)
+    stars_2 = Column(Integer, default=0, nullable=False)
+    stars_3 = Column(Integer, default=0, nullable=False)
+    stars_4 = Column(Integer, default=0, nullable=False)
+    stars_5 = Column(Integer, default=0, nullable=False)
+
+    # حجم التعامل (الصفقات المكتملة لصالح البائع)
+    completed_deals = Column(Integer, default=0, nullable=False)
+    completed_volume_cents = Column(BigInteger, default=0, nullable=False)
+
+    last_review_at = Column(DateTime, nullable=True)
+    # مفهرس: التحديث التدريجي للترتيب يقرأ فقط ما تغير بعد آخر دورة
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class SellerStatsDaily(Base):
+    """
+    نفس الإحصائيات لكن مقسمة بالأيام، لنحسب نافذة آخر 30 يوماً
+    من 30 صفاً على الأكثر (بدون المرور على كل التقييمات).
+    """
+    __tablename__ = 'seller_stats_daily'
+
+    seller_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    reviews_count = Column(Integer, default=0, nullable=False)
+    stars_sum = Column(Integer, default=0, nullable=False)
+
+class AccountType(str, enum.Enum):
+    USER = "user"          # محفظة مستخدم (تنعكس في users.balance_cents)
+    ESCROW = "escrow"      # أموال محجوزة لصفقة معينة
+    FEE = "fee"            # أرباح المنصة (العمولات)
+    EXTERNAL = "external"  # العالم الخارجي: المال الداخل (إيداع) والخارج (سحب)
+    EQUITY = "equity"      # أرصدة افتتاحية لما كان موجوداً قبل تفعيل الدفتر
+    WITHDRAWAL = "withdrawal"  # مبلغ سحب محجوز بانتظار التحويل عبر CryptoBot
+    EXCHANGE = "exchange"  # حساب صرف لكل عملة: يوازن التحويل بين العملات
+
+class DisputeCaseStatus:
+    OPEN = "open"          # في الطابور بانتظار من يستلمها
+    CLAIMED = "claimed"    # استلمها وكيل نزاعات
+    RESOLVED = "resolved"  # صدر الحكم
+
+class DisputeCase(Base):
+    """
+    قضية نزاع في طابور فريق النزاعات (صفقة كاملة أو مرحلة واحدة منها).
+    الأولوية: القضايا التي تجاوزت مهلة الرد أولاً، ثم الأكبر مبلغاً، ثم الأقدم.
+    """
+    __tablename__ = 'dispute_cases'
+
+    id = Column(Integer, primary_key=True)
+    deal_id = Column(BigInteger, ForeignKey('deals.id'), nullable=False, index=True)
+    milestone_id = Column(Integer, ForeignKey('deal_milestones.id'), nullable=True)
+    opened_by = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    # قيمة المال المجمد بالدولار (سنت) لترتيب القضايا من كل العملات معاً
+    amount_usd_cents = Column(BigInteger, default=0)
+    status = Column(String, default=DisputeCaseStatus.OPEN)
+    assigned_to = Column(BigInteger, ForeignKey('admins.user_id'), nullable=True, index=True)
+    resolution = Column(String, nullable=True)  # seller / buyer
+    opened_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+    resolved_at = Column(DateTime, nullable=True)
+
+    deal = relationship("Deal")
+
+    __table_args__ = (
+        # الطابور يقرأ القضايا المفتوحة فقط بترتيب الأولوية
+        Index('ix_dispute_cases_queue', 'status', 'amount_usd_cents', 'opened_at'),
+    )
+
+class UserBalance(Base):
+    """
+    رصيد المستخدم بالعملات غير الأساسية (الأساسية في users.balance_cents).
+    ينعكس من حسابات الدفتر user:<id>:<asset> مثل balance_cents تماماً.
+    """
+    __tablename__ = 'user_balances'
+
+    user_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
+    asset = Column(String, primary_key=True)
+    amount_units = Column(BigInteger, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LedgerAccount(Base):
+    """
+    حساب في دفتر القيد المزدوج.
+    balance_cents هنا رصيد جارٍ (كاش) يساوي دائماً مجموع قيود الحساب،
+    بأصغر وحدة لعملة الحساب (asset).
+    عدا حسابات المنصة المشتركة (ledger.POOLED_TYPES): رصيدها من اللقطات والقيود فقط.
+    """
+    __tablename__ = 'ledger_accounts'
+
+    id = Column(Integer, primary_key=True)
+    account_key = Column(String, unique=True, nullable=False)  # مثال: user:123 / user:123:TON / escrow:deal:45 / fee:platform
+    account_type = Column(Enum(AccountType), nullable=False)
+    asset = Column(String, default="USDT", nullable=False)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=True)
+    deal_id = Column(BigInteger, ForeignKey('deals.id'), nullable=True)
+
+    balance_cents = Column(BigInteger, default=0, nullable=False)
+    entries_since_snapshot = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class JournalEntry(Base):
+    """
+    سطر قيد (Append-only: لا يعدل ولا يحذف أبداً).
+    كل عملية مالية = عدة أسطر بنفس transaction_id ومجموع مبالغها صفر.
+    amount_cents موجب = زيادة رصيد الحساب، سالب = نقصانه.
+    """
+    __tablename__ = 'journal_entries'
+
+    id = Column(BigInteger, primary_key=True)
+    transaction_id = Column(String(36), nullable=False, index=True)
+    account_id = Column(Integer, ForeignKey('ledger_accounts.id'), nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)
+    entry_type = Column(String, nullable=False)  # DEPOSIT / ESCROW_HOLD / RELEASE / REFUND / OPENING
+    deal_id = Column(BigInteger, nullable=True)
+    memo = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    account = relationship("LedgerAccount")
+
+    __table_args__ = (
+        # لحساب الرصيد: القيود بعد آخر لقطة لحساب معين
+        Index('ix_journal_entries_account_id_id', 'account_id', 'id'),
+    )
+
+class LedgerSnapshot(Base):
+    """
+    لقطة دورية لرصيد الحساب حتى قيد معين.
+    الرصيد في أي لحظة = أقرب لقطة قبلها + ذيل قصير من القيود.
+    """
+    __tablename__ = 'ledger_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer, ForeignKey('ledger_accounts.id'), nullable=False)
+    last_entry_id = Column(BigInteger, nullable=False)  # اللقطة تشمل كل القيود حتى هذا الرقم
+    balance_cents = Column(BigInteger, nullable=False)
+    taken_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_ledger_snapshots_account_id_entry', 'account_id', 'last_entry_id'),
+    )
+
+class ReconciliationRun(Base):
+    """سجل كل تشغيل للتسوية، والعلامات (Watermarks) التي وصل إليها"""
+    __tablename__ = 'reconciliation_runs'
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    journal_watermark = Column(BigInteger, default=0)  # آخر JournalEntry.id تمت معالجته
+    audit_watermark = Column(Integer, default=0)       # آخر AuditLog.id تم فحصه
+    users_checked = Column(Integer, default=0)
+    discrepancies = Column(Integer, default=0)
+    audit_chain_ok = Column(Boolean, nullable=True)
+    report_path = Column(String, nullable=True)
+
+class ReconciliationBalance(Base):
+    """
+    الرصيد المتوقع لكل مستخدم، مجمّع تدريجياً بين تشغيل وآخر.
+    - ledger_cents: مجموع قيود محفظته في الدفتر
+    - deposits_cents: مجموع الإيداعات في سجل التدقيق (audit_logs)
+    - deal_net_cents: أثر الصفقات (حجز كمشترٍ / صافي كبائع)
+    """
+    __tablename__ = 'reconciliation_balances'
+
+    user_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
+    ledger_cents = Column(BigInteger, default=0, nullable=False)
+    deposits_cents = Column(BigInteger, default=0, nullable=False)
+    deal_net_cents = Column(BigInteger, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class WithdrawalStatus:
+    PENDING_APPROVAL = "pending_approval"  # مبلغ كبير: ينتظر موافقة فريق المالية
+    QUEUED = "queued"                      # جاهز للتحويل
+    PROCESSING = "processing"              # العامل يحوله الآن
+    COMPLETED = "completed"                # وصل للمستخدم
+    FAILED = "failed"                      # رُفض نهائياً وأعيد المبلغ للمحفظة
+    NEEDS_REVIEW = "needs_review"          # نتيجة تحويل سابق مجهولة: المالية تتحقق في CryptoBot
+
+class Withdrawal(Base):
+    __tablename__ = 'withdrawals'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False, index=True)
+    amount_cents = Column(BigInteger, nullable=False)
+    asset = Column(String, default="USDT")
+    status = Column(String, default=WithdrawalStatus.QUEUED, index=True)
+
+    # معرف فريد نرسله لـ CryptoBot: لو أعدنا المحاولة بنفس الرقم لا يتكرر التحويل
+    spend_id = Column(String(64), unique=True, nullable=True)
+    transfer_id = Column(String, nullable=True)
+
+    approved_by = Column(BigInteger, ForeignKey('users.id'), nullable=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class RevenueEntry(Base):
+    """
+    دفتر الإيرادات: سطر لكل عمولة أخذتها المنصة
+    (صفقة عادية = عمولة واحدة، صفقة بمراحل = عمولة لكل مرحلة).
+    """
+    __tablename__ = 'revenue_entries'
+
+    id = Column(Integer, primary_key=True)
+    deal_id = Column(BigInteger, ForeignKey('deals.id'), nullable=False)
+    milestone_id = Column(Integer, ForeignKey('deal_milestones.id'), nullable=True)
+    seller_id = Column(BigInteger, ForeignKey('users.id'), nullable=False, index=True)
+    fee_tier = Column(String, nullable=True)
+    rate_bps = Column(Integer, nullable=False)        # النسبة المطبقة (500 = 5%)
+    gross_cents = Column(BigInteger, nullable=False)  # مبلغ الصفقة
+    fee_cents = Column(BigInteger, nullable=False)
+    source = Column(String, default="release")        # release / dispute
+    # العمولة بعملة الصفقة نفسها (gross_cents/fee_cents أعلاه بالدولار للتقارير)
+    asset = Column(String, default="USDT")
+    fee_units = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('deal_id', 'milestone_id', name='uq_revenue_entries_deal_milestone'),
+        # NULL لا يساوي NULL في القيد أعلاه: عمولة الصفقة العادية تحتاج فهرسها الخاص
+        Index('uq_revenue_entries_deal_whole', 'deal_id', unique=True,
+              postgresql_where=milestone_id.is_(None)),
+    )
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class RevenueDaily(Base):
+    """
+    مجاميع الإيرادات لكل يوم (تُحدث مع كل عمولة).
+    التقارير الأسبوعية والشهرية تجمع هذه الصفوف فقط بدل المرور على كل الصفقات.
+    """
+    __tablename__ = 'revenue_daily'
+
+    day = Column(Date, primary_key=True)
+    deals_count = Column(Integer, default=0, nullable=False)
+    gross_cents = Column(BigInteger, default=0, nullable=False)
+    fee_cents = Column(BigInteger, default=0, nullable=False)
+
+class ExchangeConversion(Base):
+    """
+    سجل تدقيق لكل تحويل بين عملتين: المبالغ والسعر المستخدم ووقت لقطة الأسعار.
+    """
+    __tablename__ = 'exchange_conversions'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False, index=True)
+    deal_id = Column(BigInteger, ForeignKey('deals.id'), nullable=True, index=True)
+    purpose = Column(String, nullable=False)  # PAYMENT / REFUND
+    from_asset = Column(String, nullable=False)
+    from_units = Column(BigInteger, nullable=False)
+    to_asset = Column(String, nullable=False)
+    to_units = Column(BigInteger, nullable=False)
+    rate = Column(String, nullable=False)  # كم وحدة هدف لكل وحدة مصدر (نص: بدون فقدان دقة)
+    rates_fetched_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class OutboundStatus:
+    PENDING = "pending"  # ينتظر دوره (أو موعد إعادة المحاولة next_attempt_at)
+    SENDING = "sending"  # العامل يرسله الآن
+    SENT = "sent"
+    BLOCKED = "blocked"  # المستخدم حظر البوت أو حذف حسابه: لا نعيد المحاولة
+    FAILED = "failed"    # رفض نهائي أو استنفدت المحاولات
+
+class OutboundMessage(Base):
+    """
+    صندوق الرسائل الصادرة (إشعارات البوت): كل إشعار يسجل هنا أولاً ثم يرسله
+    outbox.outbox_worker بحدود معدل تليجرام، فلا يضيع إشعار عند 429 أو توقف البوت،
+    وتبقى نتيجة التسليم محفوظة لكل إشعار.
+    """
+    __tablename__ = 'outbound_messages'
+
+    id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False, index=True)
+    kind = Column(String(32), nullable=False)  # deal_paid / dispute_resolved / withdrawal ...
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(16), nullable=True)
+    status = Column(String(16), default=OutboundStatus.PENDING, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    telegram_message_id = Column(BigInteger, nullable=True)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    # العامل يبحث عن (pending وحان موعده) بالترتيب
+    __table_args__ = (
+        Index('ix_outbound_messages_due', 'status', 'next_attempt_at'),
+    )
+
+class BroadcastStatus:
+    PENDING = "pending"      # ينتظر العامل
+    RUNNING = "running"      # يرسل الآن (updated_at = نبض العامل)
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+
+class Broadcast(Base):
+    """
+    إعلان لكل المستخدمين. last_user_id نقطة الاستئناف: المستلمون يقرؤون بترتيب id
+    دفعة بعد دفعة، وبعد كل دفعة تحفظ آخر id مع العدادات، فالتوقف لا يعيد الإعلان من أوله.
+    """
+    __tablename__ = 'broadcasts'
+
+    id = Column(Integer, primary_key=True)
+    created_by = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(16), nullable=True)
+    status = Column(String(16), default=BroadcastStatus.PENDING, nullable=False, index=True)
+    last_user_id = Column(BigInteger, default=0, nullable=False)
+    total_recipients = Column(Integer, default=0, nullable=False)  # تقدير عند الإنشاء (للنسبة فقط)
+    sent_count = Column(Integer, default=0, nullable=False)
+    blocked_count = Column(Integer, default=0, nullable=False)
+    failed_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 if __name__ == "__main__":
     # هذا السطر يعمل فقط لو شغلت الملف مباشرة للتجربة
     init_db()
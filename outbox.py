@@ -0,0 +1,227 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError, TelegramError
+from db_services import enqueue_outbound, claim_outbound_batch, finish_outbound
+from models import OutboundStatus
+from metrics import OUTBOUND_MESSAGES, OUTBOUND_LIMIT_WAIT_SECONDS
+
+log = logging.getLogger(__name__)
+
+# حدود تليجرام: حوالي 30 رسالة/ثانية للبوت كله، ورسالة/ثانية لكل محادثة
+GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+PER_CHAT_RATE = float(os.getenv("OUTBOX_PER_CHAT_RATE", "1"))
+PER_CHAT_BURST = float(os.getenv("OUTBOX_PER_CHAT_BURST", "1"))
+# الإرسال الفوري (send_now) ينتظر RetryAfter القصير بنفسه، والأطول يفشل ويعيد None
+MAX_INLINE_RETRY_AFTER = float(os.getenv("OUTBOX_MAX_INLINE_RETRY_AFTER", "10"))
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "100"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+# أخطاء الشبكة: إعادة بتأخير متزايد حتى هذا العدد من المحاولات ثم FAILED
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+MAX_BACKOFF_SECONDS = 300
+# عند هذا العدد من المحادثات المتتبعة نحذف ما امتلأ رصيده (لم يرسل لها مؤخراً)
+MAX_TRACKED_CHATS = 10000
+
+
+class TokenBucket:
+    """
+    دلو توكنات بالحجز المسبق: كل رسالة تحجز توكنها فوراً (قد يصبح الرصيد سالباً)
+    وتنتظر المدة المحسوبة. الترتيب يبقى بترتيب الطلب بدون أقفال (حلقة أحداث واحدة).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """يحجز توكناً ويعيد عدد الثواني قبل أن يصبح استخدامه مسموحاً"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, self.paused_until - now, 0.0)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def paused_for(self):
+        return max(self.paused_until - time.monotonic(), 0.0)
+
+    def is_idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and self.paused_until <= time.monotonic()
+
+
+class SendLimiter:
+    """الحد العام + حد لكل محادثة: الرسالة تنتظر دور محادثتها أولاً ثم الدور العام"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE, per_chat_burst=PER_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id):
+        start = time.perf_counter()
+        wait = self._chat_bucket(chat_id).reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        # التوكن العام يحجز بعد انتهاء انتظار المحادثة (لا نضيع دوراً عاماً على رسالة منتظرة)
+        wait = self.global_bucket.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        OUTBOUND_LIMIT_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    def pause_chat(self, chat_id, seconds):
+        self._chat_bucket(chat_id).pause(seconds)
+
+    def pause_all(self, chat_id, seconds):
+        """RetryAfter: تليجرام يحد البوت كله، فكل الإرسال يتوقف لا هذه المحادثة وحدها"""
+        self.pause_chat(chat_id, seconds)
+        self.global_bucket.pause(seconds)
+
+
+limiter = SendLimiter()
+# يوقظ العامل فور تسجيل إشعار جديد (بدل انتظار الدورة التالية)
+_wakeup = asyncio.Event()
+
+
+def _retry_seconds(error):
+    """RetryAfter.retry_after قد يكون رقماً أو timedelta حسب إصدار المكتبة"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+# --- إرسال فوري (يحتاج المستدعي نتيجته) ---
+async def send_with_outcome(bot, chat_id, method="send_message", kind="reply", **kwargs):
+    """
+    يرسل الآن ضمن حدود المعدل (ينتظر دوره).
+    تعيد (النتيجة، الرسالة): sent / blocked / rate_limited / failed، والرسالة None عند الفشل.
+    rate_limited: RetryAfter لم ينته (limiter.global_bucket.paused_for() = المتبقي)، والمستدعي يعيد لاحقاً.
+    ملاحظة: الملفات تمرر bytes لا ملفاً مفتوحاً، حتى تصح إعادة المحاولة بعد RetryAfter.
+    """
+    send = getattr(bot, method)
+    outcome, message = "failed", None
+    for attempt in range(2):
+        await limiter.acquire(chat_id)
+        try:
+            message = await send(chat_id=chat_id, **kwargs)
+            outcome = "sent"
+            break
+        except RetryAfter as e:
+            wait = _retry_seconds(e)
+            limiter.pause_all(chat_id, wait)
+            if attempt or wait > MAX_INLINE_RETRY_AFTER:
+                log.warning("Send rate limited", extra={"chat_id": chat_id, "retry_after": wait})
+                outcome = "rate_limited"
+                break
+            # المحاولة الثانية تنتظر في acquire حتى تنتهي مهلة التوقف
+        except Forbidden:
+            outcome = "blocked"
+            break
+        except TelegramError:
+            log.warning("Send failed", extra={"chat_id": chat_id}, exc_info=True)
+            break
+    OUTBOUND_MESSAGES.labels(kind=kind, outcome=outcome).inc()
+    return outcome, message
+
+
+async def send_now(bot, chat_id, method="send_message", kind="reply", **kwargs):
+    """
+    مثل send_with_outcome لكن تعيد الرسالة المرسلة فقط (أو None عند الفشل).
+    للرسائل التي يجب أن تصل لاحقاً حتى لو فشلت الآن استخدم notify.
+    """
+    _, message = await send_with_outcome(bot, chat_id, method, kind, **kwargs)
+    return message
+
+
+# --- إشعارات مضمونة (outbox) ---
+async def notify_many(messages):
+    """
+    تسجيل إشعارات في outbound_messages ليرسلها العامل (لا ينتظر الإرسال نفسه).
+    messages: قواميس فيها chat_id, kind, text, parse_mode (اختياري).
+    """
+    ids = await asyncio.to_thread(enqueue_outbound, messages)
+    if ids:
+        _wakeup.set()
+    return ids
+
+
+async def notify(chat_id, text, kind, parse_mode=None):
+    return await notify_many([{"chat_id": chat_id, "kind": kind, "text": text, "parse_mode": parse_mode}])
+
+
+async def _deliver(bot, item):
+    chat_id = item["chat_id"]
+    status, retry_at, error, message_id = OutboundStatus.SENT, None, None, None
+    await limiter.acquire(chat_id)
+    try:
+        message = await bot.send_message(chat_id, item["text"], parse_mode=item["parse_mode"])
+        message_id = message.message_id
+        outcome = "sent"
+    except RetryAfter as e:
+        wait = _retry_seconds(e)
+        limiter.pause_all(chat_id, wait)
+        outcome, error = "retry", f"RetryAfter {wait:.0f}s"
+        retry_at = datetime.utcnow() + timedelta(seconds=wait)
+    except Forbidden as e:
+        outcome, status, error = "blocked", OutboundStatus.BLOCKED, str(e)
+    except BadRequest as e:
+        # المحادثة غير موجودة = مثل الحظر (لن تنجح أبداً)، وغيرها خطأ في الرسالة نفسها
+        blocked = "chat not found" in str(e).lower()
+        outcome = "blocked" if blocked else "failed"
+        status = OutboundStatus.BLOCKED if blocked else OutboundStatus.FAILED
+        error = str(e)
+    except NetworkError as e:
+        error = str(e)
+        if item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            outcome, status = "failed", OutboundStatus.FAILED
+        else:
+            outcome = "retry"
+            retry_at = datetime.utcnow() + timedelta(seconds=min(2 ** item["attempts"], MAX_BACKOFF_SECONDS))
+    except TelegramError as e:
+        outcome, status, error = "failed", OutboundStatus.FAILED, str(e)
+
+    OUTBOUND_MESSAGES.labels(kind=item["kind"], outcome=outcome).inc()
+    if outcome == "failed":
+        log.warning("Notification failed", extra={"outbound_id": item["id"], "chat_id": chat_id, "error": error})
+    await asyncio.to_thread(
+        finish_outbound, item["id"], status,
+        error=error, telegram_message_id=message_id, retry_at=retry_at,
+    )
+
+
+async def outbox_worker(bot):
+    """حلقة خلفية تعمل بعمر البوت: ترسل الإشعارات المسجلة بحدود المعدل"""
+    while True:
+        _wakeup.clear()
+        try:
+            items = await asyncio.to_thread(claim_outbound_batch, OUTBOX_BATCH)
+            if items:
+                # الحجز في limiter يحدث بترتيب بدء المهام، فترتيب رسائل كل محادثة محفوظ
+                await asyncio.gather(*(_deliver(bot, item) for item in items))
+        except Exception:
+            log.exception("Outbox worker error")
+            items = []
+        if len(items) < OUTBOX_BATCH:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
@@ -1,7 +1,13 @@
 # payment_services.py
 import os
+import logging
+from contextlib import contextmanager
 from aiocryptopay import AioCryptoPay, Networks
+from aiocryptopay.exceptions import CodeErrorFactory
 from dotenv import load_dotenv
+from metrics import cryptobot_call
+from tracing import tracer
+from opentelemetry.trace import SpanKind
 
 load_dotenv()
 
@@ -13,42 +19,55 @@ if token is None:
     print("❌ خطأ: لم يتم العثور على CRYPTO_BOT_TOKEN في ملف .env")
 
 # تحديد الشبكة (تجريبي أم حقيقي)
-network = Networks.TEST_NET if network_env == "testnet" else Networks.MAIN_NET
+IS_TESTNET = network_env == "testnet"
+network = Networks.TEST_NET if IS_TESTNET else Networks.MAIN_NET
 
 # إنشاء كائن الدفع
 crypto = AioCryptoPay(token=token, network=network)
 
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def _api_call(method):
+    """كل طلب لـ CryptoBot: زمن وأخطاء في المقاييس + span في التتبع"""
+    with cryptobot_call(method), tracer.start_as_current_span(f"cryptobot.{method}", kind=SpanKind.CLIENT):
+        yield
+
 
 async def get_exchange_rates():
     """
-    دالة إضافية لجلب أسعار العملات لو أردت التحويل
+    جلب أسعار العملات (يستدعيها exchange_rates.rates_refresher فقط،
+    والباقي يقرأ اللقطة المخزنة)
     """
-    rates = await crypto.get_exchange_rates()
+    with _api_call("get_exchange_rates"):
+        rates = await crypto.get_exchange_rates()
     return rates
 
 
-async def create_deposit_invoice(user_id, amount_usd):
+async def create_deposit_invoice(user_id, amount_usd, asset="USDT"):
     """
-    تنشئ رابط دفع لعملة USDT
+    تنشئ رابط دفع بالعملة المطلوبة (USDT افتراضياً)
     """
     try:
-        invoice = await crypto.create_invoice(
-            asset="USDT",  # العملة المطلوبة
-            amount=amount_usd,  # المبلغ (مثلاً 10.5)
-            description=f"Top up balance for user {user_id}",
-            payload=str(user_id),  # نخبئ هوية المستخدم هنا
-            expires_in=900,  # 15 دقيقة
-            allow_comments=False,  # لا نريد تعليقات من المستخدم
-            allow_anonymous=False  # يفضل أن نعرف من دفع
-        )
+        with _api_call("create_invoice"):
+            invoice = await crypto.create_invoice(
+                asset=asset,  # العملة المطلوبة
+                amount=amount_usd,  # المبلغ (مثلاً 10.5)
+                description=f"Top up balance for user {user_id}",
+                payload=str(user_id),  # نخبئ هوية المستخدم هنا
+                expires_in=900,  # 15 دقيقة
+                allow_comments=False,  # لا نريد تعليقات من المستخدم
+                allow_anonymous=False  # يفضل أن نعرف من دفع
+            )
 
         return {
             "invoice_id": invoice.invoice_id,
             "pay_url": invoice.bot_invoice_url,  # الرابط الذي سنرسله للمستخدم
             "hash": invoice.hash,  # نحتاجه للتحقق لاحقاً
         }
-    except Exception as e:
-        print(f"Error creating invoice: {e}")
+    except Exception:
+        log.exception("Error creating invoice")
         return None
 
 
@@ -57,9 +76,42 @@ async def check_invoice_status(invoice_id):
     نسأل CryptoBot: ما هي حالة هذه الفاتورة الآن؟
     """
     try:
-        invoices = await crypto.get_invoices(invoice_ids=[invoice_id])
+        with _api_call("get_invoices"):
+            invoices = await crypto.get_invoices(invoice_ids=[invoice_id])
         if invoices:
             return invoices[0].status  # (paid, active, expired)
-    except Exception as e:
-        print(f"Error checking invoice: {e}")
+    except Exception:
+        log.exception("Error checking invoice")
     return None
+
+
+# أخطاء CryptoBot التي تعني أن المشكلة عندنا (مؤقتة) وليست في طلب المستخدم:
+# لا نعيد المال للمحفظة، بل نعيد المحاولة لاحقاً بنفس spend_id
+RETRYABLE_TRANSFER_ERRORS = {"INSUFFICIENT_FUNDS", "APP_BALANCE_NOT_ENOUGH", "TOO_MANY_REQUESTS"}
+
+
+async def send_transfer(user_id, amount, spend_id, asset="USDT"):
+    """
+    تحويل من رصيد التطبيق إلى مستخدم في CryptoBot.
+    spend_id يجعل الطلب Idempotent: إعادة المحاولة لا تسبب تحويلاً مكرراً.
+    تعيد: ("OK", transfer_id) أو ("FAILED", سبب) أو ("RETRY", سبب)
+    """
+    try:
+        with _api_call("transfer"):
+            transfer = await crypto.transfer(
+                user_id=user_id,
+                asset=asset,
+                amount=amount,
+                spend_id=spend_id,
+                comment="Escrow bot withdrawal",
+            )
+        return "OK", transfer.transfer_id
+    except CodeErrorFactory as e:
+        # خطأ من الـ API نفسه (مثلاً المستخدم لم يفتح CryptoBot أبداً)
+        if e.name in RETRYABLE_TRANSFER_ERRORS or (e.code or 0) >= 500:
+            return "RETRY", str(e.name)
+        return "FAILED", str(e.name)
+    except Exception as e:
+        # انقطاع شبكة/مهلة: لا نعرف هل تم التحويل، نعيد بنفس spend_id
+        log.warning("Transfer outcome unknown, will retry", exc_info=True)
+        return "RETRY", str(e)
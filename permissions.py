@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from models import Session, Admin, AdminRole, engine
+
+log = logging.getLogger(__name__)
+
+# قناة Postgres التي يعلن عليها أي تغيير في جدول admins (الـ trigger بالأسفل)
+ADMINS_CHANNEL = "admins_changed"
+# إعادة تحميل احتياطية حتى لو ضاع إشعار (انقطاع الاتصال مثلاً)
+PERMISSIONS_REFRESH_SECONDS = 300
+
+# {user_id: (AdminRole, pin_hash)}: يستبدل كاملاً عند كل تحميل (لا تعديل في المكان)
+_admins = {}
+_loaded = False
+
+NOTIFY_TRIGGER_DDL = [
+    f"""
+    CREATE OR REPLACE FUNCTION notify_admins_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{ADMINS_CHANNEL}', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS admins_changed ON admins",
+    # عدادات عبء العمل (open_cases...) تتغير كثيراً ولا تهم الصلاحيات، فلا نعلن عنها
+    """
+    CREATE TRIGGER admins_changed
+    AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF user_id, role, pin_hash ON admins
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_admins_changed()
+    """,
+]
+
+
+def reload_permissions():
+    """تحميل كل الأدمن وصلاحياتهم من القاعدة (استعلام واحد)"""
+    global _admins, _loaded
+    session = Session()
+    try:
+        rows = session.query(Admin.user_id, Admin.role, Admin.pin_hash).all()
+        _admins = {r.user_id: (r.role, r.pin_hash) for r in rows}
+        _loaded = True
+        return len(_admins)
+    finally:
+        session.close()
+
+
+def _ensure_loaded():
+    if not _loaded:
+        reload_permissions()
+
+
+def get_role(user_id):
+    """صلاحية الأدمن (AdminRole) أو None لغير الأدمن: بحث في قاموس فقط"""
+    _ensure_loaded()
+    entry = _admins.get(int(user_id))
+    return entry[0] if entry else None
+
+
+def get_pin_hash(user_id):
+    _ensure_loaded()
+    entry = _admins.get(int(user_id))
+    return entry[1] if entry else None
+
+
+def role_allows(role, required_role):
+    return role is not None and (
+        not required_role or role == required_role or role == AdminRole.SUPER_ADMIN
+    )
+
+
+def has_role(user_id, required_role=None):
+    return role_allows(get_role(user_id), required_role)
+
+
+def admins_with_role(required_role):
+    """كل من يملك الصلاحية (المدير العام دائماً منهم): لتوزيع الإشعارات"""
+    _ensure_loaded()
+    return [uid for uid, (role, _) in _admins.items() if role_allows(role, required_role)]
+
+
+def _listen_connection():
+    """اتصال مخصص خارج الـ pool (LISTEN يحتاج اتصالاً يبقى مفتوحاً بوضع autocommit)"""
+    raw = engine.raw_connection()
+    raw.detach()
+    conn = raw.dbapi_connection
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {ADMINS_CHANNEL}")
+    return conn
+
+
+async def permissions_listener():
+    """
+    حلقة خلفية: تعيد تحميل الصلاحيات فور أي تغيير في جدول admins (LISTEN/NOTIFY).
+    الاتصال يراقب بـ add_reader على حلقة الأحداث، فلا يحجز أي خيط أثناء الانتظار.
+    """
+    loop = asyncio.get_running_loop()
+    # الـ trigger نفسه تثبته migrations.py (خطوة admins_changed)
+
+    while True:
+        conn = None
+        changed = asyncio.Event()
+        state = {"error": None}
+
+        def on_notify():
+            try:
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    changed.set()
+            except Exception as e:
+                state["error"] = e
+                changed.set()
+
+        try:
+            conn = await asyncio.to_thread(_listen_connection)
+            loop.add_reader(conn.fileno(), on_notify)
+            # ما تغير أثناء انقطاع الاتصال لم يصلنا إشعاره
+            await asyncio.to_thread(reload_permissions)
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=PERMISSIONS_REFRESH_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                notified = changed.is_set()
+                changed.clear()
+                if state["error"]:
+                    raise state["error"]
+                count = await asyncio.to_thread(reload_permissions)
+                if notified:
+                    log.info("Permissions reloaded", extra={"admins": count})
+        except Exception:
+            log.exception("Permissions listener error")
+            await asyncio.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    loop.remove_reader(conn.fileno())
+                    conn.close()
+                except Exception:
+                    pass
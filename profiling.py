@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import asyncio
+import cProfile
+import logging
+import functools
+import threading
+from collections import Counter
+from datetime import datetime
+from metrics import handler_label, iter_handlers
+
+log = logging.getLogger(__name__)
+
+# ملفات التحليل: .folded (Flame Graph: flamegraph.pl / speedscope) و .prof (pstats / snakeviz)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# 200 عينة/ثانية: تكلفة العينة الواحدة بضع ميكروثوان في خيط منفصل
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+MAX_SAMPLE_SECONDS = 300
+MAX_ARMED_CALLS = 20
+
+# {اسم المعالج أو المسار: عدد الاستدعاءات المتبقية للتسجيل}
+# وهو فارغ في الوضع العادي: الفحص الوحيد على المسار الساخن هو "هل القاموس فارغ؟"
+_armed = {}
+# أسماء المعالجات المغلفة (للتحقق من الاسم قبل التفعيل)
+known_labels = set()
+# تحليل واحد فقط في كل لحظة (cProfile لا يقبل محللين متداخلين، والعينات تتداخل معه)
+_busy = threading.Lock()
+
+
+def _output_path(name, suffix):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_") or "profile"
+    return os.path.join(PROFILE_DIR, f"{safe}-{datetime.utcnow():%Y%m%dT%H%M%S}{suffix}")
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_stacks(thread_id, seconds, interval):
+    """يعمل في خيط منفصل: يقرأ مكدس الخيط المستهدف كل interval ويعد المكدسات المتطابقة"""
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            parts = []
+            while frame is not None:
+                parts.append(_frame_label(frame))
+                frame = frame.f_back
+            stacks[";".join(reversed(parts))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def sample_event_loop(seconds, name="loop"):
+    """
+    تحليل إحصائي لخيط حلقة الأحداث (كل ما ينفذه البوت أو الخادم) لمدة seconds.
+    لا شيء يعمل قبل الاستدعاء ولا بعده. يعيد (مسار ملف .folded، أكثر الدوال ظهوراً)
+    أو (None, None) إن كان تحليل آخر جارياً.
+    """
+    seconds = max(1, min(int(seconds), MAX_SAMPLE_SECONDS))
+    if not _busy.acquire(blocking=False):
+        return None, None
+    try:
+        loop_thread = threading.get_ident()
+        stacks = await asyncio.to_thread(_sample_stacks, loop_thread, seconds, SAMPLE_INTERVAL)
+    finally:
+        _busy.release()
+
+    path = _output_path(name, ".folded")
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    # الدالة في قمة المكدس = أين كان الخيط فعلاً (self time)
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    total = sum(stacks.values()) or 1
+    top = [(leaf, round(100 * count / total, 1)) for leaf, count in leaves.most_common(10)]
+    log.info("Profile written", extra={"path": path, "samples": total, "seconds": seconds})
+    return path, top
+
+
+def arm(label, calls=1):
+    """تسجيل cProfile لأول calls استدعاءات قادمة لهذا المعالج/المسار"""
+    _armed[label] = max(1, min(int(calls), MAX_ARMED_CALLS))
+
+
+def armed():
+    return dict(_armed)
+
+
+def _take(label):
+    remaining = _armed.get(label)
+    if not remaining or not _busy.acquire(blocking=False):
+        return False
+    if remaining <= 1:
+        del _armed[label]
+    else:
+        _armed[label] = remaining - 1
+    return True
+
+
+async def profiled(label, call):
+    """
+    call: دالة بدون معاملات تعيد awaitable (المعالج نفسه).
+    ملاحظة: cProfile يسجل كل ما يعمل في حلقة الأحداث أثناء الاستدعاء، بما فيه مهام أخرى متزامنة.
+    """
+    if not _armed or not _take(label):
+        return await call()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return await call()
+    finally:
+        profiler.disable()
+        _busy.release()
+        path = _output_path(label, ".prof")
+        profiler.dump_stats(path)
+        log.info("Handler profile written", extra={"path": path, "target": label})
+
+
+def _profiled_handler(label, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not _armed:
+            return await callback(update, context)
+        return await profiled(label, lambda: callback(update, context))
+    return wrapper
+
+
+def profile_handlers(application):
+    """يستدعى بعد تسجيل كل المعالجات (مثل instrument_handlers)"""
+    for handler in iter_handlers(application):
+        label = handler_label(handler)
+        known_labels.add(label)
+        handler.callback = _profiled_handler(label, handler.callback)
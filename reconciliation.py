@@ -0,0 +1,351 @@
+import os
+import csv
+import hashlib
+import logging
+from decimal import Decimal
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, union, union_all, update, and_, or_, cast, exists, BigInteger
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from assets import BASE_ASSET
+from models import (
+    Session,
+    User,
+    Deal,
+    DealStatus,
+    DealMilestone,
+    AuditLog,
+    AccountType,
+    LedgerAccount,
+    JournalEntry,
+    ReconciliationRun,
+    ReconciliationBalance,
+    Withdrawal,
+    WithdrawalStatus,
+)
+
+log = logging.getLogger(__name__)
+
+# التسوية تغطي العملة الأساسية (users.balance_cents). الأرصدة بالعملات الأخرى
+# لا يوجد لها مصدر مستقل غير الدفتر نفسه.
+REPORTS_DIR = os.getenv("RECONCILIATION_REPORTS_DIR", "reports")
+STREAM_BATCH = 5000
+# الصفقات التي اكتملت قبل تفعيل الدفتر لا يوجد لها قيد عمولة، فنستخدم النسبة القديمة
+LEGACY_FEE_RATE = Decimal("0.05")
+# حالات يكون فيها مال المشتري خارج محفظته (محجوز أو ذهب للبائع)
+HELD_STATUSES = [DealStatus.ACTIVE, DealStatus.DELIVERED, DealStatus.DISPUTE, DealStatus.COMPLETED]
+# معاملة بدأت قبل اللقطة قد تُثبت (commit) بعدها برقم أصغر من العلامة،
+# لذلك لا نعالج إلا ما هو أقدم من هذا الهامش
+IN_FLIGHT_MARGIN = timedelta(minutes=5)
+# قفل استشاري حتى لا يعمل تشغيلان في نفس الوقت
+RECONCILIATION_LOCK_ID = 0x5EC0
+
+
+def _last_run(session):
+    return (
+        session.query(ReconciliationRun)
+        .filter(ReconciliationRun.finished_at != None)
+        .order_by(ReconciliationRun.id.desc())
+        .first()
+    )
+
+
+def _upsert_balances(session, column, per_user_select, accumulate=True):
+    """إدخال/تحديث عمود واحد في reconciliation_balances من استعلام (user_id, قيمة)"""
+    stmt = pg_insert(ReconciliationBalance).from_select(["user_id", column], per_user_select)
+    current = getattr(ReconciliationBalance, column)
+    new_value = current + getattr(stmt.excluded, column) if accumulate else getattr(stmt.excluded, column)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ReconciliationBalance.user_id],
+            set_={column: new_value, "updated_at": datetime.utcnow()},
+        )
+    )
+
+
+def _accumulate_ledger(session, after_id, upto_id):
+    """قيود محافظ المستخدمين الجديدة فقط (بعد العلامة)"""
+    per_user = (
+        select(LedgerAccount.user_id, cast(func.sum(JournalEntry.amount_cents), BigInteger))
+        .join(LedgerAccount, LedgerAccount.id == JournalEntry.account_id)
+        .where(
+            LedgerAccount.account_type == AccountType.USER,
+            LedgerAccount.asset == BASE_ASSET,
+            JournalEntry.id > after_id,
+            JournalEntry.id <= upto_id,
+        )
+        .group_by(LedgerAccount.user_id)
+    )
+    _upsert_balances(session, "ledger_cents", per_user)
+
+
+def _accumulate_deposits(session, after_id, upto_id):
+    """الإيداعات الجديدة من سجل التدقيق (المستقل عن الدفتر)"""
+    per_user = (
+        select(AuditLog.user_id, cast(func.sum(AuditLog.amount_cents), BigInteger))
+        .where(AuditLog.action == "DEPOSIT", AuditLog.id > after_id, AuditLog.id <= upto_id)
+        .group_by(AuditLog.user_id)
+    )
+    _upsert_balances(session, "deposits_cents", per_user)
+
+
+def _recompute_deal_side(session, since):
+    """
+    الصفقات تتغير حالتها، فلا يمكن جمعها تراكمياً.
+    نعيد حساب أثر الصفقات (والسحوبات) فقط للمستخدمين الذين تغير لهم شيء منذ آخر تشغيل.
+    """
+    buyers = select(Deal.buyer_id.label("uid")).where(Deal.buyer_id != None)
+    sellers = select(Deal.seller_id.label("uid"))
+    withdrawers = select(Withdrawal.user_id.label("uid"))
+    # تحرير مرحلة لا يلمس صف الصفقة، فنأخذ أطراف الصفقات التي تغيرت مراحلها
+    milestone_buyers = (
+        select(Deal.buyer_id.label("uid"))
+        .join(DealMilestone, DealMilestone.deal_id == Deal.id)
+        .where(Deal.buyer_id != None)
+    )
+    milestone_sellers = select(Deal.seller_id.label("uid")).join(DealMilestone, DealMilestone.deal_id == Deal.id)
+    if since is not None:
+        buyers = buyers.where(Deal.updated_at > since)
+        sellers = sellers.where(Deal.updated_at > since)
+        withdrawers = withdrawers.where(Withdrawal.updated_at > since)
+        milestone_buyers = milestone_buyers.where(DealMilestone.updated_at > since)
+        milestone_sellers = milestone_sellers.where(DealMilestone.updated_at > since)
+    affected = union(buyers, sellers, withdrawers, milestone_buyers, milestone_sellers).subquery()
+    affected_ids = select(affected.c.uid)
+
+    # نصفر أولاً (مستخدم ألغيت صفقته الوحيدة يجب أن يعود أثره صفراً)
+    session.execute(
+        update(ReconciliationBalance)
+        .where(ReconciliationBalance.user_id.in_(affected_ids))
+        .values(deal_net_cents=0)
+    )
+
+    fees = (
+        select(JournalEntry.deal_id, func.sum(JournalEntry.amount_cents).label("fee"))
+        .join(LedgerAccount, LedgerAccount.id == JournalEntry.account_id)
+        .where(
+            LedgerAccount.account_type == AccountType.FEE,
+            LedgerAccount.asset == BASE_ASSET,
+            JournalEntry.deal_id != None,
+        )
+        .group_by(JournalEntry.deal_id)
+        .subquery()
+    )
+    # ما دفعه المشتري بالعملة الأساسية (الصفقات القديمة: paid_* فارغة = المبلغ نفسه)
+    holds = select(
+        Deal.buyer_id.label("uid"), (-func.coalesce(Deal.paid_units, Deal.amount_cents)).label("net")
+    ).where(
+        Deal.buyer_id.in_(affected_ids),
+        Deal.status.in_(HELD_STATUSES),
+        func.coalesce(Deal.paid_asset, Deal.asset, BASE_ASSET) == BASE_ASSET,
+    )
+    has_milestones = exists().where(DealMilestone.deal_id == Deal.id)
+    # مراحل أعيد مبلغها للمشتري بينما بقيت الصفقة محسوبة كمحجوزة
+    milestone_refunds = (
+        select(Deal.buyer_id.label("uid"), DealMilestone.amount_cents.label("net"))
+        .join(DealMilestone, DealMilestone.deal_id == Deal.id)
+        .where(
+            Deal.buyer_id.in_(affected_ids),
+            Deal.status.in_(HELD_STATUSES),
+            DealMilestone.status == DealStatus.CANCELED,
+            func.coalesce(Deal.paid_asset, Deal.asset, BASE_ASSET) == BASE_ASSET,
+            func.coalesce(Deal.asset, BASE_ASSET) == BASE_ASSET,
+        )
+    )
+    legacy_fee = func.round(Deal.amount_cents * LEGACY_FEE_RATE)
+    releases = (
+        select(
+            Deal.seller_id.label("uid"),
+            (Deal.amount_cents - func.coalesce(fees.c.fee, legacy_fee)).label("net"),
+        )
+        .outerjoin(fees, fees.c.deal_id == Deal.id)
+        .where(
+            Deal.seller_id.in_(affected_ids),
+            Deal.status == DealStatus.COMPLETED,
+            func.coalesce(Deal.asset, BASE_ASSET) == BASE_ASSET,
+            ~has_milestones,
+        )
+    )
+    # صفقات المراحل: كل مرحلة محررة تصل للبائع أياً كانت حالة الصفقة
+    milestone_releases = (
+        select(
+            Deal.seller_id.label("uid"),
+            (func.sum(DealMilestone.amount_cents) - func.coalesce(func.max(fees.c.fee), 0)).label("net"),
+        )
+        .join(DealMilestone, DealMilestone.deal_id == Deal.id)
+        .outerjoin(fees, fees.c.deal_id == Deal.id)
+        .where(
+            Deal.seller_id.in_(affected_ids),
+            DealMilestone.status == DealStatus.COMPLETED,
+            func.coalesce(Deal.asset, BASE_ASSET) == BASE_ASSET,
+        )
+        .group_by(Deal.id, Deal.seller_id)
+    )
+    # السحب يخرج المال من المحفظة ما لم يفشل نهائياً (عندها أعيد المبلغ)
+    withdrawals = select(
+        Withdrawal.user_id.label("uid"), (-Withdrawal.amount_cents).label("net")
+    ).where(Withdrawal.user_id.in_(affected_ids), Withdrawal.status != WithdrawalStatus.FAILED)
+    movements = union_all(holds, milestone_refunds, releases, milestone_releases, withdrawals).subquery()
+    per_user = select(
+        movements.c.uid, cast(func.sum(movements.c.net), BigInteger)
+    ).group_by(movements.c.uid)
+    _upsert_balances(session, "deal_net_cents", per_user, accumulate=False)
+
+
+def _verify_audit_chain(session, after_id, upto_id):
+    """
+    نعيد حساب بصمات سلسلة التدقيق من آخر نقطة تم فحصها فقط.
+    تعيد قائمة أرقام السجلات المكسورة.
+    """
+    prev_hash = None
+    if after_id:
+        prev_hash = session.query(AuditLog.current_hash).filter_by(id=after_id).scalar()
+
+    rows = session.execute(
+        select(
+            AuditLog.id,
+            AuditLog.user_id,
+            AuditLog.action,
+            AuditLog.amount_cents,
+            AuditLog.details,
+            AuditLog.previous_hash,
+            AuditLog.current_hash,
+        )
+        .where(AuditLog.id > after_id, AuditLog.id <= upto_id)
+        .order_by(AuditLog.id)
+        .execution_options(yield_per=STREAM_BATCH)
+    )
+
+    broken = []
+    for r in rows:
+        expected_prev = prev_hash if prev_hash is not None else "GENESIS_BLOCK_HASH"
+        # نفس صيغة log_audit_event في db_services
+        raw_data = f"{r.previous_hash}{r.user_id}{r.action}{r.amount_cents}{r.details or ''}"
+        recomputed = hashlib.sha256(raw_data.encode("utf-8")).hexdigest()
+        if r.previous_hash != expected_prev or recomputed != r.current_hash:
+            broken.append(r.id)
+        prev_hash = r.current_hash
+    return broken
+
+
+def _stream_discrepancies(session, journal_upto, audit_upto):
+    """
+    مقارنة واحدة لكل المستخدمين (JOIN واحد) تُقرأ على دفعات.
+    نعيد فقط من لا تتطابق أرقامه.
+    المستخدم الذي له حركة أحدث من العلامات لا نقارن مجاميعه (ستُحسب في التشغيل القادم).
+    """
+    rb = ReconciliationBalance
+    settled = and_(
+        ~exists().where(JournalEntry.account_id == LedgerAccount.id, JournalEntry.id > journal_upto),
+        ~exists().where(AuditLog.user_id == User.id, AuditLog.id > audit_upto),
+    )
+    activity = func.coalesce(rb.deposits_cents, 0) + func.coalesce(rb.deal_net_cents, 0)
+    query = (
+        select(
+            User.id,
+            User.balance_cents,
+            LedgerAccount.balance_cents.label("ledger_cached"),
+            rb.ledger_cents,
+            activity.label("activity_expected"),
+        )
+        .outerjoin(rb, rb.user_id == User.id)
+        .outerjoin(
+            LedgerAccount,
+            and_(
+                LedgerAccount.user_id == User.id,
+                LedgerAccount.account_type == AccountType.USER,
+                LedgerAccount.asset == BASE_ASSET,
+            ),
+        )
+        .where(
+            or_(
+                # 1. الرصيد المعروض ≠ الرصيد الجاري في الدفتر
+                and_(LedgerAccount.id != None, LedgerAccount.balance_cents != User.balance_cents),
+                # 2. الرصيد الجاري ≠ مجموع القيود الفعلي
+                and_(settled, LedgerAccount.id != None,
+                     func.coalesce(rb.ledger_cents, 0) != LedgerAccount.balance_cents),
+                # 3. الرصيد ≠ (إيداعات - حجوزات + صافي المبيعات - السحوبات)
+                and_(settled, activity != User.balance_cents),
+            )
+        )
+        .order_by(User.id)
+        .execution_options(yield_per=STREAM_BATCH)
+    )
+    return session.execute(query)
+
+
+def run_reconciliation():
+    """
+    تشغيل تسوية كامل (يُستدعى ليلياً): يعمل تدريجياً من آخر علامة،
+    ويكتب تقرير الفروقات في ملف CSV. يعيد قاموس ملخص أو None.
+    """
+    session = Session()
+    try:
+        # كل القراءات داخل معاملة واحدة = لقطة ثابتة للبيانات رغم استمرار البوت بالعمل
+        if not session.execute(select(func.pg_try_advisory_xact_lock(RECONCILIATION_LOCK_ID))).scalar():
+            log.warning("Reconciliation already running")
+            return None
+
+        last = _last_run(session)
+        journal_after = last.journal_watermark if last else 0
+        audit_after = last.audit_watermark if last else 0
+        since = last.started_at - IN_FLIGHT_MARGIN if last else None
+
+        run = ReconciliationRun(started_at=datetime.utcnow())
+        session.add(run)
+        session.flush()
+
+        settled_before = run.started_at - IN_FLIGHT_MARGIN
+        journal_upto = max(journal_after, session.query(func.coalesce(func.max(JournalEntry.id), 0))
+                           .filter(JournalEntry.created_at < settled_before).scalar())
+        audit_upto = max(audit_after, session.query(func.coalesce(func.max(AuditLog.id), 0))
+                         .filter(AuditLog.timestamp < settled_before).scalar())
+
+        _accumulate_ledger(session, journal_after, journal_upto)
+        _accumulate_deposits(session, audit_after, audit_upto)
+        _recompute_deal_side(session, since)
+        broken_audit = _verify_audit_chain(session, audit_after, audit_upto)
+
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        report_path = os.path.join(
+            REPORTS_DIR, f"reconciliation-{run.id}-{run.started_at:%Y%m%d%H%M%S}.csv"
+        )
+        discrepancies = 0
+        with open(report_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "user_id", "balance_cents", "ledger_cached_cents",
+                             "ledger_expected_cents", "activity_expected_cents", "audit_log_id"])
+            for row in _stream_discrepancies(session, journal_upto, audit_upto):
+                writer.writerow(["balance", row.id, row.balance_cents, row.ledger_cached,
+                                 row.ledger_cents, row.activity_expected, ""])
+                discrepancies += 1
+            for log_id in broken_audit:
+                writer.writerow(["audit_chain", "", "", "", "", "", log_id])
+
+        run.finished_at = datetime.utcnow()
+        run.journal_watermark = journal_upto
+        run.audit_watermark = audit_upto
+        run.users_checked = session.query(func.count(User.id)).scalar()
+        run.discrepancies = discrepancies
+        run.audit_chain_ok = not broken_audit
+        run.report_path = report_path
+        session.commit()
+
+        summary = {
+            "run_id": run.id,
+            "users_checked": run.users_checked,
+            "discrepancies": discrepancies,
+            "broken_audit_logs": len(broken_audit),
+            "report_path": report_path,
+        }
+        log.info("Reconciliation finished", extra=summary)
+        return summary
+    except Exception:
+        session.rollback()
+        log.exception("Reconciliation error")
+        return None
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    run_reconciliation()
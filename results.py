@@ -0,0 +1,61 @@
+import enum
+
+
+class Result(str, enum.Enum):
+    """
+    نتائج دوال db_services (بدل النصوص الحرة "ERROR"، "NOT_FOUND"...).
+    كل عضو يساوي نصه تماماً (== و hash)، فالمقارنات القديمة في bot.py تبقى صحيحة،
+    لكن الأخطاء الإملائية تظهر فوراً (AttributeError) بدل أن تمر بصمت.
+    الاسم = القيمة دائماً: Enum يحسب hash من الاسم، فيبقى مطابقاً لـ hash النص.
+    """
+
+    SUCCESS = "SUCCESS"
+    AUTHORIZED = "AUTHORIZED"
+    UNCHANGED = "UNCHANGED"
+    EMPTY = "EMPTY"
+
+    # أخطاء في الطلب نفسه (متوقعة: لا تحسب من ميزانية الأخطاء)
+    NOT_FOUND = "NOT_FOUND"
+    USER_NOT_FOUND = "USER_NOT_FOUND"
+    BUYER_NOT_FOUND = "BUYER_NOT_FOUND"
+    DEAL_NOT_FOUND = "DEAL_NOT_FOUND"
+    DEAL_NOT_PENDING = "DEAL_NOT_PENDING"
+    WRONG_STATUS = "WRONG_STATUS"
+    NOT_DISPUTE = "NOT_DISPUTE"
+    MILESTONE_REQUIRED = "MILESTONE_REQUIRED"
+    SUM_MISMATCH = "SUM_MISMATCH"
+    INVALID = "INVALID"
+    INVALID_WINNER = "INVALID_WINNER"
+    TOO_MANY = "TOO_MANY"
+    INSUFFICIENT_FUNDS = "INSUFFICIENT_FUNDS"
+    AMOUNT_TOO_SMALL = "AMOUNT_TOO_SMALL"
+    ALREADY_REVIEWED = "ALREADY_REVIEWED"
+    CLAIMED_BY_OTHER = "CLAIMED_BY_OTHER"
+    IS_ADMIN = "IS_ADMIN"
+
+    # صلاحيات الأدمن
+    NOT_ADMIN = "NOT_ADMIN"
+    NO_PERMISSION = "NO_PERMISSION"
+    PIN_REQUIRED = "PIN_REQUIRED"
+    WRONG_PIN = "WRONG_PIN"
+    LOCKED = "LOCKED"
+
+    # أخطاء عندنا (تحسب من ميزانية الأخطاء)
+    RATES_UNAVAILABLE = "RATES_UNAVAILABLE"
+    ERROR = "ERROR"
+
+    def __str__(self):
+        return self.value
+
+
+# النتائج التي تعني أن الخطأ عندنا وليس في طلب المستخدم
+FAILURE_RESULTS = {Result.ERROR, Result.RATES_UNAVAILABLE}
+
+
+def outcome_of(result):
+    """تصنيف نتيجة دالة لعداد المقاييس: نص النتيجة المعروفة، أو ok لأي قيمة أخرى"""
+    if isinstance(result, dict):
+        result = result.get("status")
+    if isinstance(result, Result):
+        return result.value
+    return "ok"
@@ -0,0 +1,19 @@
+import os
+import asyncio
+import logging
+from db_services import aggregate_revenue_daily
+
+log = logging.getLogger(__name__)
+
+# تأخر تقرير اليوم الحالي (/revenue) عن آخر عمولة
+REVENUE_AGGREGATE_SECONDS = int(os.getenv("REVENUE_AGGREGATE_SECONDS", "60"))
+
+
+async def revenue_aggregator():
+    """حلقة خلفية: تجمع revenue_daily من revenue_entries بدل تحديثه داخل كل تحرير"""
+    while True:
+        try:
+            await asyncio.to_thread(aggregate_revenue_daily)
+        except Exception:
+            log.exception("Revenue aggregation error")
+        await asyncio.sleep(REVENUE_AGGREGATE_SECONDS)
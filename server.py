@@ -1,17 +1,66 @@
 import os
+import re
 import json
 import hashlib
 import hmac
+import time
+import asyncio
+import logging
 from fastapi import FastAPI, Request, HTTPException
-from db_services import add_balance_to_user, log_audit_event
+from fastapi.responses import FileResponse, Response
+from evidence_archiver import evidence_path
+from db_services import add_balance_to_user, log_audit_event, enqueue_outbound
+from results import Result
+from assets import normalize_asset, to_units, format_amount
 from models import Session, User # للتحقق السريع
-import httpx # لإرسال إشعار للمستخدم عبر تليجرام
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from metrics import HTTP_REQUEST_SECONDS
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from tracing import init_tracing, tracer, incoming_context
+from app_logging import configure_logging
+import profiling
+from migrations import check_schema
+
+configure_logging("escrow-webhook")
+check_schema()  # يرفض التشغيل على مخطط قاعدة أقدم من هذا الكود
+init_tracing("escrow-webhook")
+log = logging.getLogger(__name__)
 
 app = FastAPI()
 
 # توكن الكريبتو (نفس الموجود في .env)
 CRYPTO_TOKEN = os.getenv("CRYPTO_BOT_TOKEN")
-BOT_TOKEN = os.getenv("BOT_TOKEN") # توكن البوت لإرسال الإشعارات
+EVIDENCE_API_TOKEN = os.getenv("EVIDENCE_API_TOKEN") # مفتاح فريق النزاعات لعرض الأدلة
+PROFILE_API_TOKEN = os.getenv("PROFILE_API_TOKEN") # تشغيل تحليل الأداء (بدونه الـ endpoints معطلة)
+METRICS_API_TOKEN = os.getenv("METRICS_API_TOKEN") # Prometheus (authorization: Bearer)، بدونه /metrics معطل
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+@app.middleware("http")
+async def observe_latency(request: Request, call_next):
+    """زمن كل طلب في المقاييس + span جذر يرث traceparent إن أرسله الطرف الآخر"""
+    start = time.perf_counter()
+    status = 500
+    with tracer.start_as_current_span(
+        f"{request.method} {request.url.path}",
+        context=incoming_context(request.headers),
+        kind=SpanKind.SERVER,
+    ) as span:
+        try:
+            # "POST /webhook/crypto": يسجل بـ cProfile فقط إن فعله /profile/route
+            response = await profiling.profiled(
+                f"{request.method} {request.url.path}", lambda: call_next(request)
+            )
+            status = response.status_code
+            return response
+        finally:
+            # المسار المعرف (/evidence/{sha256}) لا الرابط الفعلي: عدد السلاسل يبقى محدوداً
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            span.update_name(f"{request.method} {route}")
+            span.set_attribute("http.status_code", status)
+            HTTP_REQUEST_SECONDS.labels(route=route, status=str(status)).observe(
+                time.perf_counter() - start
+            )
 
 def verify_signature(body: bytes, signature: str):
     """التحقق الأمني: هل الطلب فعلاً من CryptoBot؟"""
@@ -39,30 +88,104 @@ async def crypto_webhook(request: Request):
         payload = data.get("payload") # يحتوي على بيانات الفاتورة
         
         invoice_id = payload.get("invoice_id")
-        amount = float(payload.get("amount")) # المبلغ
+        amount = payload.get("amount") # المبلغ (نص: نحافظ على الدقة)
+        asset = normalize_asset(payload.get("asset"))
         user_id_str = payload.get("payload")  # خزنا فيه الـ Telegram ID سابقاً
         
         if not user_id_str:
             return {"status": "ignored", "reason": "no user id"}
             
         user_id = int(user_id_str)
+        if asset is None:
+            log.warning(
+                "Invoice paid in unsupported asset",
+                extra={"invoice_id": invoice_id, "asset": payload.get("asset")},
+            )
+            return {"status": "ignored", "reason": "unsupported asset"}
 
-        print(f"💰 Webhook received: Invoice {invoice_id} paid by {user_id}")
+        log.info("Webhook received", extra={"invoice_id": invoice_id, "user_id": user_id})
+        span = trace.get_current_span()
+        span.set_attribute("invoice.id", str(invoice_id))
+        span.set_attribute("telegram.user_id", user_id)
 
         # 4. تنفيذ الشحن في قاعدة البيانات
         # نمرر تفاصيل الفاتورة لمنع التكرار في السجلات
-        success = add_balance_to_user(user_id, amount)
+        result = add_balance_to_user(user_id, amount, asset, invoice_id=invoice_id)
+        if not result:
+            # 5xx: CryptoBot يعيد إرسال الـ webhook، والفاتورة لا تشحن مرتين (invoice_id)
+            raise HTTPException(status_code=503, detail="Deposit not credited")
+        if result == Result.UNCHANGED:
+            return {"status": "ok", "duplicate": True}
+
+        # نسجل في الـ Audit Log أن المصدر هو Webhook
+        units = to_units(amount, asset)
+        log_audit_event(user_id, "WEBHOOK_DEPOSIT", units, f"Invoice #{invoice_id}")
         
-        if success:
-            # نسجل في الـ Audit Log أن المصدر هو Webhook
-            log_audit_event(user_id, "WEBHOOK_DEPOSIT", int(amount*100), f"Invoice #{invoice_id}")
-            
-            # 5. إرسال إشعار للمستخدم في تليجرام (ميزة UX)
-            async with httpx.AsyncClient() as client:
-                msg_text = f"✅ **تم استلام دفعتك!**\nتم إضافة {amount}$ إلى رصيدك فوراً."
-                await client.post(
-                    f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                    json={"chat_id": user_id, "text": msg_text, "parse_mode": "Markdown"}
-                )
-                
-    return {"status": "ok"}
\ No newline at end of file
+        # 5. إشعار المستخدم عبر طابور outbound_messages (نفس مسار notify في البوت):
+        # عامل البوت يرسله بحدود المعدل ويعيده بعد RetryAfter أو خطأ شبكة بدل أن يضيع
+        msg_text = f"✅ **تم استلام دفعتك!**\nتم إضافة {format_amount(units, asset)} إلى رصيدك فوراً."
+        await asyncio.to_thread(enqueue_outbound, [
+            {"chat_id": user_id, "kind": "deposit", "text": msg_text, "parse_mode": "Markdown"},
+        ])
+
+    return {"status": "ok"}
+
+
+@app.get("/evidence/{sha256}")
+async def get_evidence(sha256: str, request: Request, thumb: bool = False):
+    """
+    عرض صورة دليل من التخزين المحلي (بدون المرور على تليجرام).
+    ?thumb=1 للصورة المصغرة.
+    """
+    token = request.headers.get("x-evidence-token", "")
+    if not EVIDENCE_API_TOKEN or not hmac.compare_digest(token, EVIDENCE_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if not SHA256_RE.match(sha256):
+        raise HTTPException(status_code=400, detail="Invalid hash")
+
+    path = evidence_path(sha256, "_thumb.jpg" if thumb else ".jpg")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Not archived")
+
+    # المحتوى لا يتغير أبداً لنفس البصمة، فنسمح بالتخزين المؤقت الطويل
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
+    )
+
+
+def _check_profile_token(request: Request):
+    token = request.headers.get("x-profile-token", "")
+    if not PROFILE_API_TOKEN or not hmac.compare_digest(token, PROFILE_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.post("/profile/sample")
+async def profile_sample(request: Request, seconds: int = 30):
+    """عينات من حلقة أحداث الخادم لمدة seconds إلى ملف .folded (Flame Graph)"""
+    _check_profile_token(request)
+    path, top = await profiling.sample_event_loop(seconds, name="webhook")
+    if path is None:
+        raise HTTPException(status_code=409, detail="Another profile is running")
+    return {"path": path, "top": [{"frame": frame, "percent": percent} for frame, percent in top]}
+
+
+@app.post("/profile/route")
+async def profile_route(request: Request, method: str, path: str, calls: int = 1):
+    """cProfile لأول calls طلبات قادمة على هذا المسار (ملفات .prof في PROFILE_DIR)"""
+    _check_profile_token(request)
+    profiling.arm(f"{method.upper()} {path}", calls)
+    return {"armed": profiling.armed(), "dir": profiling.PROFILE_DIR}
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """
+    مقاييس Prometheus لهذه العملية (البوت يعرض مقاييسه على منفذ جانبي خاص به).
+    الخادم عام (webhook)، والمقاييس تكشف حجم المعاملات والأخطاء: بتوكن فقط.
+    """
+    token = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not METRICS_API_TOKEN or not hmac.compare_digest(token, METRICS_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,152 @@
+import os
+import inspect
+import logging
+import functools
+from opentelemetry import trace, propagate
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from sqlalchemy import event
+from telegram.request import HTTPXRequest
+from models import engine
+from metrics import handler_label, iter_handlers
+
+log = logging.getLogger(__name__)
+
+# أين تذهب الـ spans: none (معطل) / console / file / otlp
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+# ملف JSON-lines للتشغيل بدون خادم تتبع (TRACE_EXPORTER=file)
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# نص الاستعلام يُقص في الـ span (الاستعلامات الجماعية قد تكون طويلة جداً)
+MAX_STATEMENT_CHARS = 2000
+
+tracer = trace.get_tracer("escrow")
+
+
+def _build_exporter():
+    if TRACE_EXPORTER == "console":
+        return ConsoleSpanExporter()
+    if TRACE_EXPORTER == "file":
+        out = open(TRACE_FILE, "a", encoding="utf-8")
+        return ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    if TRACE_EXPORTER == "otlp":
+        # اعتمادية اختيارية: تثبت فقط حيث يوجد Collector (العنوان من OTEL_EXPORTER_OTLP_ENDPOINT)
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    return None
+
+
+def init_tracing(service_name):
+    """
+    يستدعى مرة واحدة عند تشغيل العملية (البوت أو server.py).
+    بدون مصدّر تبقى الـ spans بلا تسجيل (تكلفة شبه معدومة).
+    """
+    exporter = _build_exporter()
+    if exporter is None:
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _trace_sql_statements()
+    log.info("Tracing enabled", extra={"service": service_name, "exporter": TRACE_EXPORTER})
+
+
+# --- استعلامات SQLAlchemy ---
+def _trace_sql_statements():
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_statement_span(conn, cursor, statement, parameters, context, executemany):
+        span = tracer.start_span(
+            "db.statement",
+            kind=SpanKind.CLIENT,
+            attributes={
+                "db.system": "postgresql",
+                "db.statement": statement[:MAX_STATEMENT_CHARS],
+            },
+        )
+        context._trace_span = span
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _end_statement_span(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_trace_span", None)
+        if span is not None:
+            span.set_attribute("db.rowcount", cursor.rowcount)
+            span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def _fail_statement_span(exception_context):
+        span = getattr(exception_context.execution_context, "_trace_span", None)
+        if span is not None:
+            span.record_exception(exception_context.original_exception)
+            span.set_status(Status(StatusCode.ERROR))
+            span.end()
+
+
+# --- دوال db_services ---
+def traced_db_call(operation, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracer.start_as_current_span(f"db_services.{operation}"):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def trace_db_module(namespace):
+    """مثل metrics.instrument_db_module: span لكل دالة عامة (يستدعى في آخر db_services)"""
+    module_name = namespace["__name__"]
+    for name, obj in list(namespace.items()):
+        if (
+            name.startswith("_")
+            or not inspect.isfunction(obj)
+            or obj.__module__ != module_name
+            or inspect.iscoroutinefunction(obj)
+        ):
+            continue
+        namespace[name] = traced_db_call(name, obj)
+
+
+# --- معالجات البوت ---
+def _traced_handler(label, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with tracer.start_as_current_span(f"handler {label}", kind=SpanKind.SERVER) as span:
+            user = getattr(update, "effective_user", None)
+            if user is not None:
+                span.set_attribute("telegram.user_id", user.id)
+            return await callback(update, context)
+    return wrapper
+
+
+def trace_handlers(application):
+    """يستدعى بعد تسجيل كل المعالجات: كل تحديث يبدأ trace جديداً"""
+    for handler in iter_handlers(application):
+        handler.callback = _traced_handler(handler_label(handler), handler.callback)
+
+
+# --- طلبات HTTP الخارجة ---
+class TracedRequest(HTTPXRequest):
+    """
+    كل طلب من البوت لـ Telegram API (sendMessage...) يصبح span ابناً للمعالج الذي أرسله.
+    الرابط يحتوي التوكن، فلا نسجل إلا اسم الطريقة.
+    """
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        with tracer.start_as_current_span(f"telegram.{api_method}", kind=SpanKind.CLIENT) as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            span.set_attribute("http.status_code", code)
+            if code >= 400:
+                span.set_status(Status(StatusCode.ERROR))
+            return code, payload
+
+
+def outbound_headers(headers=None):
+    """ترويسات طلب خارج تحمل سياق الـ trace الحالي (traceparent)"""
+    headers = dict(headers or {})
+    propagate.inject(headers)
+    return headers
+
+
+def incoming_context(headers):
+    """سياق الـ trace من ترويسات طلب وارد (إن أرسل المرسل traceparent)"""
+    return propagate.extract(headers)
@@ -0,0 +1,76 @@
+import os
+import asyncio
+import logging
+from db_services import claim_withdrawals_batch, finish_withdrawal, requeue_withdrawal
+from payment_services import send_transfer
+from outbox import notify
+
+log = logging.getLogger(__name__)
+
+# كم تحويلاً متزامناً نرسل لـ CryptoBot (حتى لا نتجاوز حدود الـ API)
+WITHDRAWAL_CONCURRENCY = int(os.getenv("WITHDRAWAL_CONCURRENCY", "3"))
+WITHDRAWAL_BATCH = int(os.getenv("WITHDRAWAL_BATCH", "20"))
+WITHDRAWAL_POLL_SECONDS = int(os.getenv("WITHDRAWAL_POLL_SECONDS", "15"))
+# بعد هذا العدد من المحاولات المؤقتة الفاشلة يتوقف العامل ويحيل الطلب لفريق المالية.
+# لا نعيد المال تلقائياً: ربما تم التحويل فعلاً وانقطع الرد فقط
+WITHDRAWAL_MAX_ATTEMPTS = int(os.getenv("WITHDRAWAL_MAX_ATTEMPTS", "8"))
+
+
+async def _process_one(semaphore, item):
+    async with semaphore:
+        amount = item["amount_cents"] / 100.0
+        outcome, detail = await send_transfer(
+            item["user_id"], amount, item["spend_id"], asset=item["asset"] or "USDT"
+        )
+
+    if outcome == "RETRY":
+        needs_review = item["attempts"] >= WITHDRAWAL_MAX_ATTEMPTS
+        await asyncio.to_thread(requeue_withdrawal, item["id"], detail, needs_review)
+        return
+
+    success = outcome == "OK"
+    if not success and item["attempts"] > 1:
+        # محاولة سابقة بنفس spend_id انتهت بلا رد: ربما وصل التحويل فعلاً،
+        # والرفض الآن لا يثبت العكس. إعادة المال هنا قد تدفع مرتين، فيراجعه فريق المالية
+        await asyncio.to_thread(requeue_withdrawal, item["id"], detail, True)
+        return
+
+    result = await asyncio.to_thread(
+        finish_withdrawal,
+        item["id"],
+        success,
+        transfer_id=detail if success else None,
+        error=None if success else detail,
+    )
+    if not isinstance(result, dict):
+        return
+
+    if success:
+        text = f"✅ **تم تحويل {amount}$** إلى محفظتك في CryptoBot (طلب #{item['id']})."
+    else:
+        text = (
+            f"❌ **تعذر تنفيذ السحب #{item['id']}**\n"
+            f"أعدنا {amount}$ إلى رصيدك. تأكد أنك بدأت محادثة مع @CryptoBot ثم حاول مجدداً."
+        )
+    await notify(item["user_id"], text, kind="withdrawal", parse_mode="Markdown")
+
+
+async def process_withdrawals_once(semaphore):
+    """دفعة واحدة: تعيد عدد الطلبات التي عولجت"""
+    items = await asyncio.to_thread(claim_withdrawals_batch, WITHDRAWAL_BATCH)
+    if items:
+        await asyncio.gather(*(_process_one(semaphore, item) for item in items))
+    return len(items)
+
+
+async def withdrawal_worker():
+    """حلقة خلفية تعمل بعمر البوت"""
+    semaphore = asyncio.Semaphore(WITHDRAWAL_CONCURRENCY)
+    while True:
+        try:
+            done = await process_withdrawals_once(semaphore)
+        except Exception:
+            log.exception("Withdrawal worker error")
+            done = 0
+        if done < WITHDRAWAL_BATCH:
+            await asyncio.sleep(WITHDRAWAL_POLL_SECONDS)